@@ -1,7 +1,79 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Min, Max
 from django.forms.widgets import TextInput
+from django.utils.functional import cached_property
 
+from .io import invalidate_series_hashes
 from .models import Dataset, Location, Param, Column, Datum, TagsField
+from .rollups import RollupRanges, delete_data
+
+# filtered data is counted up to this many rows (pages after these are not listed), and tables
+# with more rows than this are not counted at all (see EstimatedCountPaginator)
+MAX_EXACT_COUNT = 10000
+
+# locations and params are only listed in filters if there are at most this many (e.g., once a
+# dataset has been selected)
+MAX_FILTER_CHOICES = 200
+
+
+def estimated_count(model):
+    """
+    :return: An estimate of the number of rows in a model's table that does not read the table:
+      the planner's estimate on PostgreSQL, or the range of primary keys otherwise
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        # tables that have never been analyzed have no estimate
+        if row is not None and row[0] >= 0:
+            return int(row[0])
+    pk_range = model.objects.aggregate(first=Min('pk'), last=Max('pk'))
+    if pk_range['first'] is None:
+        return 0
+    return pk_range['last'] - pk_range['first'] + 1
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that does not COUNT(*) every row of a large table. Unfiltered tables with more
+    than MAX_EXACT_COUNT rows are counted using estimated_count(), and filtered rows are counted
+    up to MAX_EXACT_COUNT.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model)
+            if estimate > MAX_EXACT_COUNT:
+                return estimate
+        return queryset.order_by()[:MAX_EXACT_COUNT].count()
+
+
+class SlugListFilter(admin.RelatedFieldListFilter):
+    """
+    A filter on a foreign key to Dataset, Location or Param that lists the slugs of the related
+    objects using one query (rather than one per object). Locations and params are listed for
+    the selected dataset, or for all datasets if there are at most MAX_FILTER_CHOICES of them.
+    """
+
+    def field_choices(self, field, request, model_admin):
+        model = field.related_model
+        slug = model._meta.model_name
+        if model is Dataset:
+            return list(Dataset.objects.order_by('dataset').values_list('pk', 'dataset'))
+
+        objects = model.objects.all()
+        dataset_id = request.GET.get('dataset__id__exact', '')
+        if dataset_id.isdigit():
+            objects = objects.filter(dataset_id=dataset_id)
+        choices = [(pk, '%s / %s' % (ds, value)) for pk, ds, value in
+                   objects.order_by('dataset__dataset', slug)
+                   .values_list('pk', 'dataset__dataset', slug)[:MAX_FILTER_CHOICES + 1]]
+        return choices if len(choices) <= MAX_FILTER_CHOICES else []
 
 
 class TaggedAdmin(admin.ModelAdmin):
@@ -11,11 +83,50 @@ class TaggedAdmin(admin.ModelAdmin):
     }
 
 
+class DatasetObjectAdmin(TaggedAdmin):
+    # the dataset slug is part of each object's name
+    list_select_related = ('dataset', )
+
+
 class DatumAdmin(TaggedAdmin):
     fields = ('dataset', 'location', 'param', 'x', 'value', 'tags')
 
+    # the names of the dataset, location and param of each row are read in the same query, and
+    # the foreign keys are edited as ids rather than as a list of every object
+    list_select_related = ('dataset', 'location', 'param')
+    raw_id_fields = ('dataset', 'location', 'param')
+
+    # each filter (and combination of filters from left to right) is the first column(s) of an
+    # index that also provides this ordering; ordering by other columns would sort the table
+    list_filter = (('dataset', SlugListFilter), ('location', SlugListFilter), ('param', SlugListFilter))
+    ordering = ('dataset', 'location', 'param', 'x')
+    sortable_by = ()
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # keep rollups up to date with changes made here, and have incremental imports compare the
+    # changed series with their archives again
+    def save_model(self, request, obj, form, change):
+        rollups = RollupRanges()
+        with transaction.atomic():
+            if change:
+                # the datum may have been moved to another series or x
+                rollups.add_rows(Datum.objects.filter(pk=obj.pk).values_list('dataset_id', 'location_id', 'param_id',
+                                                                             'x'))
+            super(DatumAdmin, self).save_model(request, obj, form, change)
+            rollups.add((obj.dataset_id, obj.location_id, obj.param_id), obj.x, obj.x)
+            invalidate_series_hashes(set(series[0] for series in rollups.series), rollups.series)
+            rollups.update()
+
+    def delete_model(self, request, obj):
+        delete_data(Datum.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        delete_data(queryset)
+
 admin.site.register(Dataset, TaggedAdmin)
-admin.site.register(Location, TaggedAdmin)
-admin.site.register(Param, TaggedAdmin)
-admin.site.register(Column, TaggedAdmin)
+admin.site.register(Location, DatasetObjectAdmin)
+admin.site.register(Param, DatasetObjectAdmin)
+admin.site.register(Column, DatasetObjectAdmin)
 admin.site.register(Datum, DatumAdmin)
@@ -0,0 +1,167 @@
+"""
+Aggregate query results over buckets of x (e.g., daily means) using GROUP BY in the database
+"""
+
+import math
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import ExpressionWrapper, F, IntegerField, Avg, Count, Min, Max, Sum
+from django.db.models.functions import Cast, ExtractMonth, ExtractYear, Floor, Mod
+from django.utils import timezone
+
+from .downsample import numeric_data
+from .io import encode_rows
+
+# the aggregates that can be requested using 'agg'
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'count')
+
+# resample units that are a fixed number of seconds, so that x can be divided into buckets of
+# equal width (aligned to the epoch, i.e., midnight UTC on 1970-01-01)
+FIXED_UNITS = {'s': 1, 'min': 60, 'h': 3600, 'D': 86400, 'W': 7 * 86400}
+
+# resample units that are a number of months in the current time zone
+CALENDAR_UNITS = {'M': 1, 'Y': 12}
+
+# e.g., '1h', '15min', 'D', '3M', or a number (a bucket width in units of x, for non-datetime x)
+RESAMPLE_RE = re.compile(r'^([0-9]*\.?[0-9]*)(s|min|h|D|W|M|Y)?$')
+
+# the number of rows fetched per query when encoding aggregates
+DEFAULT_AGGREGATE_CHUNK_SIZE = 2000
+
+_AGGREGATE_EXPRESSIONS = {
+    'mean': lambda: Avg('value_num'),
+    'min': lambda: Min('value_num'),
+    'max': lambda: Max('value_num'),
+    'sum': lambda: Sum('value_num'),
+    'count': lambda: Count('id'),
+}
+
+
+class Resample:
+    """
+    A bucket size parsed from a resample string
+    :ivar width: The bucket width, in units of x (for fixed units and numbers) or months
+    :ivar calendar: True if buckets are calendar months
+    :ivar datetime: True if buckets are of datetimes (i.e., the resample string had a unit)
+    """
+
+    def __init__(self, resample):
+        match = RESAMPLE_RE.match(resample)
+        if match is None or match.group(1) in ('', '.') and match.group(2) is None:
+            raise ValueError("Unparsable resample: %s" % resample)
+        number, unit = match.groups()
+        number = float(number) if number not in ('', '.') else 1.0
+
+        self.calendar = unit in CALENDAR_UNITS
+        self.datetime = unit is not None
+        if self.calendar:
+            if number != int(number):
+                raise ValueError("Unparsable resample: %s" % resample)
+            self.width = int(number) * CALENDAR_UNITS[unit]
+        else:
+            self.width = number * FIXED_UNITS[unit] if unit is not None else number
+        if self.width <= 0:
+            raise ValueError("resample must be positive: %s" % resample)
+
+    def bucket(self):
+        """
+        :return: An expression for the start of each row's bucket: x for fixed widths, or months
+          since year 0 for calendar buckets
+        """
+        if self.calendar:
+            months = Cast(ExtractYear('datetime'), IntegerField()) * 12 + \
+                Cast(ExtractMonth('datetime'), IntegerField()) - 1
+            return ExpressionWrapper(months - Mod(months, self.width), output_field=IntegerField())
+        return Floor(F('x') / self.width) * self.width
+
+    def bucket_of(self, x):
+        """
+        :return: The bucket (see bucket()) that contains x, computed in Python
+        """
+        if self.calendar:
+            dt = datetime.fromtimestamp(x, timezone.get_current_timezone())
+            months = dt.year * 12 + dt.month - 1
+            return months - months % self.width
+        return math.floor(x / self.width) * self.width
+
+    def bucket_x(self, bucket):
+        """
+        :return: An (x, datetime) tuple for the start of a bucket, where datetime is None if
+          buckets are not of datetimes
+        """
+        if self.calendar:
+            year, month = divmod(int(bucket), 12)
+            dt = timezone.make_aware(datetime(year, month + 1, 1))
+            return dt.timestamp(), dt
+        if self.datetime:
+            return bucket, datetime.fromtimestamp(bucket, dt_timezone.utc)
+        return bucket, None
+
+
+def parse_aggregates(agg):
+    """
+    :param agg: A comma-separated list of AGGREGATES
+    """
+    aggs = agg.split(',')
+    for name in aggs:
+        if name not in AGGREGATES:
+            raise ValueError("agg must be a comma-separated list of %s" % ', '.join(AGGREGATES))
+    return aggs
+
+
+def aggregate_data(data, resample, aggs=('mean', )):
+    """
+    Aggregate the numeric values of each (location, param) series in a Datum QuerySet over buckets
+    of x, in the database
+    :param resample: A Resample
+    :param aggs: A list of AGGREGATES
+    :return: A QuerySet of dicts with the ids and slugs of the dataset, location and param, bucket
+      (see Resample.bucket()), and a value for each of aggs, ordered by series ids and bucket
+    """
+    data = numeric_data(data)
+    if resample.calendar:
+        data = data.filter(datetime__isnull=False)
+
+    return data.order_by() \
+        .annotate(bucket=resample.bucket()) \
+        .values('dataset_id', 'location_id', 'param_id', 'dataset__dataset', 'location__location', 'param__param',
+                'bucket') \
+        .annotate(**{name: _AGGREGATE_EXPRESSIONS[name]() for name in aggs}) \
+        .order_by('dataset_id', 'location_id', 'param_id', 'bucket')
+
+
+def aggregate_rows(data, resample, aggs=('mean', ), chunk_size=DEFAULT_AGGREGATE_CHUNK_SIZE):
+    """
+    Generate the rows of aggregate_data() as (dataset, location, param, x, datetime, *aggs) tuples
+    """
+    return bucket_rows(aggregate_data(data, resample, aggs).iterator(chunk_size=chunk_size), resample, aggs)
+
+
+def bucket_rows(buckets, resample, aggs):
+    """
+    Convert the dicts returned by aggregate_data() to (dataset, location, param, x, datetime, *aggs) tuples
+    """
+    for row in buckets:
+        x, dt = resample.bucket_x(row['bucket'])
+        yield (row['dataset__dataset'], row['location__location'], row['param__param'], x, dt) + \
+            tuple(row[name] for name in aggs)
+
+
+def encode_aggregates(rows, aggs, format, chunk_size=DEFAULT_AGGREGATE_CHUNK_SIZE):
+    """
+    Encode the rows generated by aggregate_rows() as chunks of text in one of QUERY_FORMATS
+    """
+    header = ('dataset', 'location', 'param', 'x', 'datetime') + tuple(aggs)
+
+    def formatted(row):
+        dt = row[4]
+        return row[:4] + (None if dt is None else dt.isoformat(), ) + row[5:]
+
+    def csv_row(row):
+        return ['' if value is None else value for value in formatted(row)]
+
+    def json_object(row):
+        return dict(zip(header, formatted(row)))
+
+    return encode_rows(rows, format, header, csv_row, json_object, chunk_size)
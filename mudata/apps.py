@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MudataConfig(AppConfig):
     name = 'mudata'
+
+    def ready(self):
+        # connect the signals that invalidate the slug cache and index tags and coordinates
+        from . import slugs, spatial, tagindex  # noqa: F401
@@ -0,0 +1,274 @@
+"""
+Benchmarks for the performance-sensitive parts of mudata. Each benchmark returns a dict
+(or a list of dicts) of results so that runs can be compared over time. Benchmarks that
+need a database are run using the mudata_benchmark management command; the others can
+be run using:
+
+    python -m mudata.benchmarks
+"""
+
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+try:
+    import resource
+except ImportError:  # pragma: no cover (not available on windows)
+    resource = None
+
+
+# the formats of views.query() responses that are benchmarked, which stream every row
+QUERY_BENCHMARK_FORMATS = ('csv', 'json')
+
+
+def strptime_parse(x):
+    # the datetime_parse() implementation that datetime_parse.DATETIME_FORMATS replaced,
+    # kept as the reference for benchmark_datetime_parse()
+    from .datetime_parse import DATETIME_FORMATS
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(x, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Could not parse x value: %s' % x)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to its current size (linux only)
+    :return: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return peak_rss_kb() is not None
+
+
+def peak_rss_kb():
+    """
+    The peak resident set size of this process since it started or since reset_peak_rss(), in
+    kilobytes (None where unavailable)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss cannot be reset: it is the peak since the process started
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call func, returning its result along with the wall time, query count and the peak RSS
+    during the call (None if the peak cannot be reset, in which case a peak would include
+    earlier runs in the same process)
+    """
+    from django.db import connection
+    from .instrumentation import QueryCounter
+
+    reset = reset_peak_rss()
+    start_rss = peak_rss_kb() if reset else None
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+    peak_rss = peak_rss_kb() if reset else None
+    return result, {'seconds': seconds, 'queries': counter.count, 'peak_rss_kb': peak_rss,
+                    'rss_growth_kb': None if peak_rss is None else peak_rss - start_rss}
+
+
+def benchmark_datetime_parse(n=100000, seed=0):
+    """
+    Compare per-value strptime() parsing with datetime_parse() and datetime_parse_array()
+    on date, datetime and numeric x columns
+    """
+    from .datetime_parse import datetime_parse, datetime_parse_array
+
+    def parse_each(parse, values):
+        for x in values:
+            try:
+                parse(x)
+            except ValueError:
+                pass
+
+    rand = random.Random(seed)
+    start = datetime(1990, 1, 1)
+    columns = {
+        'date': [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(n)],
+        'datetime': [(start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S') for i in range(n)],
+        'datetime_tz': [(start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M -0300') for i in range(n)],
+        'numeric': [str(rand.uniform(-1000, 1000)) for i in range(n)],
+    }
+
+    results = {}
+    for name, values in columns.items():
+        strptime_time = timed(parse_each, strptime_parse, values)
+        parse_time = timed(parse_each, datetime_parse, values)
+        array_time = timed(datetime_parse_array, values)
+        results[name] = {
+            'rows': n,
+            'strptime_rows_per_sec': n / strptime_time,
+            'datetime_parse_rows_per_sec': n / parse_time,
+            'datetime_parse_array_rows_per_sec': n / array_time,
+            'speedup': strptime_time / array_time,
+        }
+    return results
+
+
+def benchmark_import(zip_file, n_rows, engine='bulk', **kwargs):
+    """
+    Time import_mudata() on a generated archive
+    :param zip_file: An archive written by mudata.synthetic.generate_mudata()
+    :param n_rows: The number of rows in data.csv
+    :param kwargs: Passed to import_mudata()
+    """
+    from .io import import_mudata
+
+    report, stats = measure(import_mudata, zip_file, engine=engine, **kwargs)
+    stats.update({'benchmark': 'import', 'engine': engine, 'rows': n_rows,
+                  'defer_rollups': kwargs.get('defer_rollups', False),
+                  'rows_per_sec': n_rows / stats['seconds'], 'stages': report.as_dict()['stages']})
+    return stats
+
+
+def benchmark_rebuild_rollups(dataset_ids, n_rows):
+    """
+    Time rebuild_rollups() for the given datasets (the work deferred by imports with defer_rollups)
+    """
+    from .rollups import rebuild_rollups
+
+    _, stats = measure(rebuild_rollups, dataset_ids)
+    stats.update({'benchmark': 'rebuild_rollups', 'rows': n_rows, 'rows_per_sec': n_rows / stats['seconds']})
+    return stats
+
+
+def response_size(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+def benchmark_query(query_params, name, response_format='csv'):
+    """
+    Time views.query() for a query string, reading the whole (streamed) response
+    :param query_params: A dict of query parameters
+    :param name: A name for the query shape, used in the results
+    :param response_format: One of views.QUERY_FORMATS. The html format only renders the first
+      rows of the result, so it does not measure the query.
+    """
+    from django.test import RequestFactory
+    from . import views
+
+    request = RequestFactory().get('/query/%s' % response_format, query_params)
+    n_bytes, stats = measure(lambda: response_size(views.query(request, response_format)))
+    stats.update({'benchmark': 'query', 'query': name, 'format': response_format, 'bytes': n_bytes})
+    return stats
+
+
+def benchmark_views(dataset, location, param):
+    """
+    Time the dataset, location and param pages
+    """
+    from django.test import RequestFactory
+    from . import views
+
+    factory = RequestFactory()
+    pages = (
+        ('view_dataset', views.view_dataset, (dataset, )),
+        ('view_location', views.view_location, (dataset, location)),
+        ('view_param', views.view_param, (dataset, param)),
+    )
+
+    results = []
+    for name, view, args in pages:
+        request = factory.get('/view/')
+        n_bytes, stats = measure(lambda: response_size(view(request, *args)))
+        stats.update({'benchmark': 'view', 'view': name, 'bytes': n_bytes})
+        results.append(stats)
+    return results
+
+
+def benchmark_synthetic(n_rows, engine='bulk', x_type='datetime', tmp_dir=None, defer_rollups=False, **kwargs):
+    """
+    Generate an archive with n_rows of data, import it (the database must not already contain
+    the generated datasets), then benchmark queries and views against it. The generated datasets
+    are dropped afterwards.
+    :param defer_rollups: Import without updating rollups, then benchmark rebuilding them, so that
+      the cost of maintaining rollups during imports can be compared with rebuilding them afterwards
+    :param kwargs: Passed to mudata.synthetic.generate_mudata()
+    :return: A list of results
+    """
+    import os
+    import tempfile
+    from .drop import drop_dataset
+    from .models import Dataset
+    from .synthetic import generate_mudata, dataset_slug, location_slug, param_slug, X_START, X_STEP
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        zip_file = os.path.join(tmp, 'synthetic.mudata.zip')
+        start = time.perf_counter()
+        generate_mudata(zip_file, n_rows=n_rows, x_type=x_type, **kwargs)
+        generate_seconds = time.perf_counter() - start
+
+        import_stats = benchmark_import(zip_file, n_rows, engine=engine, defer_rollups=defer_rollups)
+        import_stats.update({'x_type': x_type, 'generate_seconds': generate_seconds,
+                             'zip_bytes': os.path.getsize(zip_file)})
+
+    results = [import_stats]
+    dataset_slugs = [dataset_slug(i) for i in range(kwargs.get('n_datasets', 1))]
+    if defer_rollups:
+        dataset_ids = list(Dataset.objects.filter(dataset__in=dataset_slugs).order_by('id')
+                           .values_list('id', flat=True))
+        results.append(benchmark_rebuild_rollups(dataset_ids, n_rows))
+
+    # restrict x to roughly the first 10% of each series
+    n_series = kwargs.get('n_datasets', 1) * kwargs.get('n_locations', 5) * kwargs.get('n_params', 5)
+    n_x = max(n_rows // n_series // 10, 1)
+    if x_type == 'datetime':
+        x_range = {'datetime_from': X_START.strftime('%Y-%m-%d %H:%M:%S'),
+                   'datetime_to': (X_START + X_STEP * n_x).strftime('%Y-%m-%d %H:%M:%S')}
+    else:
+        x_range = {'x_from': '0', 'x_to': str(n_x)}
+
+    queries = (
+        ('dataset', {'datasets': dataset_slug(0)}),
+        ('param', {'params': param_slug(0)}),
+        ('location_param', {'locations': location_slug(0), 'params': param_slug(0)}),
+        ('x_range', x_range),
+    )
+    for name, query_params in queries:
+        for response_format in QUERY_BENCHMARK_FORMATS:
+            stats = benchmark_query(query_params, name, response_format)
+            stats['rows'] = n_rows
+            results.append(stats)
+
+    for stats in benchmark_views(dataset_slug(0), location_slug(0), param_slug(0)):
+        stats['rows'] = n_rows
+        results.append(stats)
+
+    # remove the generated datasets (and only those) for the next run
+    drop_dataset(*dataset_slugs)
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps({'datetime_parse': benchmark_datetime_parse()}, indent=2))
@@ -1,27 +1,146 @@
-
-from datetime import datetime
+import re
+from datetime import datetime, timedelta, timezone
 
 EPOCH = datetime(1970, 1, 1, 0, 0, tzinfo=datetime.utcnow().tzinfo)
 
+# formats accepted by datetime_parse(), in the order they are tried
+DATETIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M %z', '%Y-%m-%d %H:%M:%S %z',
+                    '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f %z',
+                    '%Y-%m-%d %H:%M:%S.%f')
 
-def datetime_parse(x):
-    if x is None:
-        return x
+# zero-padded versions of DATETIME_FORMATS that can be parsed without strptime(). Groups are
+# year, month, day, hour, minute, second, fraction of a second, utc offset sign, utc offset
+# hours, utc offset minutes.
+# Patterns end in \Z rather than $, which would also match before a trailing newline.
+_FAST_FORMATS = tuple(re.compile(pattern, re.ASCII) for pattern in (
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})()()()()()()()\Z',
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2})()()(?: ([+-])([0-9]{2})([0-9]{2}))?\Z',
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?'
+    r'(?: ([+-])([0-9]{2})([0-9]{2}))?\Z',
+))
+
+# the index of the last fast format and strptime() format that succeeded, which are tried first
+_last_fast_format = 0
+_last_format = 0
+
+# timezone objects keyed by utc offset string, so that they are not re-created for each value
+_timezones = {}
+
+
+def _fast_parse(x, pattern):
+    match = pattern.match(x)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, sign, tz_hours, tz_minutes = match.groups()
+    try:
+        tzinfo = _timezone(sign, tz_hours, tz_minutes) if sign else None
+        return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                        int(second or 0), int(fraction.ljust(6, '0')) if fraction else 0, tzinfo=tzinfo)
+    except ValueError:
+        # out of range values (e.g., 2017-02-30), left to strptime() to report
+        return None
+
+
+def _timezone(sign, tz_hours, tz_minutes):
+    tz_key = sign + tz_hours + tz_minutes
+    tzinfo = _timezones.get(tz_key)
+    if tzinfo is None:
+        if int(tz_minutes) > 59:
+            raise ValueError('Invalid utc offset: %s' % tz_key)
+        offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+        tzinfo = timezone(-offset if sign == '-' else offset)
+        _timezones[tz_key] = tzinfo
+    return tzinfo
+
+
+def _strptime_parse(x):
+    global _last_format
+
+    # strptime() can only succeed if x starts with a four-digit year followed by a '-',
+    # which quickly rules out numeric x values
+    if len(x) < 5 or x[4] != '-':
+        raise ValueError('Could not parse x value: %s' % x)
 
-    for date_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M %z', '%Y-%m-%d %H:%M:%S %z',
-                        '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+    n_formats = len(DATETIME_FORMATS)
+    for i in range(n_formats):
+        format_index = (_last_format + i) % n_formats
         try:
-            return datetime.strptime(x, date_format)
+            dt = datetime.strptime(x, DATETIME_FORMATS[format_index])
         except ValueError:
-            pass
+            continue
+        _last_format = format_index
+        return dt
 
     raise ValueError('Could not parse x value: %s' % x)
 
 
+def datetime_parse(x):
+    global _last_fast_format
+
+    if x is None:
+        return x
+
+    # try the format that worked last time first, then the others
+    n_formats = len(_FAST_FORMATS)
+    for i in range(n_formats):
+        format_index = (_last_fast_format + i) % n_formats
+        dt = _fast_parse(x, _FAST_FORMATS[format_index])
+        if dt is not None:
+            _last_fast_format = format_index
+            return dt
+
+    # values that aren't zero-padded (e.g., 2017-5-9), offsets such as 'Z' or '+03:00'
+    return _strptime_parse(x)
+
+
+def datetime_parse_array(values):
+    """
+    Parse a column of x values, detecting the format from the values themselves so that
+    each value is usually matched against a single pattern
+    :param values: A sequence of strings
+    :return: A list of datetime objects, with None for values that could not be parsed
+    """
+    global _last_fast_format
+
+    n_formats = len(_FAST_FORMATS)
+    format_index = _last_fast_format
+    pattern = _FAST_FORMATS[format_index]
+
+    result = []
+    for x in values:
+        dt = _fast_parse(x, pattern)
+        if dt is None:
+            # the format changed (or this element needs strptime())
+            for i in range(1, n_formats):
+                candidate = (format_index + i) % n_formats
+                dt = _fast_parse(x, _FAST_FORMATS[candidate])
+                if dt is not None:
+                    format_index = candidate
+                    pattern = _FAST_FORMATS[candidate]
+                    break
+            else:
+                try:
+                    dt = _strptime_parse(x)
+                except ValueError:
+                    dt = None
+        result.append(dt)
+
+    _last_fast_format = format_index
+    return result
+
+
 def datetime_numeric(dt):
     return dt.timestamp()
 
 
+def datetime_numeric_array(dts):
+    """
+    Convert a list of datetimes (or None) to a list of numeric values (or None)
+    """
+    return [None if dt is None else dt.timestamp() for dt in dts]
+
+
 def datetime_parse_numeric(x):
     dt = datetime_parse(x)
     if dt is None:
@@ -0,0 +1,167 @@
+"""
+Downsample query results for plotting, so that the number of points returned for each
+(location, param) series depends on the width of the plot rather than on the number of rows
+"""
+
+import itertools
+
+from django.db import connection
+from django.db.models import F, Count, Min, Max
+from django.db.models.functions import Floor, Least
+
+from .models import Location, Param
+
+# 'minmax' returns the minimum and maximum of each bucket of x values at the x values where they
+# occur (M4-style, computed in the database),
+# 'lttb' selects one point per bucket using Largest-Triangle-Three-Buckets
+PLOT_METHODS = ('minmax', 'lttb')
+
+# plot widths, in buckets (i.e., pixels)
+DEFAULT_PLOT_WIDTH = 800
+MAX_PLOT_WIDTH = 10000
+
+# the number of rows fetched per query by downsample_lttb()
+DEFAULT_PLOT_CHUNK_SIZE = 10000
+
+
+def numeric_data(data):
+    """
+    Restrict a Datum QuerySet to rows whose value is a number (see models.numeric_value())
+    """
+    return data.filter(value_num__isnull=False)
+
+
+def downsample(data, width=DEFAULT_PLOT_WIDTH, method='minmax'):
+    """
+    Downsample the numeric values of each (location, param) series in a Datum QuerySet
+    :param width: The number of buckets that x values are divided into
+    :param method: One of PLOT_METHODS
+    :return: A list of dicts with the dataset, location and param slugs and the points
+      ([x, value] lists, ordered by x) of each series
+    """
+    if method not in PLOT_METHODS:
+        raise ValueError("method must be one of %s" % ', '.join(PLOT_METHODS))
+    if not 3 <= width <= MAX_PLOT_WIDTH:
+        raise ValueError("width must be between 3 and %s" % MAX_PLOT_WIDTH)
+
+    data = numeric_data(data)
+    series = downsample_minmax(data, width) if method == 'minmax' else downsample_lttb(data, width)
+
+    locations = {location_id: (dataset, location) for location_id, dataset, location in
+                 Location.objects.filter(id__in=set(key[0] for key in series))
+                 .values_list('id', 'dataset__dataset', 'location')}
+    params = dict(Param.objects.filter(id__in=set(key[1] for key in series)).values_list('id', 'param'))
+    return [{'dataset': locations[location_id][0], 'location': locations[location_id][1],
+             'param': params[param_id], 'points': points}
+            for (location_id, param_id), points in sorted(series.items())]
+
+
+def downsample_minmax(data, width=DEFAULT_PLOT_WIDTH):
+    """
+    Divide the x range of (numeric) data into width buckets of equal size and find the minimum
+    and maximum value in each bucket of each series, and the first x at which each occurs. The
+    minimum and maximum are found using a GROUP BY query, which is joined back to the rows of
+    each bucket (whose x values are contiguous) to find their x values.
+    :return: A dict of (location_id, param_id) -> points, with up to two points per bucket (the
+      minimum and the maximum, in order of x)
+    """
+    x_range = data.aggregate(x_min=Min('x'), x_max=Max('x'))
+    x_min, x_max = x_range['x_min'], x_range['x_max']
+    if x_min is None:
+        return {}
+    scale = width / (x_max - x_min) if x_max > x_min else 0
+
+    buckets = data.order_by() \
+        .annotate(bucket=Least(Floor((F('x') - x_min) * scale), width - 1)) \
+        .values('location_id', 'param_id', 'bucket') \
+        .annotate(x_first=Min('x'), x_last=Max('x'), y_min=Min('value_num'), y_max=Max('value_num'))
+    rows = data.order_by().values('location_id', 'param_id', 'x', 'value_num')
+    buckets_sql, buckets_params = buckets.query.sql_with_params()
+    rows_sql, rows_params = rows.query.sql_with_params()
+
+    sql = 'SELECT b.location_id, b.param_id, b.y_min, b.y_max, ' \
+          'MIN(CASE WHEN d.value_num = b.y_min THEN d.x END), MIN(CASE WHEN d.value_num = b.y_max THEN d.x END) ' \
+          'FROM (%s) b INNER JOIN (%s) d ON d.location_id = b.location_id AND d.param_id = b.param_id ' \
+          'AND d.x >= b.x_first AND d.x <= b.x_last AND (d.value_num = b.y_min OR d.value_num = b.y_max) ' \
+          'GROUP BY b.location_id, b.param_id, b.bucket, b.y_min, b.y_max ' \
+          'ORDER BY b.location_id, b.param_id, b.bucket' % (buckets_sql, rows_sql)
+
+    series = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, buckets_params + rows_params)
+        for location_id, param_id, y_min, y_max, x_of_min, x_of_max in cursor:
+            points = series.setdefault((location_id, param_id), [])
+            if x_of_min == x_of_max:
+                points.append([x_of_min, y_min])
+            else:
+                points.extend(sorted([[x_of_min, y_min], [x_of_max, y_max]]))
+    return series
+
+
+def downsample_lttb(data, width=DEFAULT_PLOT_WIDTH, chunk_size=DEFAULT_PLOT_CHUNK_SIZE):
+    """
+    Select width points from each series of (numeric) data using lttb(), streaming rows in x
+    order from a server-side cursor so that only two buckets of each series are held in memory
+    :return: A dict of (location_id, param_id) -> points
+    """
+    counts = {(location_id, param_id): n for location_id, param_id, n in
+              data.order_by().values_list('location_id', 'param_id').annotate(n=Count('id'))}
+
+    rows = data.order_by('location_id', 'param_id', 'x') \
+        .values_list('location_id', 'param_id', 'x', 'value_num').iterator(chunk_size=chunk_size)
+    series = {}
+    for key, series_rows in itertools.groupby(rows, key=lambda row: row[:2]):
+        points = ((x, value) for location_id, param_id, x, value in series_rows)
+        series[key] = [[x, y] for x, y in lttb(points, counts.get(key, 0), width)]
+    return series
+
+
+def lttb(points, n, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling (Steinarsson, 2013). The first and last points are
+    kept, and the others are divided into threshold - 2 buckets of (nearly) equal size. From each
+    bucket, the point that forms the largest triangle with the point selected from the previous
+    bucket and the average of the next bucket is selected.
+    :param points: An iterable of (x, y) tuples in order of x
+    :param n: The number of points
+    :param threshold: The number of points to select (at least 3)
+    :return: A generator of the selected (x, y) tuples
+    """
+    points = iter(points)
+    if n <= threshold:
+        yield from points
+        return
+
+    selected = next(points, None)
+    if selected is None:
+        return
+    yield selected
+
+    # the middle bucket i has the points after the first with indexes in
+    # [i * (n - 2) // (threshold - 2), (i + 1) * (n - 2) // (threshold - 2)), and a final bucket has the
+    # last point. Buckets may be short if there are fewer than n points.
+    n_buckets = threshold - 2
+    bounds = [i * (n - 2) // n_buckets for i in range(n_buckets + 1)]
+
+    def buckets():
+        for start, end in zip(bounds, bounds[1:]):
+            yield list(itertools.islice(points, end - start))
+        yield list(itertools.islice(points, 1))
+
+    buckets = buckets()
+    bucket = next(buckets)
+    for next_bucket in buckets:
+        if bucket:
+            if next_bucket:
+                c_x = sum(x for x, y in next_bucket) / len(next_bucket)
+                c_y = sum(y for x, y in next_bucket) / len(next_bucket)
+            else:
+                c_x, c_y = bucket[-1]
+            a_x, a_y = selected
+            # twice the area of the triangle a, p, c
+            selected = max(bucket, key=lambda p: abs((a_x - c_x) * (p[1] - a_y) - (a_x - p[0]) * (c_y - a_y)))
+            yield selected
+        bucket = next_bucket
+
+    # the last point
+    yield from bucket
@@ -0,0 +1,93 @@
+"""
+Drop or replace whole datasets using one DELETE statement per table, rather than through the
+cascade collector of QuerySet.delete() (which loads the primary key of every row that refers to
+a dataset into memory)
+"""
+
+from .instrumentation import DEFAULT_PROGRESS_EVERY
+from .io import import_mudata, write_transaction, DEFAULT_BATCH_SIZE
+from .models import (Dataset, Location, Param, Column, Datum, LocationTag, LocationPoint, ParamTag, TableHash,
+                     SeriesHash, Rollup)
+from .slugs import slug_cache
+
+
+def dataset_rows(ds_id):
+    """
+    :return: A list of QuerySets of all the rows that belong to a dataset, in an order in which
+      they can be deleted (rows that refer to others come first). Each is filtered on an indexed
+      column of its own table, so that it can be deleted using a single DELETE statement.
+    """
+    locations = Location.objects.filter(dataset_id=ds_id).values('id')
+    params = Param.objects.filter(dataset_id=ds_id).values('id')
+    return [
+        Datum.objects.filter(dataset_id=ds_id),
+        Rollup.objects.filter(dataset_id=ds_id),
+        SeriesHash.objects.filter(dataset_id=ds_id),
+        TableHash.objects.filter(dataset_id=ds_id),
+        LocationTag.objects.filter(location_id__in=locations),
+        LocationPoint.objects.filter(location_id__in=locations),
+        ParamTag.objects.filter(param_id__in=params),
+        Column.objects.filter(dataset_id=ds_id),
+        Location.objects.filter(dataset_id=ds_id),
+        Param.objects.filter(dataset_id=ds_id),
+        Dataset.objects.filter(pk=ds_id),
+    ]
+
+
+def delete_dataset_rows(ds_id, counts):
+    """
+    Delete the rows of dataset_rows(), adding the number deleted from each table to counts. No
+    rows are loaded and no signals are sent, so the caller invalidates the slug cache.
+    """
+    for rows in dataset_rows(ds_id):
+        deleted = rows._raw_delete(rows.db)
+        counts[rows.model._meta.label] = counts.get(rows.model._meta.label, 0) + deleted
+
+
+def drop_dataset(*datasets):
+    """
+    Delete datasets and everything that belongs to them (metadata, data, rollups, indexes and
+    incremental import hashes) in one transaction, so that readers see either all or none of
+    each dataset
+    :param datasets: Dataset slugs
+    :return: A dict of model label (e.g., 'mudata.Datum') -> the number of rows deleted
+    :raises Dataset.DoesNotExist: if any of datasets does not exist
+    """
+    counts = {}
+    with write_transaction():
+        ids = dict(Dataset.objects.filter(dataset__in=datasets).values_list('dataset', 'id'))
+        missing = [slug for slug in datasets if slug not in ids]
+        if missing:
+            raise Dataset.DoesNotExist('Unknown dataset(s): %s' % ', '.join(missing))
+        for slug in datasets:
+            delete_dataset_rows(ids[slug], counts)
+
+    slug_cache.invalidate(ids.values())
+    return counts
+
+
+def replace_dataset(dataset, zip_file, engine='bulk', batch_size=DEFAULT_BATCH_SIZE, progress=None,
+                    progress_every=DEFAULT_PROGRESS_EVERY):
+    """
+    Replace a dataset with its contents in a mudata archive. The existing dataset (if any) is
+    deleted as in drop_dataset() and the new one is imported in the same transaction, so that
+    readers see the old dataset until the new one is complete.
+    :param dataset: The slug of the dataset (other datasets in the archive are not imported)
+    :param engine: 'bulk' or 'columnar' (see io.import_mudata())
+    :return: A (counts, report) tuple of the rows deleted (see drop_dataset()) and the
+      ImportReport of the import
+    :raises ValueError: if the archive does not contain the dataset
+    """
+    counts = {}
+    with write_transaction():
+        ds_id = Dataset.objects.filter(dataset=dataset).values_list('id', flat=True).first()
+        if ds_id is not None:
+            delete_dataset_rows(ds_id, counts)
+
+        report = import_mudata(zip_file, engine=engine, batch_size=batch_size, progress=progress,
+                               progress_every=progress_every, dataset_slugs=[dataset])
+        if not Dataset.objects.filter(dataset=dataset).exists():
+            raise ValueError('Dataset "%s" is not in the archive' % dataset)
+
+    slug_cache.invalidate([ds_id] if ds_id is not None else [])
+    return counts, report
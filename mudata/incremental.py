@@ -0,0 +1,351 @@
+"""
+Incremental re-import of mudata archives. The archive is treated as the new version of the
+datasets it contains: a content hash is stored for each metadata table and each (dataset,
+location, param) series, series whose hash is unchanged are skipped, and only the rows that
+differ in the others are inserted, updated or deleted.
+"""
+
+import hashlib
+import itertools
+import json
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+
+from .io import (DATA_COLUMNS, DEFAULT_BATCH_SIZE, import_metadata, open_member, read_table, parse_data,
+                 prepare_data, insert_data, row_error, duplicate_error, write_transaction)
+from .models import Location, Datum, TableHash, SeriesHash
+from .rollups import RollupRanges
+from .spatial import index_points
+from .tagindex import TAG_MODELS, index_tags
+
+# rows are compared using 128-bit digests, summed modulo 2 ** 128 so that row order does not matter
+_HASH_MODULUS = 1 << 128
+
+# number of ids per DELETE query (stays below SQLite's default limit on query parameters)
+DELETE_BATCH_SIZE = 500
+
+# the most rows of changed series that are parsed and held in memory before they are written
+DEFAULT_SYNC_ROWS = 200000
+
+
+class MultisetHash:
+    """
+    An order-independent hash of a collection of rows of strings. The hash changes if a row
+    is added, removed or changed, but not if rows are reordered.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+
+    def add(self, *values):
+        digest = hashlib.blake2b('\x1f'.join(values).encode('utf-8'), digest_size=16).digest()
+        self.total = (self.total + int.from_bytes(digest, 'big')) % _HASH_MODULUS
+        self.count += 1
+
+    def hexdigest(self):
+        return '%d:%032x' % (self.count, self.total)
+
+
+def parse_tags(field, value):
+    """
+    Convert tags read from a table to a dict (empty tags are allowed by full_clean())
+    """
+    return {} if value in ('', None) else field.to_python(value)
+
+
+def import_incremental(zip_ref, fnames, new_objects, report, batch_size=DEFAULT_BATCH_SIZE, dataset_slugs=None,
+                       rollups=None):
+    """
+    Incrementally import mudata tables. Metadata is inserted as with import_bulk(), and the tags
+    of existing objects are updated in tables whose hash has changed (metadata is never deleted).
+    Data is synchronised one series at a time, so that an interrupted import leaves each series
+    either in its old or its new state; series that are no longer in data.csv are deleted from
+    the datasets in the archive. If dataset_slugs is not None, only these datasets are imported.
+    The rollups of changed series are updated using rollups (a mudata.rollups.RollupRanges).
+    """
+    datasets, locations, params = import_metadata(zip_ref, fnames, new_objects, report,
+                                                  sync=MetadataSync(report), dataset_slugs=dataset_slugs)
+    with report.stage('data.csv') as stats:
+        sync_data(zip_ref, fnames['data.csv'], datasets, locations, params, report, batch_size, dataset_slugs,
+                  rollups=rollups)
+        stats.rows = report.rows
+
+
+class MetadataSync:
+    """
+    The sync callback for import_metadata(): compares the hash of each dataset's rows in a table
+    with the stored hash, updating the tags of existing objects if it has changed
+    """
+
+    def __init__(self, report):
+        self.report = report
+
+    def __call__(self, table, rows, key_fields, ids):
+        if not rows:
+            return
+        tags_field = type(rows[0][1])._meta.get_field('tags')
+
+        # the first occurrence of a key wins, as for inserted objects
+        objects = {}
+        hashes = defaultdict(MultisetHash)
+        for line_number, obj in rows:
+            key = tuple(getattr(obj, field) for field in key_fields)
+            if key in objects:
+                continue
+            try:
+                tags = parse_tags(tags_field, obj.tags)
+            except ValidationError as e:
+                raise row_error(table + '.csv', line_number, e)
+            objects[key] = tags
+            ds_id = ids[key] if table == 'datasets' else obj.dataset_id
+            hashes[ds_id].add(*[str(value) for value in key] + [json.dumps(tags, sort_keys=True)])
+        hashes = {ds_id: hash_value.hexdigest() for ds_id, hash_value in hashes.items()}
+
+        stored = dict(TableHash.objects.filter(dataset_id__in=list(hashes), table=table)
+                      .values_list('dataset_id', 'hash'))
+        changed = set(ds_id for ds_id, hash_value in hashes.items() if stored.get(ds_id) != hash_value)
+        self.report.count('tables_unchanged', len(hashes) - len(changed))
+        self.report.count('tables_changed', len(changed))
+        if not changed:
+            return
+
+        model = type(rows[0][1])
+        if table == 'datasets':
+            existing_qs = model.objects.filter(pk__in=list(changed))
+        else:
+            existing_qs = model.objects.filter(dataset_id__in=list(changed))
+        existing_tags = dict(existing_qs.values_list('pk', 'tags'))
+
+        updated = []
+        for key, tags in objects.items():
+            pk = ids[key]
+            if pk in existing_tags and tags != existing_tags[pk]:
+                model.objects.filter(pk=pk).update(tags=tags)
+                updated.append(model(pk=pk, tags=tags))
+                self.report.count('%s_updated' % table)
+        if model in TAG_MODELS:
+            # update() does not send the signal that indexes tags
+            index_tags(updated)
+        if model is Location:
+            index_points(updated)
+
+        for ds_id in changed:
+            TableHash.objects.update_or_create(dataset_id=ds_id, table=table,
+                                               defaults={'hash': hashes[ds_id]})
+
+
+def sync_data(zip_ref, member, datasets, locations, params, report, batch_size=DEFAULT_BATCH_SIZE,
+              dataset_slugs=None, max_rows=DEFAULT_SYNC_ROWS, rollups=None):
+    """
+    Synchronise the data in the datasets in the archive with data.csv. Changed series are parsed
+    and written in groups of about max_rows rows (see series_groups()), reading data.csv once per
+    group, so that memory use does not depend on the size of data.csv. An invalid row aborts the
+    import, leaving the series of earlier groups in their new state.
+    :param member: The archive member containing data.csv
+    :param datasets: A dict of dataset slug -> id
+    :param locations: A dict of (dataset id, location slug) -> id
+    :param params: A dict of (dataset id, param slug) -> id
+    :param dataset_slugs: If not None, skip rows that do not belong to these datasets
+    :param max_rows: The number of rows parsed before they are written
+    :param rollups: The RollupRanges used to update the rollups of changed series
+    """
+    # first pass: hash the raw x, value and tags of every row of each series
+    with report.stage('hash') as stats, open_member(zip_ref, member) as f:
+        slug_hashes = defaultdict(MultisetHash)
+        first_lines = {}
+        for line_number, line in read_table(f, 'data.csv', DATA_COLUMNS, dataset_slugs):
+            slugs = (line[0], line[1], line[2])
+            if slugs not in first_lines:
+                first_lines[slugs] = line_number
+            slug_hashes[slugs].add(line[3], line[4], line[5])
+            stats.rows += 1
+
+    series_slugs = {}
+    hashes = {}
+    for slugs, hash_value in slug_hashes.items():
+        try:
+            ds_id = datasets[slugs[0]]
+            series = (ds_id, locations[ds_id, slugs[1]], params[ds_id, slugs[2]])
+        except KeyError:
+            raise ValueError('Unknown dataset, location, or param in "data.csv" on line %s' % first_lines[slugs])
+        series_slugs[series] = slugs
+        hashes[series] = hash_value.hexdigest()
+
+    series_hashes = dataset_hashes(hashes)
+    with report.stage('validate'):
+        stored, existing_series, stored_dataset_hashes = stored_hashes(list(datasets.values()), hashes,
+                                                                       series_hashes)
+
+    changed = [series for series, hash_value in hashes.items() if stored.get(series) != hash_value]
+    removed = [series for series in existing_series if series not in hashes]
+    report.count('series_unchanged', len(hashes) - len(changed))
+    report.count('series_changed', len(changed))
+    report.count('series_removed', len(removed))
+
+    if rollups is None:
+        rollups = RollupRanges()
+    counts = {series: slug_hashes[series_slugs[series]].count for series in changed}
+    for group in series_groups(changed, counts, max_rows):
+        # further passes: parse and validate the rows of a group of changed series, then write them
+        new_rows = {series: {} for series in group}
+        group_slugs = set(series_slugs[series] for series in group)
+        with report.stage('parse') as stats, open_member(zip_ref, member) as f:
+            lines = ((line_number, line) for line_number, line in read_table(f, 'data.csv', DATA_COLUMNS)
+                     if (line[0], line[1], line[2]) in group_slugs)
+            for line_number, row in parse_data(lines, datasets, locations, params):
+                series_rows = new_rows[row[:3]]
+                if row[3] in series_rows:
+                    raise duplicate_error(line_number)
+                series_rows[row[3]] = row
+                stats.rows += 1
+
+        for series in group:
+            with report.stage('write'), write_transaction():
+                sync_series(series, new_rows.pop(series), series in existing_series, report, batch_size, rollups)
+                SeriesHash.objects.update_or_create(dataset_id=series[0], location_id=series[1],
+                                                    param_id=series[2], defaults={'hash': hashes[series]})
+                rollups.update()
+
+    for series in removed:
+        with report.stage('write'), write_transaction():
+            deleted, _ = series_data(series).delete()
+            SeriesHash.objects.filter(dataset_id=series[0], location_id=series[1], param_id=series[2]).delete()
+            report.count('rows_deleted', deleted)
+            rollups.add(series)
+            rollups.update()
+
+    # the 'data' hash also records that every series in the dataset has a SeriesHash
+    stale = [ds_id for ds_id in datasets.values() if stored_dataset_hashes.get(ds_id) != series_hashes[ds_id]]
+    if stale:
+        with write_transaction():
+            for ds_id in stale:
+                TableHash.objects.update_or_create(dataset_id=ds_id, table='data',
+                                                   defaults={'hash': series_hashes[ds_id]})
+
+
+def series_groups(series, counts, max_rows=DEFAULT_SYNC_ROWS):
+    """
+    Split series into consecutive groups of at most max_rows rows in total (a series with more
+    rows than this is a group of its own)
+    :param counts: A dict of series -> number of rows
+    :return: A generator of lists of series
+    """
+    group = []
+    n_rows = 0
+    for item in series:
+        if group and n_rows + counts[item] > max_rows:
+            yield group
+            group = []
+            n_rows = 0
+        group.append(item)
+        n_rows += counts[item]
+    if group:
+        yield group
+
+
+def dataset_hashes(hashes):
+    """
+    Hash the series hashes of each dataset
+    :param hashes: A dict of (dataset_id, location_id, param_id) -> hash
+    :return: A defaultdict of dataset_id -> hash (datasets without series have the hash of no rows)
+    """
+    totals = defaultdict(MultisetHash)
+    for (ds_id, location_id, param_id), hash_value in hashes.items():
+        totals[ds_id].add(str(location_id), str(param_id), hash_value)
+    empty = MultisetHash().hexdigest()
+    return defaultdict(lambda: empty, ((ds_id, total.hexdigest()) for ds_id, total in totals.items()))
+
+
+def stored_hashes(dataset_ids, hashes, series_hashes):
+    """
+    Load the stored hashes of the series in the given datasets
+    :param hashes: A dict of (dataset_id, location_id, param_id) -> hash for the series in data.csv
+    :param series_hashes: The dataset_hashes() of hashes
+    :return: A (stored, existing_series, stored_dataset_hashes) tuple: a dict of series -> stored
+      hash, the set of series that may have data in the database and a dict of dataset_id -> stored
+      'data' hash
+    """
+    stored_dataset_hashes = dict(TableHash.objects.filter(dataset_id__in=list(dataset_ids), table='data')
+                                 .values_list('dataset_id', 'hash'))
+
+    stored = {}
+    existing_series = set()
+    for ds_id in dataset_ids:
+        if ds_id not in stored_dataset_hashes:
+            # data written by a non-incremental import: every series that has data is compared
+            # row by row
+            existing_series.update(Datum.objects.filter(dataset_id=ds_id)
+                                   .values_list('dataset_id', 'location_id', 'param_id').distinct())
+        elif stored_dataset_hashes[ds_id] == series_hashes[ds_id]:
+            # nothing in the dataset has changed
+            for series, hash_value in hashes.items():
+                if series[0] == ds_id:
+                    stored[series] = hash_value
+                    existing_series.add(series)
+        else:
+            for location_id, param_id, hash_value in (SeriesHash.objects.filter(dataset_id=ds_id)
+                                                      .values_list('location_id', 'param_id', 'hash')):
+                stored[ds_id, location_id, param_id] = hash_value
+                existing_series.add((ds_id, location_id, param_id))
+    return stored, existing_series, stored_dataset_hashes
+
+
+def series_data(series):
+    ds_id, location_id, param_id = series
+    return Datum.objects.filter(dataset_id=ds_id, location_id=location_id, param_id=param_id)
+
+
+def sync_series(series, rows, has_data, report, batch_size=DEFAULT_BATCH_SIZE, rollups=None):
+    """
+    Insert, update or delete the rows of one series so that it matches rows
+    :param rows: A dict of x -> (dataset_id, location_id, param_id, x, datetime, value, tags),
+      as returned by parse_data()
+    :param has_data: False if the series is known to have no data in the database
+    :param rollups: A RollupRanges that the range of changed x values is added to
+    """
+    deleted_ids = []
+    changed_x = []
+    insert = []
+    if has_data:
+        existing = {x: (pk, value, tags) for pk, x, value, tags in
+                    series_data(series).values_list('pk', 'x', 'value', 'tags')}
+    else:
+        existing = {}
+
+    tags_field = Datum._meta.get_field('tags')
+    for x, row in rows.items():
+        if x not in existing:
+            insert.append(row)
+            changed_x.append(x)
+            report.count('rows_inserted')
+            continue
+        pk, value, tags = existing.pop(x)
+        # tags are only decoded if their text differs
+        if row[5] == value and (row[6] == tags.json or parse_tags(tags_field, row[6]) == tags):
+            report.count('rows_unchanged')
+        else:
+            # changed rows are replaced, so that they can be written in batches
+            deleted_ids.append(pk)
+            insert.append(row)
+            changed_x.append(x)
+            report.count('rows_updated')
+
+    # rows with x values that are no longer in the series
+    deleted_ids.extend(pk for pk, value, tags in existing.values())
+    changed_x.extend(existing)
+    report.count('rows_deleted', len(existing))
+    if rollups is not None and changed_x:
+        rollups.add(series, min(changed_x), max(changed_x))
+
+    for start in range(0, len(deleted_ids), DELETE_BATCH_SIZE):
+        Datum.objects.filter(pk__in=deleted_ids[start:start + DELETE_BATCH_SIZE]).delete()
+
+    insert = iter(insert)
+    while True:
+        batch = list(itertools.islice(insert, batch_size))
+        if not batch:
+            break
+        insert_data(prepare_data(batch))
+        report.rows_written(len(batch))
@@ -0,0 +1,126 @@
+"""
+Timings, throughput and query counts for long-running operations such as import_mudata()
+"""
+
+import contextlib
+import time
+from collections import OrderedDict
+
+# the default number of data rows between calls to a progress callback
+DEFAULT_PROGRESS_EVERY = 100000
+
+
+class QueryCounter:
+    """
+    A database execute_wrapper() that counts queries without storing them (unlike
+    CaptureQueriesContext, which keeps the SQL for every bulk insert in memory)
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class StageStats:
+    """
+    Wall time, rows processed and queries executed for one stage of an import
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = 0
+        self.queries = 0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else None
+
+    def as_dict(self):
+        return {'stage': self.name, 'seconds': self.seconds, 'rows': self.rows, 'queries': self.queries,
+                'rows_per_sec': self.rows_per_sec}
+
+    def __repr__(self):
+        return '<StageStats %s: %s rows in %.3fs, %s queries>' % (self.name, self.rows, self.seconds, self.queries)
+
+
+class ImportReport:
+    """
+    Collects per-stage statistics for an import and calls a progress callback as data rows
+    are written. Stages are 'extract' (opening the archive), one stage per table (e.g.,
+    'datasets.csv'), and, within 'data.csv', 'parse' (reading, parsing and validating fields),
+    'validate' (checking for duplicate keys) and 'write'. Stages that run more than once
+    (e.g., once per batch) accumulate.
+    """
+
+    def __init__(self, progress=None, progress_every=DEFAULT_PROGRESS_EVERY):
+        """
+        :param progress: A callable, called with this report after every progress_every rows
+          of data.csv are written (checked after each write, so batches are never split)
+        :param progress_every: The number of data rows between calls to progress
+        """
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+        self.queries = QueryCounter()
+        self.rows = 0
+        self.progress = progress
+        self.progress_every = progress_every
+        self.start = time.perf_counter()
+        self.end = None
+        self._next_progress = progress_every
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        """
+        Time a block of code, adding the time, rows and query count to the named stage
+        """
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(name)
+
+        queries = self.queries.count
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            stats.queries += self.queries.count - queries
+            stats.rows += rows
+
+    def rows_written(self, rows):
+        """
+        Record that rows of data.csv were written, calling the progress callback if needed
+        """
+        self.rows += rows
+        if self.progress is not None and self.rows >= self._next_progress:
+            self.progress(self)
+            self._next_progress = (self.rows // self.progress_every + 1) * self.progress_every
+
+    def count(self, name, n=1):
+        """
+        Add n to a named counter (e.g., the number of rows inserted or skipped)
+        """
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def rows_per_sec(self):
+        seconds = self.seconds
+        return self.rows / seconds if seconds else None
+
+    def as_dict(self):
+        return {'seconds': self.seconds, 'rows': self.rows, 'rows_per_sec': self.rows_per_sec,
+                'queries': self.queries.count, 'counts': dict(self.counts),
+                'stages': [stats.as_dict() for stats in self.stages.values()]}
+
+    def __repr__(self):
+        return '<ImportReport: %s rows in %.3fs, %s queries>' % (self.rows, self.seconds, self.queries.count)
@@ -1,231 +1,1429 @@
-
 import zipfile
-import tempfile
+import gzip
+import io
 import os
+import posixpath
 import csv
 import contextlib
-from django.core.exceptions import ObjectDoesNotExist
+import itertools
+import json
+from django.db import connection, models, transaction
+from django.utils import timezone
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+
+from .datetime_parse import datetime_parse, datetime_numeric, datetime_parse_array, datetime_numeric_array
+from .models import Dataset, Location, Param, Column, Datum, TableHash, SeriesHash, LazyTags, numeric_value
+from .pipeline import parse_data_pipelined
+from .instrumentation import ImportReport, DEFAULT_PROGRESS_EVERY
+from .slugs import slug_cache
+from .spatial import index_points
+from .tagindex import index_tags
+
+# engines understood by import_mudata()
+IMPORT_ENGINES = ('row', 'bulk', 'pipelined', 'columnar')
+
+# policies for rows of data.csv whose (dataset, location, param, x) is already in the database
+CONFLICT_POLICIES = ('error', 'skip', 'replace')
+
+# number of rows buffered before each write by the 'bulk', 'pipelined' and 'columnar' engines
+# (these are split into as many queries as the database backend requires)
+DEFAULT_BATCH_SIZE = 2000
+
+# number of rows fetched per query (and written between yields of stream_mudata()) when exporting
+DEFAULT_EXPORT_CHUNK_SIZE = 2000
+
+# the text formats of stream_data()
+QUERY_FORMATS = ('json', 'ndjson', 'csv')
+
+# required columns for each table, in the order they are read
+DATASETS_COLUMNS = ('dataset', 'tags')
+LOCATIONS_COLUMNS = ('dataset', 'location', 'tags')
+PARAMS_COLUMNS = ('dataset', 'param', 'tags')
+COLUMNS_COLUMNS = ('dataset', 'table', 'column', 'tags')
+DATA_COLUMNS = ('dataset', 'location', 'param', 'x', 'value', 'tags')
+
+# the tables that make up a mudata archive
+TABLE_FILES = ('datasets.csv', 'locations.csv', 'params.csv', 'columns.csv', 'data.csv')
 
-from .datetime_parse import datetime_parse, datetime_numeric
-from .models import Dataset, Location, Param, Column, Datum
+
+@contextlib.contextmanager
+def write_transaction():
+    """
+    A transaction.atomic() block that takes the database write lock as soon as it starts. SQLite
+    starts transactions as readers, and a reader that writes after another connection has
+    committed fails immediately with "database is locked" rather than waiting for the lock, which
+    happens when several processes import into the same database (see mudata.parallel).
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                # a write that changes nothing
+                cursor.execute('UPDATE %s SET id = id WHERE 1 = 0' % connection.ops.quote_name(Dataset._meta.db_table))
+        yield
 
 
 @contextlib.contextmanager
-def import_context():
+def import_context(new_objects, checkpoint=None):
+    """
+    Delete the objects in new_objects (and, by cascade, any data that refers to them) if the
+    import is aborted, including by KeyboardInterrupt
+    :param new_objects: A list that the import appends metadata objects to as they are created
+    :param checkpoint: An ImportCheckpoint, cleared if any objects are deleted
+    """
+    from .drop import delete_dataset_rows
+
     try:
         yield
-    except Exception as e:
-        # if an exception was raised, undo the addition of objects
-        raise e
+    except BaseException:
+        # if an exception was raised, undo the addition of objects. If the database raised the
+        # exception inside an enclosing transaction, that transaction will be rolled back anyway
+        if new_objects and not transaction.get_connection().needs_rollback:
+            # new datasets (and everything in them) are deleted one table at a time rather than
+            # through the cascade collector, which loads every row that refers to them
+            dataset_ids = [obj.pk for obj in new_objects if isinstance(obj, Dataset) and obj.pk is not None]
+            with write_transaction():
+                for ds_id in dataset_ids:
+                    delete_dataset_rows(ds_id, {})
+                for obj in reversed(new_objects):
+                    if obj.pk is not None and not isinstance(obj, Dataset) and obj.dataset_id not in dataset_ids:
+                        type(obj).objects.filter(pk=obj.pk).delete()
+            slug_cache.invalidate(dataset_ids)
+            if checkpoint is not None:
+                checkpoint.clear()
+        raise
+
+
+class ImportCheckpoint:
+    """
+    Persists the last committed line of data.csv to a JSON file so that an import can be
+    resumed after a crash. The checkpoint is only used if it was written for the same
+    data.csv (compared using the member name, size and CRC recorded in the archive).
+    """
+
+    def __init__(self, path, zip_file):
+        self.path = path
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            member = find_members(zip_ref).get('data.csv')
+            info = zip_ref.getinfo(member) if member else None
+        self.identity = {'member': member, 'size': info and info.file_size, 'crc': info and info.CRC}
+
+    @property
+    def line(self):
+        """
+        The last committed line of data.csv, or 0 if there is no (matching) checkpoint
+        """
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if state.get('identity') != self.identity:
+            return 0
+        return state['line']
+
+    def save(self, line_number):
+        # write then rename so that a crash never leaves a partial checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'identity': self.identity, 'line': line_number}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ChunkedTransaction:
+    """
+    Commits data.csv writes in transactions of (at least) commit_every rows, saving a checkpoint
+    after each commit. With commit_every=None, writes are not wrapped in a transaction. The
+    rollups of the rows recorded in rollups (a mudata.rollups.RollupRanges) are updated before
+    each commit.
+    """
+
+    def __init__(self, commit_every=None, checkpoint=None, rollups=None):
+        self.commit_every = commit_every
+        self.checkpoint = checkpoint
+        self.rollups = rollups
+        self.rows = 0
+        self.last_line_number = None
+        self.atomic = None
+
+    def begin(self):
+        if self.commit_every is not None:
+            self.atomic = transaction.atomic()
+            self.atomic.__enter__()
+
+    def commit(self):
+        if self.rollups is not None:
+            with write_transaction():
+                self.rollups.update()
+        if self.atomic is not None:
+            self.atomic.__exit__(None, None, None)
+            self.atomic = None
+        if self.checkpoint is not None and self.last_line_number is not None:
+            self.checkpoint.save(self.last_line_number)
+        self.rows = 0
+
+    def written(self, rows, last_line_number):
+        """
+        Record that rows (ending at last_line_number) were written, committing if needed
+        """
+        self.rows += rows
+        self.last_line_number = last_line_number
+        if self.commit_every is not None and self.rows >= self.commit_every:
+            self.commit()
+            self.begin()
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        elif self.atomic is not None:
+            self.atomic.__exit__(exc_type, exc_value, traceback)
+            self.atomic = None
+        elif self.rollups and not connection.needs_rollback:
+            # rows written before the error were committed
+            with write_transaction():
+                self.rollups.update()
+        return False
 
 
 def missing_columns(header_line, required_columns):
     return [col_name for col_name in required_columns if col_name not in header_line]
 
 
-def import_mudata(zip_file):
+def read_table(f, fname, required_columns, dataset_slugs=None):
+    """
+    Check the header of a mudata csv file and return an iterator of (line_number, line) for
+    each non-empty line, where line_number is the line number in the original file
+    :param f: An open (text) file
+    :param fname: The file name to use in error messages
+    :param required_columns: The columns that must be present in the header
+    :param dataset_slugs: If not None, skip lines whose dataset (the first required column) is not
+      in this collection
+    """
+    reader = csv.reader(f)
+    header = next(reader)
+    check_header(header, fname, required_columns)
+    lines = read_rows(reader, fname, len(required_columns))
+    if dataset_slugs is not None:
+        return ((line_number, line) for line_number, line in lines if line[0] in dataset_slugs)
+    return lines
+
+
+def check_header(header, fname, required_columns):
+    missing_cols = missing_columns(header, required_columns)
+    if missing_cols:
+        raise ValueError('"%s" is missing column(s): %s' % (fname, ', '.join(missing_cols)))
+
+
+def read_rows(reader, fname, n_columns, first_line_number=2):
+    """
+    Yield (line_number, line) for each non-empty line of a csv.reader() that has already
+    consumed the header
+    :param first_line_number: The line number of the first line in reader
+    """
+    for line_number, line in enumerate(reader, first_line_number):
+        # check number of columns on each line
+        if len(line) == 0:
+            continue
+        elif len(line) != n_columns:
+            raise ValueError('Wrong number of columns in "%s" on line %s' % (fname, line_number))
+        yield line_number, line
+
+
+def row_error(fname, line_number, error):
+    """
+    Wrap a ValidationError raised while validating a row so that the message includes the
+    file and line number
+    """
+    return ValidationError('Invalid row in "%(fname)s" on line %(line)s: %(error)s',
+                           params={'fname': fname, 'line': line_number, 'error': '; '.join(error.messages)},
+                           code='invalid')
+
+
+# fields used to validate data.csv rows without constructing a Datum
+_X_FIELD = Datum._meta.get_field('x')
+_VALUE_FIELD = Datum._meta.get_field('value')
+_TAGS_FIELD = Datum._meta.get_field('tags')
+_DATETIME_FIELD = Datum._meta.get_field('datetime')
+
+
+def parse_datum(line):
+    """
+    Parse and validate a line from data.csv without touching the database
+    :param line: A (dataset, location, param, x, value, tags) list of strings
+    :return: An (x, datetime, value, tags) tuple
+    """
+    # make sure NA values are None
+    value = None if line[4] in ('', 'NA') else line[4]
+    if value is not None and len(value) > _VALUE_FIELD.max_length:
+        # raises the same error as full_clean()
+        _VALUE_FIELD.run_validators(value)
+
+    # parse x value
+    try:
+        dt = datetime_parse(line[3])
+        x = datetime_numeric(dt)
+    except ValueError:
+        dt = None
+        x = _X_FIELD.to_python(line[3])
+
+    # empty tags are allowed by full_clean(), '{}' is by far the most common value
+    tags = line[5]
+    if tags and tags != '{}':
+        _TAGS_FIELD.to_python(tags)
+
+    return x, dt, value, tags
+
+
+def import_mudata(zip_file, engine='bulk', batch_size=DEFAULT_BATCH_SIZE, workers=None, progress=None,
+                  progress_every=DEFAULT_PROGRESS_EVERY, commit_every=None, checkpoint=None, incremental=False,
+                  on_conflict='error', dataset_slugs=None, defer_rollups=False):
     """
     Import a mudata zipfile
-    :param zip_file: 
-    :param update: 
-    :return: 
+    :param zip_file: A filename or file-like object containing a mudata zip archive
+    :param engine: 'bulk' to validate rows in memory and write them using bulk_create(),
+      'pipelined' to do the same but parse and validate data.csv in worker processes,
+      'columnar' to parse and validate data.csv in chunks of columns and write them as tuples, or
+      'row' to validate and save() each object individually
+    :param batch_size: The number of rows buffered before each write by the 'bulk', 'pipelined'
+      and 'columnar' engines
+    :param workers: The number of worker processes used by the 'pipelined' engine (defaults to
+      the number of CPUs)
+    :param progress: A callable, called with the ImportReport after every progress_every rows of
+      data.csv are written
+    :param progress_every: The number of data.csv rows between calls to progress
+    :param commit_every: Commit data.csv rows in transactions of this many rows (rounded up to a
+      multiple of batch_size) rather than one transaction per write
+    :param checkpoint: An ImportCheckpoint. Lines of data.csv up to the checkpoint are skipped, the
+      checkpoint is saved after each commit and cleared once the import completes.
+    :param incremental: Treat the archive as the new version of the datasets it contains: update
+      the tags of existing metadata, skip (dataset, location, param) series whose content hash is
+      unchanged since the last incremental import and insert, update or delete only the rows
+      that differ in the others (see mudata.incremental). Not supported by the 'row' engine or
+      with commit_every or checkpoint.
+    :param on_conflict: What to do with rows of data.csv that already exist in the database: 'error'
+      to abort the import, 'skip' to keep the existing row or 'replace' to replace it. Rows are
+      loaded into a staging table and merged using set-based SQL unless on_conflict is 'error' (see
+      StagingTable). Rows that occur more than once in data.csv are always an error. Only 'error' is
+      supported by the 'row' engine, incremental imports and with commit_every or checkpoint.
+    :param dataset_slugs: If not None, import only the rows of each table that belong to these
+      datasets (used by mudata.parallel to import each dataset in a separate process). Not
+      supported by the 'row' and 'pipelined' engines.
+    :param defer_rollups: Mark the rollups of the datasets written to as stale rather than updating
+      them after each write, which is faster for large imports. Aggregate queries on these datasets
+      read the Datum table until mudata.rollups.rebuild_rollups() (or the mudata_rebuild_rollups
+      command) is run.
+    :return: An ImportReport with timings, row counts and query counts for each stage
     """
 
+    if engine not in IMPORT_ENGINES:
+        raise ValueError('Unknown import engine: %s' % engine)
+    if engine == 'row' and (commit_every is not None or checkpoint is not None):
+        raise ValueError("commit_every and checkpoint are not supported by the 'row' engine")
+    if on_conflict not in CONFLICT_POLICIES:
+        raise ValueError('Unknown conflict policy: %s' % on_conflict)
+    if on_conflict != 'error' and (engine == 'row' or incremental or commit_every is not None or
+                                   checkpoint is not None):
+        raise ValueError("on_conflict must be 'error' for the 'row' engine, incremental imports and with "
+                         "commit_every or checkpoint")
+    if dataset_slugs is not None and engine in ('row', 'pipelined'):
+        raise ValueError("dataset_slugs is not supported by the '%s' engine" % engine)
+    if incremental and (engine == 'row' or commit_every is not None or checkpoint is not None):
+        raise ValueError("incremental imports are not supported by the 'row' engine or with commit_every "
+                         "or checkpoint")
+
     # keep track of database additions so that they can be undone if import does not
     # complete
     new_objects = []
 
-    # create a tempfile, open the zip file, use import_context to cleanup objects if something goes wrong
-    with import_context(), tempfile.TemporaryDirectory() as tmp_dir, zipfile.ZipFile(zip_file, 'r') as zip_ref:
-
-        # extract the zip_file to the temporary directory
-        zip_ref.extractall(tmp_dir)
-
-        # find files
-        fnames = {}
-        for fname in ('datasets.csv', 'locations.csv', 'params.csv', 'columns.csv', 'data.csv'):
-            for root, dir, filenames in os.walk(tmp_dir):
-                if fname in filenames:
-                    fnames[fname] = os.path.join(root, fname)
-                    break
-
-        # iterate through datasets
-        if 'datasets.csv' not in fnames:
-            raise ValueError('"datasets.csv" not found in import file')
-
-        # datasets keeps reference to datasets by name for quick lookup/cleanup later
-        datasets = {}
-        with open(fnames['datasets.csv'], 'r') as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            missing_cols = missing_columns(header, ('dataset', 'tags'))
-            if missing_cols:
-                raise ValueError('"dataset.csv" is missing column(s): ' + ', '.join(missing_cols))
-            for line_number, line in enumerate(reader):
-                # check number of columns on each line
-                if len(line) == 0:
-                    continue
-                elif len(line) != 2:
-                    raise ValueError('Wrong number of columns in "dataset.csv" on line %s' % (line_number + 2))
-
-                # create dataset object
-                ds = Dataset(dataset=line[0], tags=line[1])
-
-                # check for existing dataset, make sure tags match
-                try:
-                    ds = Dataset.objects.get(dataset=ds.dataset)
-                except ObjectDoesNotExist:
-                    # validate dataset object
-                    ds.full_clean()
-                    # add to database
-                    ds.save()
-                    new_objects.append(ds)
-
-                # keep reference to the (now saved in db) dataset
-                datasets[line[0]] = ds
-
-        # iterate through locations
-        if 'locations.csv' not in fnames:
-            raise ValueError('"locations.csv" not found in import file')
-
-        locations = {}
-        with open(fnames['locations.csv'], 'r') as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            missing_cols = missing_columns(header, ('dataset', 'location', 'tags'))
-            if missing_cols:
-                raise ValueError('"location.csv" is missing column(s): ' + ', '.join(missing_cols))
-            for line_number, line in enumerate(reader):
-                # check columns on each line
-                if len(line) == 0:
-                    continue
-                elif len(line) != 3:
-                    raise ValueError('Wrong number of columns in "locations.csv" on line %s' % (line_number + 2))
-
-                # find dataset object
-                ds = datasets[line[0]]
-                # create location object
-                loc = Location(dataset=ds, location=line[1], tags=line[2])
-
-                # check for existing location, make sure tags match
-                try:
-                    loc = Location.objects.get(dataset=ds, location=loc.location)
-                except ObjectDoesNotExist:
-                    # validate location object
-                    loc.full_clean()
-                    # add to database
-                    loc.save()
-                    new_objects.append(loc)
-
-                # keep reference to the (saved in db) location
-                locations[line[0]+line[1]] = loc
-
-        # iterate through parameters
-        if 'params.csv' not in fnames:
-            raise ValueError('"params.csv" not found in import file')
-
-        params = {}
-        with open(fnames['params.csv'], 'r') as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            missing_cols = missing_columns(header, ('dataset', 'param', 'tags'))
-            if missing_cols:
-                raise ValueError('"params.csv" is missing column(s): ' + ', '.join(missing_cols))
-            for line_number, line in enumerate(reader):
-                # check columns on each line
-                if len(line) == 0:
-                    continue
-                elif len(line) != 3:
-                    raise ValueError('Wrong number of columns in "params.csv" on line %s' % (line_number + 2))
-
-                # find dataset object
-                ds = datasets[line[0]]
-                # create param object
-                param = Param(dataset=ds, param=line[1], tags=line[2])
-
-                # check for existing param, make sure tags match
-                try:
-                    param = Param.objects.get(dataset=ds, param=param.param)
-                except ObjectDoesNotExist:
-                    # validate param object
-                    param.full_clean()
-                    # add to database
-                    param.save()
-
-                # keep reference to the (saved in db) location
-                params[line[0] + line[1]] = param
-
-        # iterate through columns
-        if 'columns.csv' not in fnames:
-            raise ValueError('"columns.csv" not found in import file')
-
-        with open(fnames['columns.csv'], 'r') as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            missing_cols = missing_columns(header, ('dataset', 'table', 'column', 'tags'))
-            if missing_cols:
-                raise ValueError('"columns.csv" is missing column(s): ' + ', '.join(missing_cols))
-            for line_number, line in enumerate(reader):
-                # check columns on each line
-                if len(line) == 0:
-                    continue
-                elif len(line) != 4:
-                    raise ValueError('Wrong number of columns in "columns.csv" on line %s' % (line_number + 2))
-
-                # find dataset object
-                ds = datasets[line[0]]
-                # create column object
-                column = Column(dataset=ds, table=line[1], column=line[2], tags=line[3])
-
-                # check for existing column entry before adding
-                try:
-                    Column.objects.get(dataset=ds, table=column.table, column=column.column)
-                except ObjectDoesNotExist:
-                    # validate param object
-                    column.full_clean()
-                    # add to database
-                    column.save()
-
-        # iterate through data
-        if 'data.csv' not in fnames:
-            raise ValueError('"data.csv" not found in import file')
-
-        with open(fnames['data.csv'], 'r') as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            missing_cols = missing_columns(header, ('dataset', 'location', 'param', 'x', 'value', 'tags'))
-            if missing_cols:
-                raise ValueError('"data.csv" is missing column(s): ' + ', '.join(missing_cols))
-            for line_number, line in enumerate(reader):
-                # check columns on each line
-                if len(line) == 0:
-                    continue
-                elif len(line) != 6:
-                    raise ValueError('Wrong number of columns in "data.csv" on line %s' % (line_number + 2))
-
-                # find dataset object
-                ds = datasets[line[0]]
-                # find location object
-                location = locations[line[0]+line[1]]
-                # find param object
-                param = params[line[0]+line[2]]
-
-                # make sure NA values are None
-                value = None if line[4] in ('', 'NA') else line[4]
-
-                # parse x value
-                try:
-                    dt = datetime_parse(line[3])
-                    dt_numeric = datetime_numeric(dt)
-                    datum = Datum(dataset=ds, location=location, param=param, x=dt_numeric,
-                                  datetime=dt, value=value, tags=line[5])
-                except ValueError:
-                    datum = Datum(dataset=ds, location=location, param=param, x=line[3],
-                                  value=value, tags=line[5])
-
-                # check for existing datum, but this time fail if there is an attempt to add duplicate data
-                # this should fail on full_clean
-                datum.full_clean()
+    # imported here because mudata.rollups builds on mudata.aggregate, which builds on this module
+    from .rollups import RollupRanges
+    # the series whose rollups need to be updated
+    rollups = RollupRanges(defer=defer_rollups)
+
+    # count queries for the report
+    report = ImportReport(progress, progress_every)
+
+    # open the zip file, use import_context to cleanup objects if something goes wrong
+    with connection.execute_wrapper(report.queries), import_context(new_objects, checkpoint), \
+            contextlib.ExitStack() as stack:
+
+        with report.stage('extract'):
+            zip_ref = stack.enter_context(zipfile.ZipFile(zip_file, 'r'))
+            # find files (members are read directly from the archive rather than extracted)
+            fnames = find_members(zip_ref)
+
+        if incremental:
+            # imported here because mudata.incremental builds on this module
+            from .incremental import import_incremental
+            import_incremental(zip_ref, fnames, new_objects, report, batch_size, dataset_slugs, rollups)
+        elif engine == 'row':
+            import_rows(zip_ref, fnames, new_objects, report, rollups)
+        else:
+            transactions = ChunkedTransaction(commit_every, checkpoint, rollups)
+            resume_from = checkpoint.line if checkpoint is not None else 0
+            if engine == 'pipelined':
+                import_bulk(zip_ref, fnames, new_objects, report, transactions, batch_size, resume_from,
+                            workers=workers or os.cpu_count(), on_conflict=on_conflict)
+            else:
+                import_bulk(zip_ref, fnames, new_objects, report, transactions, batch_size, resume_from,
+                            columnar=(engine == 'columnar'), on_conflict=on_conflict, dataset_slugs=dataset_slugs)
+
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    report.finish()
+    return report
+
+
+def find_members(zip_ref):
+    """
+    Find the mudata tables in a zip archive. Tables may be in any directory and may be
+    gzip-compressed (e.g., data.csv.gz); if a table occurs more than once, the one closest
+    to the root of the archive is used.
+    :param zip_ref: An open ZipFile
+    :return: A dict of table file name (e.g., 'data.csv') -> archive member name
+    """
+    fnames = {}
+    depths = {}
+    for member in zip_ref.namelist():
+        basename = posixpath.basename(member)
+        fname = basename[:-3] if basename.endswith('.gz') else basename
+        if fname not in TABLE_FILES:
+            continue
+        depth = member.count('/')
+        if fname not in fnames or depth < depths[fname]:
+            fnames[fname] = member
+            depths[fname] = depth
+    return fnames
+
+
+@contextlib.contextmanager
+def open_member(zip_ref, member):
+    """
+    Open a zip archive member as a decoded text stream suitable for csv.reader(), decompressing
+    gzipped members on the fly
+    """
+    with zip_ref.open(member, 'r') as raw:
+        if member.endswith('.gz'):
+            raw = gzip.GzipFile(fileobj=raw, mode='rb')
+        with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as f:
+            yield f
+
+
+def import_bulk(zip_ref, fnames, new_objects, report, transactions, batch_size=DEFAULT_BATCH_SIZE, resume_from=0,
+                workers=None, columnar=False, on_conflict='error', dataset_slugs=None):
+    """
+    Import mudata tables, loading existing keys once per table, validating rows in memory
+    and writing them in batches using bulk_create(). Metadata tables are written in a single
+    transaction; data.csv rows are written in the transactions managed by transactions, skipping
+    lines up to and including resume_from. Unless on_conflict is 'error', data.csv rows are
+    instead loaded into a StagingTable and merged in a single transaction.
+    """
+
+    datasets, locations, params = import_metadata(zip_ref, fnames, new_objects, report,
+                                                  dataset_slugs=dataset_slugs)
+    # data written by this import is not reflected in the hashes used by incremental imports
+    invalidate_series_hashes(list(datasets.values()))
+
+    with report.stage('data.csv') as stats, open_member(zip_ref, fnames['data.csv']) as f, transactions:
+        if on_conflict != 'error':
+            import_data_staged(f, datasets, locations, params, report, on_conflict, batch_size, workers,
+                               columnar, dataset_slugs, transactions.rollups)
+        elif columnar:
+            import_data_columnar(f, datasets, locations, params, report, transactions, batch_size, resume_from,
+                                 dataset_slugs)
+        else:
+            import_data_bulk(f, datasets, locations, params, report, transactions, batch_size, resume_from,
+                             workers, dataset_slugs)
+        stats.rows = report.rows
+
+
+def import_metadata(zip_ref, fnames, new_objects, report, sync=None, dataset_slugs=None):
+    """
+    Import datasets.csv, locations.csv, params.csv and columns.csv in a single transaction,
+    inserting objects that do not already exist
+    :param sync: A callable, called after each table is written with the table name (e.g.,
+      'locations'), the list of (line_number, unsaved object), the key fields and the dict of
+      key tuple -> id returned by bulk_create_missing() (used by incremental imports to update
+      existing objects)
+    :param dataset_slugs: If not None, import only the rows that belong to these datasets
+    :return: A (datasets, locations, params) tuple of lookup dicts mapping dataset slug -> id,
+      (dataset id, location slug) -> id and (dataset id, param slug) -> id
+    """
+    for fname in TABLE_FILES:
+        if fname not in fnames:
+            raise ValueError('"%s" not found in import file' % fname)
+
+    with write_transaction():
+        with report.stage('datasets.csv') as stats, open_member(zip_ref, fnames['datasets.csv']) as f:
+            rows = [(line_number, Dataset(dataset=line[0], tags=line[1]))
+                    for line_number, line in read_table(f, 'datasets.csv', DATASETS_COLUMNS, dataset_slugs)]
+            slugs = [ds.dataset for line_number, ds in rows]
+            datasets = bulk_create_missing(Dataset, 'datasets.csv', rows, ('dataset', ),
+                                           Dataset.objects.filter(dataset__in=slugs), new_objects)
+            if sync is not None:
+                sync('datasets', rows, ('dataset', ), datasets)
+            stats.rows = len(rows)
+        # datasets maps slug -> id for quick lookup later
+        datasets = {slug: ds_id for (slug, ), ds_id in datasets.items()}
+        dataset_ids = list(datasets.values())
+
+        def dataset_id(fname, line_number, slug):
+            try:
+                return datasets[slug]
+            except KeyError:
+                raise ValueError('Unknown dataset "%s" in "%s" on line %s' % (slug, fname, line_number))
+
+        with report.stage('locations.csv') as stats, open_member(zip_ref, fnames['locations.csv']) as f:
+            rows = [(line_number, Location(dataset_id=dataset_id('locations.csv', line_number, line[0]),
+                                           location=line[1], tags=line[2]))
+                    for line_number, line in read_table(f, 'locations.csv', LOCATIONS_COLUMNS, dataset_slugs)]
+            created = len(new_objects)
+            locations = bulk_create_missing(Location, 'locations.csv', rows, ('dataset_id', 'location'),
+                                            Location.objects.filter(dataset_id__in=dataset_ids), new_objects)
+            # bulk_create() does not send the signal that indexes tags and coordinates
+            index_tags(new_objects[created:])
+            index_points(new_objects[created:])
+            if sync is not None:
+                sync('locations', rows, ('dataset_id', 'location'), locations)
+            stats.rows = len(rows)
+
+        with report.stage('params.csv') as stats, open_member(zip_ref, fnames['params.csv']) as f:
+            rows = [(line_number, Param(dataset_id=dataset_id('params.csv', line_number, line[0]),
+                                        param=line[1], tags=line[2]))
+                    for line_number, line in read_table(f, 'params.csv', PARAMS_COLUMNS, dataset_slugs)]
+            created = len(new_objects)
+            params = bulk_create_missing(Param, 'params.csv', rows, ('dataset_id', 'param'),
+                                         Param.objects.filter(dataset_id__in=dataset_ids), new_objects)
+            index_tags(new_objects[created:])
+            if sync is not None:
+                sync('params', rows, ('dataset_id', 'param'), params)
+            stats.rows = len(rows)
+
+        with report.stage('columns.csv') as stats, open_member(zip_ref, fnames['columns.csv']) as f:
+            rows = [(line_number, Column(dataset_id=dataset_id('columns.csv', line_number, line[0]),
+                                         table=line[1], column=line[2], tags=line[3]))
+                    for line_number, line in read_table(f, 'columns.csv', COLUMNS_COLUMNS, dataset_slugs)]
+            columns = bulk_create_missing(Column, 'columns.csv', rows, ('dataset_id', 'table', 'column'),
+                                          Column.objects.filter(dataset_id__in=dataset_ids), new_objects)
+            if sync is not None:
+                sync('columns', rows, ('dataset_id', 'table', 'column'), columns)
+            stats.rows = len(rows)
+
+    # bulk_create() does not send the signals that keep the slug cache up to date
+    slug_cache.invalidate(dataset_ids)
+    return datasets, locations, params
+
+
+def invalidate_series_hashes(dataset_ids, series=None):
+    """
+    Remove the hashes that incremental imports use to skip unchanged data, for data that was
+    written without updating them
+    :param series: If not None, only the hashes of these (dataset_id, location_id, param_id) series
+      (and the 'data' hashes of their datasets) are removed
+    """
+    if series is None:
+        SeriesHash.objects.filter(dataset_id__in=dataset_ids).delete()
+    else:
+        for ds_id, location_id, param_id in series:
+            SeriesHash.objects.filter(dataset_id=ds_id, location_id=location_id, param_id=param_id).delete()
+    TableHash.objects.filter(dataset_id__in=dataset_ids, table='data').delete()
+
+
+def bulk_create_missing(model, fname, rows, key_fields, existing_qs, new_objects):
+    """
+    Validate and bulk_create() the objects in rows whose key is not already in existing_qs. As
+    with the 'row' engine, the first occurrence of a key wins and existing objects are left alone.
+    :param rows: A list of (line_number, unsaved object)
+    :return: A dict of key tuple -> id for all objects in existing_qs after the insert
+    """
+    existing = set(existing_qs.values_list(*key_fields))
+    # the dataset foreign key was resolved from the lookup table and does not need to be checked
+    exclude = [] if model is Dataset else ['dataset']
+
+    objects = []
+    for line_number, obj in rows:
+        key = tuple(getattr(obj, field) for field in key_fields)
+        if key in existing:
+            continue
+        existing.add(key)
+        try:
+            obj.full_clean(exclude=exclude, validate_unique=False)
+        except ValidationError as e:
+            raise row_error(fname, line_number, e)
+        objects.append(obj)
+
+    model.objects.bulk_create(objects)
+
+    # not all backends set the primary key on bulk_create(), so look the ids up again
+    ids = {tuple(values[:-1]): values[-1] for values in existing_qs.values_list(*key_fields, 'id')}
+    for obj in objects:
+        obj.pk = ids[tuple(getattr(obj, field) for field in key_fields)]
+    new_objects.extend(objects)
+    return ids
+
+
+def import_data_bulk(f, datasets, locations, params, report, transactions, batch_size=DEFAULT_BATCH_SIZE,
+                     resume_from=0, workers=None, dataset_slugs=None):
+    """
+    Validate the rows in data.csv in memory and write them using bulk_create()
+    :param f: An open data.csv file
+    :param datasets: A dict of dataset slug -> id
+    :param locations: A dict of (dataset id, location slug) -> id
+    :param params: A dict of (dataset id, param slug) -> id
+    :param report: The ImportReport for the import
+    :param transactions: The ChunkedTransaction that writes are made in
+    :param resume_from: Skip lines up to and including this line number
+    :param workers: If not None, parse and validate rows in this many worker processes
+      (see mudata.pipeline)
+    :param dataset_slugs: If not None, skip rows that do not belong to these datasets (not supported
+      with workers)
+    """
+    if workers is None:
+        lines = skip_lines(read_table(f, 'data.csv', DATA_COLUMNS, dataset_slugs), resume_from)
+        rows = parse_data(lines, datasets, locations, params)
+    else:
+        rows = parse_data_pipelined(f, datasets, locations, params, workers=workers, chunk_size=batch_size,
+                                    resume_from=resume_from)
+
+    write_data(rows, list(datasets.values()), report, transactions, batch_size)
+
+
+def skip_lines(lines, resume_from):
+    """
+    Skip (line_number, line) items up to and including line number resume_from
+    """
+    if resume_from:
+        return itertools.dropwhile(lambda item: item[0] <= resume_from, lines)
+    return lines
+
+
+def parse_data(lines, datasets, locations, params):
+    """
+    Resolve and validate lines from data.csv without touching the database
+    :param lines: An iterator of (line_number, line), as returned by read_table()
+    :return: A generator of (line_number, (dataset_id, location_id, param_id, x, datetime, value, tags))
+    """
+    for line_number, line in lines:
+        try:
+            ds_id = datasets[line[0]]
+            location_id = locations[ds_id, line[1]]
+            param_id = params[ds_id, line[2]]
+        except KeyError:
+            raise ValueError('Unknown dataset, location, or param in "data.csv" on line %s' % line_number)
+
+        try:
+            x, dt, value, tags = parse_datum(line)
+        except ValidationError as e:
+            raise row_error('data.csv', line_number, e)
+
+        yield line_number, (ds_id, location_id, param_id, x, dt, value, tags)
+
+
+def existing_data_keys(dataset_ids):
+    """
+    Load the (dataset_id, location_id, param_id, x) keys of all data in the given datasets, so
+    that uniqueness can be checked once instead of by one query per row
+    """
+    return set(Datum.objects.filter(dataset_id__in=dataset_ids)
+               .values_list('dataset_id', 'location_id', 'param_id', 'x'))
+
+
+def duplicate_error(line_number):
+    return row_error('data.csv', line_number,
+                     ValidationError('Datum with this Dataset, Location, Param and X already exists.'))
+
+
+def write_data(rows, dataset_ids, report, transactions, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Check parsed data.csv rows for duplicate keys and write them using bulk_create()
+    :param rows: An iterator of (line_number, row) as returned by parse_data()
+    :param dataset_ids: The datasets that rows may refer to
+    :param report: The ImportReport for the import
+    :param transactions: The ChunkedTransaction that writes are made in
+    """
+    with report.stage('validate'):
+        existing = existing_data_keys(dataset_ids)
+
+    rows = iter(rows)
+    while True:
+        # rows are parsed as they are pulled from the iterator
+        with report.stage('parse') as stats:
+            batch = list(itertools.islice(rows, batch_size))
+            stats.rows += len(batch)
+        if not batch:
+            break
+
+        with report.stage('validate', rows=len(batch)):
+            objects = []
+            for line_number, (ds_id, location_id, param_id, x, dt, value, tags) in batch:
+                # fail if there is an attempt to add duplicate data
+                key = (ds_id, location_id, param_id, x)
+                if key in existing:
+                    raise duplicate_error(line_number)
+                existing.add(key)
+
+                objects.append(Datum(dataset_id=ds_id, location_id=location_id, param_id=param_id, x=x,
+                                     datetime=dt, value=value, value_num=numeric_value(value), tags=tags))
+
+        with report.stage('write', rows=len(objects)):
+            Datum.objects.bulk_create(objects)
+            if transactions.rollups is not None:
+                transactions.rollups.add_rows(row for line_number, row in batch)
+            transactions.written(len(objects), batch[-1][0])
+        report.rows_written(len(objects))
+
+
+def import_data_columnar(f, datasets, locations, params, report, transactions, batch_size=DEFAULT_BATCH_SIZE,
+                         resume_from=0, dataset_slugs=None):
+    """
+    Read data.csv in chunks of batch_size rows, parse and validate each chunk as columns and
+    write it as tuples using insert_data()
+    :param f: An open data.csv file
+    :param datasets: A dict of dataset slug -> id
+    :param locations: A dict of (dataset id, location slug) -> id
+    :param params: A dict of (dataset id, param slug) -> id
+    :param report: The ImportReport for the import
+    :param transactions: The ChunkedTransaction that writes are made in
+    :param resume_from: Skip lines up to and including this line number
+    :param dataset_slugs: If not None, skip rows that do not belong to these datasets
+    """
+    with report.stage('validate'):
+        existing = existing_data_keys(list(datasets.values()))
+
+    lines = skip_lines(read_table(f, 'data.csv', DATA_COLUMNS, dataset_slugs), resume_from)
+    while True:
+        with report.stage('parse') as stats:
+            chunk = list(itertools.islice(lines, batch_size))
+            if chunk:
+                line_numbers, chunk = zip(*chunk)
+                rows = parse_data_columns(line_numbers, list(zip(*chunk)), datasets, locations, params)
+                stats.rows += len(rows)
+        if not chunk:
+            break
+
+        with report.stage('validate', rows=len(rows)):
+            # fail if there is an attempt to add duplicate data
+            keys = [row[:4] for row in rows]
+            if len(set(keys)) != len(keys) or not existing.isdisjoint(keys):
+                for line_number, key in zip(line_numbers, keys):
+                    if key in existing:
+                        raise duplicate_error(line_number)
+                    existing.add(key)
+            existing.update(keys)
+
+        with report.stage('write', rows=len(rows)):
+            insert_data(rows)
+            if transactions.rollups is not None:
+                transactions.rollups.add_rows(rows)
+            transactions.written(len(rows), line_numbers[-1])
+        report.rows_written(len(rows))
+
+
+def parse_data_columns(line_numbers, columns, datasets, locations, params):
+    """
+    Resolve and validate a chunk of data.csv without touching the database
+    :param line_numbers: The line number of each row in the chunk
+    :param columns: The (dataset, location, param, x, value, tags) columns of the chunk
+    :return: A list of (dataset_id, location_id, param_id, x, datetime, value, tags) tuples with values
+      prepared for the database
+    """
+    dataset_col, location_col, param_col, x_col, value_col, tags_col = columns
+
+    # the error for the first invalid row, if any
+    errors = []
+
+    # map slugs to ids, where None marks a slug that could not be found
+    dataset_ids = list(map(datasets.get, dataset_col))
+    location_ids = list(map(locations.get, zip(dataset_ids, location_col)))
+    param_ids = list(map(params.get, zip(dataset_ids, param_col)))
+    for ids in (location_ids, param_ids):
+        if None in ids:
+            i = ids.index(None)
+            errors.append((i, ValueError('Unknown dataset, location, or param in "data.csv" on line %s' %
+                                         line_numbers[i])))
+
+    # parse x values as datetimes, then as numbers where that fails
+    dts = datetime_parse_array(x_col)
+    xs = datetime_numeric_array(dts)
+    for i, x in enumerate(xs):
+        if x is None:
+            try:
+                xs[i] = _X_FIELD.to_python(x_col[i])
+            except ValidationError as e:
+                errors.append((i, row_error('data.csv', line_numbers[i], e)))
+                break
+
+    # make sure NA values are None
+    values = [None if value == '' or value == 'NA' else value for value in value_col]
+    for i, value in enumerate(values):
+        if value is not None and len(value) > _VALUE_FIELD.max_length:
+            try:
+                _VALUE_FIELD.run_validators(value)
+            except ValidationError as e:
+                errors.append((i, row_error('data.csv', line_numbers[i], e)))
+                break
+
+    # empty tags are allowed by full_clean(), '{}' is by far the most common value
+    for i, tags in enumerate(tags_col):
+        if tags and tags != '{}':
+            try:
+                _TAGS_FIELD.to_python(tags)
+            except ValidationError as e:
+                errors.append((i, row_error('data.csv', line_numbers[i], e)))
+                break
+
+    if errors:
+        raise min(errors, key=lambda error: error[0])[1]
+
+    dts = [None if dt is None else _DATETIME_FIELD.get_db_prep_save(dt, connection) for dt in dts]
+    return list(zip(dataset_ids, location_ids, param_ids, xs, dts, values, tags_col))
+
+
+# the Datum fields written by insert_data(), in order
+DATUM_INSERT_FIELDS = [Datum._meta.get_field(name) for name in ('dataset', 'location', 'param', 'x', 'datetime',
+                                                                 'value', 'tags', 'value_num')]
+
+
+def insert_data(rows):
+    """
+    Insert rows of (dataset_id, location_id, param_id, x, datetime, value, tags) tuples into the
+    Datum table using multi-row INSERT statements, without creating model instances. Values must
+    already be prepared for the database.
+    """
+    insert_rows(Datum._meta.db_table, DATUM_INSERT_FIELDS, with_value_num(rows))
+
+
+def with_value_num(rows):
+    """
+    Append the Datum.value_num of each (dataset_id, location_id, param_id, x, datetime, value, tags) row
+    """
+    return [tuple(row) + (numeric_value(row[5]), ) for row in rows]
+
+
+def insert_rows(table, fields, rows):
+    """
+    Insert rows of tuples into a table using multi-row INSERT statements
+    :param fields: The field for each value in a row, whose column names are used
+    """
+    if not rows:
+        return
+
+    qn = connection.ops.quote_name
+    insert_sql = 'INSERT INTO %s (%s) ' % (qn(table), ', '.join(qn(field.column) for field in fields))
+    batch_size = max(connection.ops.bulk_batch_size(fields, rows), 1)
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            placeholder_rows = [['%s'] * len(fields)] * len(batch)
+            cursor.execute(insert_sql + connection.ops.bulk_insert_sql(fields, placeholder_rows),
+                           [value for row in batch for value in row])
+
+
+def import_data_staged(f, datasets, locations, params, report, on_conflict, batch_size=DEFAULT_BATCH_SIZE,
+                       workers=None, columnar=False, dataset_slugs=None, rollups=None):
+    """
+    Load data.csv into a StagingTable and merge it into the Datum table, skipping or replacing rows
+    that already exist. Inserted, skipped and replaced rows are counted in the report.
+    :param on_conflict: 'skip' or 'replace'
+    :param workers: If not None, parse and validate rows in this many worker processes
+    :param columnar: Parse and validate rows as columns (see import_data_columnar())
+    :param dataset_slugs: If not None, skip rows that do not belong to these datasets
+    :param rollups: A RollupRanges, whose series are updated in the merge transaction
+    """
+    with StagingTable() as staging:
+        for line_numbers, rows in parse_batches(f, datasets, locations, params, report, batch_size, workers,
+                                                columnar, dataset_slugs):
+            with report.stage('write', rows=len(rows)):
+                staging.insert(line_numbers, rows)
+            report.rows_written(len(rows))
+
+        with report.stage('validate'):
+            line_number = staging.first_duplicate()
+            if line_number is not None:
+                raise duplicate_error(line_number)
+
+        with report.stage('merge'), write_transaction():
+            inserted, conflicts = staging.merge(on_conflict)
+            if rollups is not None:
+                for ds_id, location_id, param_id, x_min, x_max in staging.series_ranges():
+                    rollups.add((ds_id, location_id, param_id), x_min, x_max)
+                rollups.update()
+
+    report.count('rows_inserted', inserted)
+    report.count('rows_skipped' if on_conflict == 'skip' else 'rows_replaced', conflicts)
+
+
+def parse_batches(f, datasets, locations, params, report, batch_size=DEFAULT_BATCH_SIZE, workers=None,
+                  columnar=False, dataset_slugs=None):
+    """
+    Read, resolve and validate data.csv in batches of batch_size rows
+    :return: A generator of (line_numbers, rows), where rows are prepared for insert_data()
+    """
+    if columnar:
+        lines = read_table(f, 'data.csv', DATA_COLUMNS, dataset_slugs)
+        while True:
+            with report.stage('parse') as stats:
+                chunk = list(itertools.islice(lines, batch_size))
+                if chunk:
+                    line_numbers, chunk = zip(*chunk)
+                    rows = parse_data_columns(line_numbers, list(zip(*chunk)), datasets, locations, params)
+                    stats.rows += len(rows)
+            if not chunk:
+                break
+            yield line_numbers, rows
+    else:
+        if workers is None:
+            parsed = parse_data(read_table(f, 'data.csv', DATA_COLUMNS, dataset_slugs), datasets, locations,
+                                params)
+        else:
+            parsed = parse_data_pipelined(f, datasets, locations, params, workers=workers, chunk_size=batch_size)
+        while True:
+            with report.stage('parse') as stats:
+                batch = list(itertools.islice(parsed, batch_size))
+                stats.rows += len(batch)
+            if not batch:
+                break
+            line_numbers, rows = zip(*batch)
+            yield line_numbers, prepare_data(rows)
+
+
+class StagingTable:
+    """
+    A temporary table with the columns of Datum plus the line number of each row, that data.csv
+    is bulk-loaded into so that conflicts with existing data can be resolved using a few set-based
+    queries (standard SQL that both SQLite and PostgreSQL support) rather than a check per row.
+    The table is dropped when the context manager exits.
+    """
+
+    name = 'mudata_datum_staging'
+
+    # the columns that identify a Datum
+    key_columns = ('dataset_id', 'location_id', 'param_id', 'x')
+
+    def __init__(self):
+        line_field = models.IntegerField()
+        line_field.set_attributes_from_name('line')
+        self.fields = [line_field] + DATUM_INSERT_FIELDS
+        self.rows = 0
+
+    def execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def __enter__(self):
+        qn = connection.ops.quote_name
+        self.execute('CREATE TEMPORARY TABLE %s (%s)' % (
+            qn(self.name), ', '.join('%s %s' % (qn(field.column), field.db_type(connection))
+                                     for field in self.fields)
+        ))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.execute('DROP TABLE %s' % connection.ops.quote_name(self.name))
+
+    def insert(self, line_numbers, rows):
+        """
+        Load (dataset_id, location_id, param_id, x, datetime, value, tags) rows prepared for the
+        database, as returned by parse_data_columns()
+        """
+        insert_rows(self.name, self.fields, [(line_number, ) + row
+                                             for line_number, row in zip(line_numbers, with_value_num(rows))])
+        self.rows += len(rows)
+
+    def key_match(self, a, b):
+        qn = connection.ops.quote_name
+        return ' AND '.join('%s.%s = %s.%s' % (a, qn(column), b, qn(column)) for column in self.key_columns)
+
+    def first_duplicate(self):
+        """
+        :return: The line number of the first row whose key occurs on an earlier line, or None
+        """
+        qn = connection.ops.quote_name
+        self.execute('CREATE INDEX %s ON %s (%s)' % (
+            qn(self.name + '_key'), qn(self.name), ', '.join(qn(column) for column in self.key_columns)
+        ))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT MIN(s.%(line)s) FROM %(staging)s s WHERE EXISTS '
+                           '(SELECT 1 FROM %(staging)s t WHERE %(match)s AND t.%(line)s < s.%(line)s)' % {
+                               'line': qn('line'), 'staging': qn(self.name), 'match': self.key_match('t', 's')})
+            return cursor.fetchone()[0]
+
+    def series_ranges(self):
+        """
+        :return: A list of the (dataset_id, location_id, param_id, x_min, x_max) of each staged series
+        """
+        qn = connection.ops.quote_name
+        series = ', '.join(qn(column) for column in self.key_columns[:3])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT %s, MIN(%s), MAX(%s) FROM %s GROUP BY %s' % (
+                series, qn('x'), qn('x'), qn(self.name), series))
+            return cursor.fetchall()
+
+    def merge(self, on_conflict):
+        """
+        Insert the staged rows into the Datum table, skipping or replacing rows whose key already
+        exists (call within a transaction)
+        :param on_conflict: 'skip' or 'replace'
+        :return: An (inserted, conflicts) tuple of row counts
+        """
+        qn = connection.ops.quote_name
+        datum_table = qn(Datum._meta.db_table)
+        columns = ', '.join(qn(field.column) for field in DATUM_INSERT_FIELDS)
+        insert_sql = 'INSERT INTO %s (%s) SELECT %s FROM %s s' % (datum_table, columns, columns, qn(self.name))
+
+        if on_conflict == 'skip':
+            inserted = self.execute(insert_sql + ' WHERE NOT EXISTS (SELECT 1 FROM %s d WHERE %s)' % (
+                datum_table, self.key_match('d', 's')))
+            return inserted, self.rows - inserted
+        else:
+            replaced = self.execute('DELETE FROM %s WHERE EXISTS (SELECT 1 FROM %s s WHERE %s)' % (
+                datum_table, qn(self.name), self.key_match('s', datum_table)))
+            self.execute(insert_sql)
+            return self.rows - replaced, replaced
+
+
+def prepare_data(rows):
+    """
+    Prepare (dataset_id, location_id, param_id, x, datetime, value, tags) rows, as returned by
+    parse_data(), for insert_data()
+    """
+    prep = _DATETIME_FIELD.get_db_prep_save
+    return [(ds_id, location_id, param_id, x, None if dt is None else prep(dt, connection), value, tags)
+            for ds_id, location_id, param_id, x, dt, value, tags in rows]
+
+
+def import_rows(zip_ref, fnames, new_objects, report, rollups=None):
+    """
+    Import mudata tables, validating and saving each object individually
+    :param rollups: A RollupRanges, whose series are updated once data.csv has been written
+    """
+
+    # iterate through datasets
+    if 'datasets.csv' not in fnames:
+        raise ValueError('"datasets.csv" not found in import file')
+
+    # datasets keeps reference to datasets by name for quick lookup/cleanup later
+    datasets = {}
+    with report.stage('datasets.csv') as stats, open_member(zip_ref, fnames['datasets.csv']) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing_cols = missing_columns(header, ('dataset', 'tags'))
+        if missing_cols:
+            raise ValueError('"dataset.csv" is missing column(s): ' + ', '.join(missing_cols))
+        for line_number, line in enumerate(reader):
+            # check number of columns on each line
+            if len(line) == 0:
+                continue
+            elif len(line) != 2:
+                raise ValueError('Wrong number of columns in "dataset.csv" on line %s' % (line_number + 2))
+            stats.rows += 1
+
+            # create dataset object
+            ds = Dataset(dataset=line[0], tags=line[1])
+
+            # check for existing dataset, make sure tags match
+            try:
+                ds = Dataset.objects.get(dataset=ds.dataset)
+            except ObjectDoesNotExist:
+                # validate dataset object
+                ds.full_clean()
+                # add to database
+                ds.save()
+                new_objects.append(ds)
+
+            # keep reference to the (now saved in db) dataset
+            datasets[line[0]] = ds
+
+    # iterate through locations
+    if 'locations.csv' not in fnames:
+        raise ValueError('"locations.csv" not found in import file')
+
+    locations = {}
+    with report.stage('locations.csv') as stats, open_member(zip_ref, fnames['locations.csv']) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing_cols = missing_columns(header, ('dataset', 'location', 'tags'))
+        if missing_cols:
+            raise ValueError('"location.csv" is missing column(s): ' + ', '.join(missing_cols))
+        for line_number, line in enumerate(reader):
+            # check columns on each line
+            if len(line) == 0:
+                continue
+            elif len(line) != 3:
+                raise ValueError('Wrong number of columns in "locations.csv" on line %s' % (line_number + 2))
+            stats.rows += 1
+
+            # find dataset object
+            ds = datasets[line[0]]
+            # create location object
+            loc = Location(dataset=ds, location=line[1], tags=line[2])
+
+            # check for existing location, make sure tags match
+            try:
+                loc = Location.objects.get(dataset=ds, location=loc.location)
+            except ObjectDoesNotExist:
+                # validate location object
+                loc.full_clean()
                 # add to database
-                datum.save()
+                loc.save()
+                new_objects.append(loc)
+
+            # keep reference to the (saved in db) location
+            locations[line[0]+line[1]] = loc
 
+    # iterate through parameters
+    if 'params.csv' not in fnames:
+        raise ValueError('"params.csv" not found in import file')
+
+    params = {}
+    with report.stage('params.csv') as stats, open_member(zip_ref, fnames['params.csv']) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing_cols = missing_columns(header, ('dataset', 'param', 'tags'))
+        if missing_cols:
+            raise ValueError('"params.csv" is missing column(s): ' + ', '.join(missing_cols))
+        for line_number, line in enumerate(reader):
+            # check columns on each line
+            if len(line) == 0:
+                continue
+            elif len(line) != 3:
+                raise ValueError('Wrong number of columns in "params.csv" on line %s' % (line_number + 2))
+            stats.rows += 1
+
+            # find dataset object
+            ds = datasets[line[0]]
+            # create param object
+            param = Param(dataset=ds, param=line[1], tags=line[2])
+
+            # check for existing param, make sure tags match
+            try:
+                param = Param.objects.get(dataset=ds, param=param.param)
+            except ObjectDoesNotExist:
+                # validate param object
+                param.full_clean()
+                # add to database
+                param.save()
+                new_objects.append(param)
+
+            # keep reference to the (saved in db) location
+            params[line[0] + line[1]] = param
+
+    # iterate through columns
+    if 'columns.csv' not in fnames:
+        raise ValueError('"columns.csv" not found in import file')
+
+    with report.stage('columns.csv') as stats, open_member(zip_ref, fnames['columns.csv']) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing_cols = missing_columns(header, ('dataset', 'table', 'column', 'tags'))
+        if missing_cols:
+            raise ValueError('"columns.csv" is missing column(s): ' + ', '.join(missing_cols))
+        for line_number, line in enumerate(reader):
+            # check columns on each line
+            if len(line) == 0:
+                continue
+            elif len(line) != 4:
+                raise ValueError('Wrong number of columns in "columns.csv" on line %s' % (line_number + 2))
+            stats.rows += 1
+
+            # find dataset object
+            ds = datasets[line[0]]
+            # create column object
+            column = Column(dataset=ds, table=line[1], column=line[2], tags=line[3])
+
+            # check for existing column entry before adding
+            try:
+                Column.objects.get(dataset=ds, table=column.table, column=column.column)
+            except ObjectDoesNotExist:
+                # validate param object
+                column.full_clean()
+                # add to database
+                column.save()
+                new_objects.append(column)
+
+    # iterate through data
+    if 'data.csv' not in fnames:
+        raise ValueError('"data.csv" not found in import file')
+
+    # data written by this import is not reflected in the hashes used by incremental imports
+    invalidate_series_hashes([ds.pk for ds in datasets.values()])
+
+    with report.stage('data.csv') as stats, open_member(zip_ref, fnames['data.csv']) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        missing_cols = missing_columns(header, ('dataset', 'location', 'param', 'x', 'value', 'tags'))
+        if missing_cols:
+            raise ValueError('"data.csv" is missing column(s): ' + ', '.join(missing_cols))
+        for line_number, line in enumerate(reader):
+            # check columns on each line
+            if len(line) == 0:
+                continue
+            elif len(line) != 6:
+                raise ValueError('Wrong number of columns in "data.csv" on line %s' % (line_number + 2))
+            stats.rows += 1
+
+            # find dataset object
+            ds = datasets[line[0]]
+            # find location object
+            location = locations[line[0]+line[1]]
+            # find param object
+            param = params[line[0]+line[2]]
+
+            # make sure NA values are None
+            value = None if line[4] in ('', 'NA') else line[4]
+
+            # parse x value
+            try:
+                dt = datetime_parse(line[3])
+                dt_numeric = datetime_numeric(dt)
+                datum = Datum(dataset=ds, location=location, param=param, x=dt_numeric,
+                              datetime=dt, value=value, tags=line[5])
+            except ValueError:
+                datum = Datum(dataset=ds, location=location, param=param, x=line[3],
+                              value=value, tags=line[5])
+
+            # check for existing datum, but this time fail if there is an attempt to add duplicate data
+            # this should fail on full_clean
+            datum.full_clean()
+            # add to database
+            datum.save()
+            report.rows_written(1)
+            if rollups is not None:
+                rollups.add((ds.pk, location.pk, param.pk), datum.x, datum.x)
+
+    if rollups is not None:
+        with write_transaction():
+            rollups.update()
+
+
+class ZipStream:
+    """
+    A write-only, unseekable file that collects the bytes written by a ZipFile so that they
+    can be streamed (ZipFile writes data descriptors instead of seeking back to headers)
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def format_tags(tags):
+    # tags loaded from the database are written as they were stored, without being decoded
+    if isinstance(tags, LazyTags):
+        return tags.json
+    return json.dumps(tags) if isinstance(tags, dict) else tags
+
+
+def dump_json(obj):
+    """
+    json.dumps() a dict for the json and ndjson formats, copying the text of LazyTags values into
+    the output rather than decoding and re-encoding them
+    """
+    values = {}
+    raw = []
+    for key, value in obj.items():
+        if isinstance(value, LazyTags):
+            text = value.json
+            # ndjson needs each object on one line
+            if '\n' not in text and '\r' not in text:
+                raw.append('%s: %s' % (json.dumps(key), text))
+                continue
+            value = value.tags
+        values[key] = value
+    text = json.dumps(values)
+    if not raw:
+        return text
+    return text[:-1] + (', ' if values else '') + ', '.join(raw) + '}'
+
+
+def format_x(x, dt):
+    """
+    Format an x value for data.csv. Datetimes are written in the current time zone with their
+    utc offset (so that the two times in the hour that is repeated when daylight saving time ends
+    are distinct) and with fractional seconds if they have any, so that x and datetime round-trip.
+    """
+    if dt is None:
+        return repr(x)
+    text_format = '%Y-%m-%d %H:%M:%S.%f' if dt.microsecond else '%Y-%m-%d %H:%M:%S'
+    if timezone.is_aware(dt):
+        return timezone.localtime(dt).strftime(text_format + ' %z')
+    return dt.strftime(text_format)
+
+
+# the Datum fields (with the slugs joined from the metadata tables) that are exported for each row
+DATA_EXPORT_FIELDS = ('dataset__dataset', 'location__location', 'param__param', 'x', 'datetime', 'value', 'tags')
+
+# the order that data is exported in (this is unique, so it can also be used to page through data)
+DATA_ORDERING = ('dataset_id', 'location_id', 'param_id', 'x', 'id')
+
+# the order that data selected only by a range of x are queried in, which the index on x can serve
+# (ordering these by DATA_ORDERING walks the whole unique index instead)
+DATA_X_ORDERING = ('x', 'dataset_id', 'location_id', 'param_id', 'id')
+
+
+def format_data_row(row):
+    """
+    Format a row of DATA_EXPORT_FIELDS as a row of data.csv
+    """
+    ds, location, param, x, dt, value, tags = row
+    return ds, location, param, format_x(x, dt), 'NA' if value is None else value, format_tags(tags)
+
+
+def export_tables(datasets=None, data=None, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    The tables of a mudata archive as (file name, header, rows) tuples, where rows are generated
+    from server-side cursors as the tables are written
+    :param datasets: A Dataset QuerySet. If data is None, all metadata and data in these datasets
+      are exported.
+    :param data: A Datum QuerySet. If datasets is None, only the datasets, locations and params
+      that data refers to are exported.
+    """
+    if datasets is None and data is None:
+        raise ValueError('One of datasets or data must be specified')
+
+    if data is None:
+        data = Datum.objects.filter(dataset__in=datasets)
+        locations = Location.objects.filter(dataset__in=datasets)
+        params = Param.objects.filter(dataset__in=datasets)
+    else:
+        if datasets is None:
+            datasets = Dataset.objects.filter(id__in=data.values('dataset_id'))
+        locations = Location.objects.filter(id__in=data.values('location_id'))
+        params = Param.objects.filter(id__in=data.values('param_id'))
+    columns = Column.objects.filter(dataset__in=datasets)
+
+    def rows(qs, fields, formatters=None):
+        for row in qs.values_list(*fields).iterator(chunk_size=chunk_size):
+            yield [format_tags(value) for value in row] if formatters is None else formatters(row)
+
+    data = data.order_by(*DATA_ORDERING)
+    return (
+        ('datasets.csv', DATASETS_COLUMNS, rows(datasets.order_by('id'), ('dataset', 'tags'))),
+        ('locations.csv', LOCATIONS_COLUMNS, rows(locations.order_by('id'), ('dataset__dataset', 'location', 'tags'))),
+        ('params.csv', PARAMS_COLUMNS, rows(params.order_by('id'), ('dataset__dataset', 'param', 'tags'))),
+        ('columns.csv', COLUMNS_COLUMNS, rows(columns.order_by('id'), ('dataset__dataset', 'table', 'column', 'tags'))),
+        ('data.csv', DATA_COLUMNS, rows(data, DATA_EXPORT_FIELDS, format_data_row)),
+    )
+
+
+def stream_mudata(datasets=None, data=None, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Generate a mudata zip archive as chunks of bytes, using memory that does not depend on the
+    size of the export (e.g., for a StreamingHttpResponse)
+    :param datasets: A Dataset QuerySet (see export_tables())
+    :param data: A Datum QuerySet (see export_tables())
+    :param chunk_size: The number of rows fetched per query and written between chunks
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for fname, header, rows in export_tables(datasets, data, chunk_size):
+            with zip_ref.open(fname, 'w', force_zip64=True) as raw, \
+                    io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                for i, row in enumerate(rows, 1):
+                    writer.writerow(row)
+                    if i % chunk_size == 0:
+                        f.flush()
+                        yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
+
+
+def stream_data(data, format, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE, ordering=DATA_ORDERING):
+    """
+    Generate the rows of a Datum QuerySet as chunks of text, fetching chunk_size rows per query
+    from a server-side cursor so that memory use does not depend on the number of rows
+    :param data: A Datum QuerySet
+    :param format: One of QUERY_FORMATS: 'json' (an array of objects), 'ndjson' (one object per
+      line) or 'csv' (in the format of data.csv)
+    :param ordering: DATA_ORDERING or DATA_X_ORDERING
+    """
+    rows = data.order_by(*ordering).values_list(*DATA_EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+    return encode_data(rows, format, chunk_size)
+
+
+def encode_data(rows, format, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Encode rows of DATA_EXPORT_FIELDS as chunks of text of chunk_size rows (see stream_data())
+    """
+    def data_object(row):
+        ds, location, param, x, dt, value, tags = row
+        return {'dataset': ds, 'location': location, 'param': param, 'x': x,
+                'datetime': None if dt is None else dt.isoformat(), 'value': value, 'tags': tags}
+
+    return encode_rows(rows, format, DATA_COLUMNS, format_data_row, data_object, chunk_size)
+
+
+def encode_rows(rows, format, header, csv_row, json_object, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Encode rows as chunks of text of chunk_size rows
+    :param format: One of QUERY_FORMATS
+    :param header: The header of the csv format
+    :param csv_row: A function that formats a row for csv.writer()
+    :param json_object: A function that converts a row to a dict for the json and ndjson formats
+    """
+    if format not in QUERY_FORMATS:
+        raise ValueError("format must be one of %s" % ', '.join(QUERY_FORMATS))
+
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    return encode_chunks(chunks, format, header, csv_row, json_object)
+
+
+def encode_chunks(chunks, format, header, csv_row, json_object):
+    # a separate generator so that encode_rows() checks the format when it is called
+    if format == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        for chunk in chunks:
+            writer.writerows(csv_row(row) for row in chunk)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    elif format == 'ndjson':
+        for chunk in chunks:
+            yield ''.join(dump_json(json_object(row)) + '\n' for row in chunk)
+    else:
+        separator = '['
+        for chunk in chunks:
+            yield separator + ','.join(dump_json(json_object(row)) for row in chunk)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+
+def export_mudata(zip_file, datasets=None, data=None, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Export a mudata zipfile that can be read by import_mudata()
+    :param zip_file: A filename or writable file-like object
+    :param datasets: A Dataset QuerySet (see export_tables())
+    :param data: A Datum QuerySet (see export_tables())
+    """
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(zip_file, 'wb')) if isinstance(zip_file, str) else zip_file
+        for chunk in stream_mudata(datasets, data, chunk_size):
+            f.write(chunk)
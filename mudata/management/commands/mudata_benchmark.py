@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mudata.benchmarks import benchmark_synthetic
+from mudata.io import IMPORT_ENGINES
+from mudata.synthetic import X_TYPES
+
+
+class Command(BaseCommand):
+    help = 'Benchmark import_mudata(), views.query() and the view pages against generated mudata archives. ' \
+           'Benchmarks run in a separate test database, and results are written as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                            help='Number of data.csv rows for each run (e.g., 10000 1000000 10000000)')
+        parser.add_argument('--engine', choices=IMPORT_ENGINES, nargs='+', default=['bulk'],
+                            help='Import engine(s) to benchmark')
+        parser.add_argument('--rollups', choices=('update', 'defer'), nargs='+', default=['update'],
+                            help="Update rollups during each import, or defer them and benchmark rebuilding them "
+                                 "afterwards (e.g., --rollups update defer to compare the two)")
+        parser.add_argument('--x-type', choices=X_TYPES, default='datetime')
+        parser.add_argument('--datasets', type=int, default=1, help='Number of datasets')
+        parser.add_argument('--locations', type=int, default=5, help='Number of locations per dataset')
+        parser.add_argument('--params', type=int, default=5, help='Number of params per dataset')
+        parser.add_argument('--tag-size', type=int, default=0, help='Number of tags on each row of data.csv')
+        parser.add_argument('--tmp-dir', default=None, help='Directory for generated archives')
+        parser.add_argument('--output', default=None, help='Write results to this file instead of stdout')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            results = []
+            for n_rows in options['rows']:
+                for engine in options['engine']:
+                    for rollups in options['rollups']:
+                        results.extend(benchmark_synthetic(
+                            n_rows, engine=engine, x_type=options['x_type'], tmp_dir=options['tmp_dir'],
+                            defer_rollups=(rollups == 'defer'), n_datasets=options['datasets'],
+                            n_locations=options['locations'], n_params=options['params'],
+                            tag_size=options['tag_size']
+                        ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps({'vendor': connection.vendor, 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
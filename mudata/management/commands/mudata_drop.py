@@ -0,0 +1,47 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from mudata.drop import drop_dataset, replace_dataset
+from mudata.io import DEFAULT_BATCH_SIZE
+from mudata.models import Dataset
+
+
+class Command(BaseCommand):
+    help = 'Delete datasets and everything that belongs to them using one DELETE statement per table, in ' \
+           'a single transaction. With --replace, the dataset is replaced by its contents in a mudata ' \
+           'archive in the same transaction, so that readers see the old dataset until the new one is ' \
+           'complete.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='+', help='The datasets to drop')
+        parser.add_argument('--replace', metavar='ZIP_FILE', default=None,
+                            help='Import the dataset from this archive (only one dataset can be replaced)')
+        parser.add_argument('--engine', choices=('bulk', 'columnar'), default='bulk',
+                            help='The import engine used by --replace')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Number of rows per write')
+
+    def handle(self, *args, **options):
+        try:
+            if options['replace'] is not None:
+                if len(options['datasets']) != 1:
+                    raise CommandError('--replace can only be used with one dataset')
+                counts, report = replace_dataset(options['datasets'][0], options['replace'],
+                                                 engine=options['engine'], batch_size=options['batch_size'])
+            else:
+                counts = drop_dataset(*options['datasets'])
+                report = None
+        except Dataset.DoesNotExist as e:
+            raise CommandError(str(e))
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
+
+        for label, count in counts.items():
+            self.stdout.write('%-20s %12s rows deleted' % (label, count))
+        if report is None:
+            self.stdout.write(self.style.SUCCESS('Dropped %s' % ', '.join(options['datasets'])))
+        else:
+            self.stdout.write(self.style.SUCCESS('Replaced %s with %s rows in %.1fs' %
+                                                 (options['datasets'][0], report.rows, report.seconds)))
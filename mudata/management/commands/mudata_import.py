@@ -0,0 +1,78 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from mudata.instrumentation import DEFAULT_PROGRESS_EVERY
+from mudata.io import import_mudata, ImportCheckpoint, IMPORT_ENGINES, CONFLICT_POLICIES, DEFAULT_BATCH_SIZE
+from mudata.parallel import archive_datasets, lock_datasets
+
+# the default number of data.csv rows per transaction
+DEFAULT_COMMIT_EVERY = 100000
+
+
+class Command(BaseCommand):
+    help = 'Import a mudata zip archive. Data is committed in transactions of --commit-every rows, and ' \
+           'the last committed line is kept in a checkpoint file so that an interrupted import can be ' \
+           'resumed by running the same command again. If the import fails, metadata created by the ' \
+           'run (and any data that refers to it) is removed. The archive\'s datasets are locked for the ' \
+           'duration of the import, so that it waits for (and blocks) mudata_import_parallel and other ' \
+           'mudata_import runs that use the same lock directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('zip_file', help='The mudata archive to import')
+        parser.add_argument('--engine', choices=[engine for engine in IMPORT_ENGINES if engine != 'row'],
+                            default='bulk')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Number of rows per write')
+        parser.add_argument('--commit-every', type=int, default=DEFAULT_COMMIT_EVERY,
+                            help='Number of data.csv rows per transaction')
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of worker processes for the 'pipelined' engine")
+        parser.add_argument('--checkpoint', default=None,
+                            help='Checkpoint file (defaults to ZIP_FILE.checkpoint)')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint and import all of data.csv')
+        parser.add_argument('--on-conflict', choices=CONFLICT_POLICIES, default='error',
+                            help='What to do with rows of data.csv that already exist')
+        parser.add_argument('--defer-rollups', action='store_true',
+                            help='Mark rollups as stale instead of updating them (run mudata_rebuild_rollups '
+                                 'afterwards)')
+        parser.add_argument('--lock-dir', default=None, help='Directory for dataset lock files')
+        parser.add_argument('--progress-every', type=int, default=DEFAULT_PROGRESS_EVERY,
+                            help='Number of data.csv rows between progress messages')
+
+    def handle(self, *args, **options):
+        if options['on_conflict'] == 'error':
+            commit_every = options['commit_every']
+            checkpoint = ImportCheckpoint(options['checkpoint'] or options['zip_file'] + '.checkpoint',
+                                          options['zip_file'])
+            if options['restart']:
+                checkpoint.clear()
+            elif checkpoint.line:
+                self.stdout.write('Resuming after line %s of data.csv' % checkpoint.line)
+        else:
+            # staged rows are merged in one transaction, so there is nothing to resume
+            commit_every = None
+            checkpoint = None
+
+        def progress(report):
+            self.stdout.write('%s rows (%.0f rows/sec)' % (report.rows, report.rows_per_sec or 0))
+
+        try:
+            with lock_datasets(archive_datasets(options['zip_file']), options['lock_dir']):
+                report = import_mudata(options['zip_file'], engine=options['engine'],
+                                       batch_size=options['batch_size'], workers=options['workers'],
+                                       progress=progress, progress_every=options['progress_every'],
+                                       commit_every=commit_every, checkpoint=checkpoint,
+                                       on_conflict=options['on_conflict'], defer_rollups=options['defer_rollups'])
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
+
+        for stats in report.stages.values():
+            self.stdout.write('%-14s %10.3fs %12s rows %8s queries' % (stats.name, stats.seconds, stats.rows,
+                                                                        stats.queries))
+        for name, count in report.counts.items():
+            self.stdout.write('%-14s %10s' % (name, count))
+        self.stdout.write(self.style.SUCCESS('Imported %s rows in %.1fs (%.0f rows/sec)' %
+                                             (report.rows, report.seconds, report.rows_per_sec or 0)))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mudata.io import IMPORT_ENGINES, CONFLICT_POLICIES, DEFAULT_BATCH_SIZE
+from mudata.parallel import import_parallel
+
+
+class Command(BaseCommand):
+    help = 'Import mudata zip archives in parallel. Each dataset in each archive is imported by a separate ' \
+           'worker process; imports into the same dataset are serialised using a lock file per dataset, so ' \
+           'several copies of this command (or mudata_import) can run at once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('zip_files', nargs='+', help='The mudata archives to import')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (defaults to the number of CPUs)')
+        parser.add_argument('--engine', choices=[engine for engine in IMPORT_ENGINES
+                                                 if engine not in ('row', 'pipelined')], default='bulk')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Number of rows per write')
+        parser.add_argument('--on-conflict', choices=CONFLICT_POLICIES, default='error',
+                            help='What to do with rows of data.csv that already exist')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only write series that have changed since the last incremental import')
+        parser.add_argument('--defer-rollups', action='store_true',
+                            help='Mark rollups as stale instead of updating them (run mudata_rebuild_rollups '
+                                 'afterwards)')
+        parser.add_argument('--lock-dir', default=None, help='Directory for dataset lock files')
+
+    def handle(self, *args, **options):
+        try:
+            results = import_parallel(options['zip_files'], workers=options['workers'], lock_dir=options['lock_dir'],
+                                      engine=options['engine'], batch_size=options['batch_size'],
+                                      on_conflict=options['on_conflict'], incremental=options['incremental'],
+                                      defer_rollups=options['defer_rollups'])
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
+
+        errors = 0
+        for result in results:
+            if 'error' in result:
+                errors += 1
+                self.stderr.write('%s [%s]: %s' % (result['zip_file'], result['dataset'], result['error']))
+            else:
+                report = result['report']
+                self.stdout.write('%s [%s]: %s rows in %.1fs (waited %.1fs for lock)' % (
+                    result['zip_file'], result['dataset'], report['rows'], report['seconds'], result['lock_seconds']
+                ))
+        if errors:
+            raise CommandError('%s of %s imports failed' % (errors, len(results)))
+        self.stdout.write(self.style.SUCCESS('Imported %s datasets' % len(results)))
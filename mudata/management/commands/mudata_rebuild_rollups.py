@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mudata.models import Dataset
+from mudata.rollups import rebuild_rollups, stale_datasets
+
+
+class Command(BaseCommand):
+    help = 'Recompute the hourly, daily and monthly rollups that aggregate queries are answered from. ' \
+           'Rollups are kept up to date by imports unless they are run with --defer-rollups, so this is only ' \
+           'needed after such imports or if data was changed by other means.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='*', help='The datasets to rebuild (defaults to all datasets)')
+        parser.add_argument('--stale', action='store_true',
+                            help='Only rebuild datasets whose rollups were deferred by an import')
+
+    def handle(self, *args, **options):
+        datasets = dict(Dataset.objects.values_list('dataset', 'id'))
+        if options['stale']:
+            if options['datasets']:
+                raise CommandError('--stale cannot be used with a list of datasets')
+            dataset_ids = stale_datasets()
+        elif options['datasets']:
+            missing = [slug for slug in options['datasets'] if slug not in datasets]
+            if missing:
+                raise CommandError('Unknown dataset(s): %s' % ', '.join(missing))
+            dataset_ids = [datasets[slug] for slug in options['datasets']]
+        else:
+            dataset_ids = sorted(datasets.values())
+
+        rebuild_rollups(dataset_ids)
+        self.stdout.write(self.style.SUCCESS('Rebuilt the rollups of %s datasets' % len(dataset_ids)))
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(choices=[('datasets', 'datasets'), ('locations', 'locations'), ('params', 'params'), ('data', 'data'), ('columns', 'columns')], max_length=200)),
+                ('hash', models.CharField(max_length=64)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mudata.Dataset')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SeriesHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mudata.Dataset')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mudata.Location')),
+                ('param', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mudata.Param')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tablehash',
+            unique_together=set([('dataset', 'table')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='serieshash',
+            unique_together=set([('dataset', 'location', 'param')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0002_series_hashes'),
+    ]
+
+    operations = [
+        # the new indexes are created before the foreign key indexes that they replace are dropped
+        migrations.AddIndex(
+            model_name='datum',
+            index=models.Index(fields=['location', 'param', 'x'], name='mudata_datum_location_param_x'),
+        ),
+        migrations.AddIndex(
+            model_name='datum',
+            index=models.Index(fields=['param', 'x'], name='mudata_datum_param_x'),
+        ),
+        migrations.AddIndex(
+            model_name='datum',
+            index=models.Index(fields=['x'], name='mudata_datum_x'),
+        ),
+        migrations.AlterField(
+            model_name='datum',
+            name='dataset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mudata.Dataset'),
+        ),
+        migrations.AlterField(
+            model_name='datum',
+            name='location',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mudata.Location'),
+        ),
+        migrations.AlterField(
+            model_name='datum',
+            name='param',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mudata.Param'),
+        ),
+    ]
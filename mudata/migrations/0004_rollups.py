@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0003_datum_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('h', 'hourly'), ('D', 'daily'), ('M', 'monthly')], max_length=1)),
+                ('period', models.FloatField()),
+                ('n', models.IntegerField()),
+                ('total', models.FloatField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mudata.Dataset')),
+                ('location', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mudata.Location')),
+                ('param', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mudata.Param')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rollup',
+            index=models.Index(fields=['param', 'resolution', 'period'], name='mudata_rollup_param_period'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rollup',
+            unique_together=set([('location', 'param', 'resolution', 'period')]),
+        ),
+        # rollups of existing data are built once numeric values are available (see 0005_datum_value_num)
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, Max, Min, Sum
+from django.db.models.functions import Cast, ExtractMonth, ExtractYear, Floor
+from django.utils import timezone
+
+# mudata.models.NUMERIC_VALUE_RE when this migration was written
+NUMERIC_VALUE_RE = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'
+
+
+def fill_value_num(apps, schema_editor):
+    Datum = apps.get_model('mudata', 'Datum')
+    Datum.objects.filter(value__regex=NUMERIC_VALUE_RE).update(value_num=Cast('value', models.FloatField()))
+
+
+def rollup_period(resolution):
+    # a frozen copy of mudata.aggregate.Resample(resolution).bucket() for 'h', 'D' and 'M'
+    if resolution == 'M':
+        return Cast(ExtractYear('datetime'), IntegerField()) * 12 + Cast(ExtractMonth('datetime'), IntegerField()) - 1
+    width = 3600 if resolution == 'h' else 86400
+    return Floor(F('x') / width) * width
+
+
+def build_rollups(apps, schema_editor):
+    Dataset = apps.get_model('mudata', 'Dataset')
+    Datum = apps.get_model('mudata', 'Datum')
+    Rollup = apps.get_model('mudata', 'Rollup')
+
+    Rollup.objects.all().delete()
+    # monthly rollups are of months in the default time zone
+    with timezone.override(timezone.get_default_timezone()):
+        for ds_id in Dataset.objects.order_by('id').values_list('id', flat=True):
+            for resolution in ('h', 'D', 'M'):
+                data = Datum.objects.filter(dataset_id=ds_id, value_num__isnull=False)
+                if resolution == 'M':
+                    data = data.filter(datetime__isnull=False)
+                periods = data.order_by() \
+                    .annotate(period=rollup_period(resolution)) \
+                    .values('location_id', 'param_id', 'period') \
+                    .annotate(n=Count('id'), total=Sum('value_num'), minimum=Min('value_num'),
+                              maximum=Max('value_num'))
+                rows = []
+                for values in periods.iterator(chunk_size=2000):
+                    rows.append(Rollup(dataset_id=ds_id, resolution=resolution, **values))
+                    if len(rows) >= 2000:
+                        Rollup.objects.bulk_create(rows, batch_size=500)
+                        rows = []
+                Rollup.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0004_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datum',
+            name='value_num',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_value_num, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='datum',
+            index=models.Index(fields=['param', 'value_num'], name='mudata_datum_param_value'),
+        ),
+        # summarise data imported before rollups existed
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
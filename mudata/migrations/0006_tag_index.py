@@ -0,0 +1,80 @@
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# mudata.tagindex.MAX_TAG_LENGTH when this migration was written
+MAX_TAG_LENGTH = 200
+
+
+def tag_value(value):
+    # a frozen copy of mudata.tagindex.tag_value()
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return None
+    return json.dumps(value)
+
+
+def index_existing_tags(apps, schema_editor):
+    for model_name, tag_model_name, fk_name in (('Location', 'LocationTag', 'location'),
+                                                ('Param', 'ParamTag', 'param')):
+        model = apps.get_model('mudata', model_name)
+        tag_model = apps.get_model('mudata', tag_model_name)
+        rows = []
+        for pk, tags in model.objects.values_list('pk', 'tags').iterator(chunk_size=2000):
+            if isinstance(tags, str):
+                tags = json.loads(tags) if tags else {}
+            for key, value in tags.items():
+                text = tag_value(value)
+                if text is not None and len(key) <= MAX_TAG_LENGTH and len(text) <= MAX_TAG_LENGTH:
+                    rows.append(tag_model(key=key, value=text, **{fk_name + '_id': pk}))
+            if len(rows) >= 2000:
+                tag_model.objects.bulk_create(rows, batch_size=500)
+                rows = []
+        tag_model.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0005_datum_value_num'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParamTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200)),
+                ('value', models.CharField(max_length=200)),
+                ('param', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tag_index', to='mudata.Param')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LocationTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200)),
+                ('value', models.CharField(max_length=200)),
+                ('location', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tag_index', to='mudata.Location')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paramtag',
+            index=models.Index(fields=['key', 'value'], name='mudata_paramtag_key_value'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='paramtag',
+            unique_together=set([('param', 'key')]),
+        ),
+        migrations.AddIndex(
+            model_name='locationtag',
+            index=models.Index(fields=['key', 'value'], name='mudata_locationtag_key_value'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='locationtag',
+            unique_together=set([('location', 'key')]),
+        ),
+        migrations.RunPython(index_existing_tags, migrations.RunPython.noop),
+    ]
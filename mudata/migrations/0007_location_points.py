@@ -0,0 +1,68 @@
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# mudata.spatial.LATITUDE_TAGS and LONGITUDE_TAGS when this migration was written
+LATITUDE_TAGS = ('latitude', 'lat')
+LONGITUDE_TAGS = ('longitude', 'lon', 'lng')
+
+
+def coordinate(tags, keys, limit):
+    # a frozen copy of mudata.spatial.coordinate()
+    for key in keys:
+        value = tags.get(key)
+        if isinstance(value, bool):
+            continue
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if -limit <= value <= limit:
+            return value
+    return None
+
+
+def index_existing_points(apps, schema_editor):
+    Location = apps.get_model('mudata', 'Location')
+    LocationPoint = apps.get_model('mudata', 'LocationPoint')
+    rows = []
+    for pk, tags in Location.objects.values_list('pk', 'tags').iterator(chunk_size=2000):
+        if isinstance(tags, str):
+            try:
+                tags = json.loads(tags) if tags else {}
+            except ValueError:
+                continue
+        if not hasattr(tags, 'get'):
+            continue
+        latitude = coordinate(tags, LATITUDE_TAGS, 90)
+        longitude = coordinate(tags, LONGITUDE_TAGS, 180)
+        if latitude is not None and longitude is not None:
+            rows.append(LocationPoint(location_id=pk, latitude=latitude, longitude=longitude))
+        if len(rows) >= 2000:
+            LocationPoint.objects.bulk_create(rows, batch_size=500)
+            rows = []
+    LocationPoint.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0006_tag_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationPoint',
+            fields=[
+                ('location', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='point', serialize=False, to='mudata.Location')),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='locationpoint',
+            index=models.Index(fields=['latitude', 'longitude'], name='mudata_locationpoint_lat_lon'),
+        ),
+        migrations.RunPython(index_existing_points, migrations.RunPython.noop),
+    ]
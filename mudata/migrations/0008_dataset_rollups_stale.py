@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-16 23:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mudata', '0007_location_points'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='rollups_stale',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,10 +1,67 @@
 
 import json
+import re
+from collections.abc import MutableMapping
 from django.db import models
 from django import forms
 from django.core.exceptions import ValidationError
 
 
+class LazyTags(MutableMapping):
+    """
+    The tags of an object loaded from the database, as a dict that is only decoded from JSON
+    when it is first accessed. Tags that have not been accessed are saved (and exported, see
+    the json property) as the JSON text that was loaded.
+    """
+
+    __slots__ = ('_json', '_tags')
+
+    def __init__(self, text):
+        self._json = text or '{}'
+        self._tags = {} if self._json == '{}' else None
+
+    @property
+    def tags(self):
+        """
+        The decoded tags
+        """
+        if self._tags is None:
+            self._tags = json.loads(self._json)
+        return self._tags
+
+    @property
+    def decoded(self):
+        return self._tags is not None
+
+    @property
+    def json(self):
+        """
+        The tags as JSON text: the text that was loaded, unless the tags have been accessed
+        """
+        return self._json if self._tags is None else json.dumps(self._tags)
+
+    def __getitem__(self, key):
+        return self.tags[key]
+
+    def __setitem__(self, key, value):
+        self.tags[key] = value
+
+    def __delitem__(self, key):
+        del self.tags[key]
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __repr__(self):
+        return repr(self.tags)
+
+    def __str__(self):
+        return self.json
+
+
 class TagsField(models.TextField):
     """
     This custom field handles converting data from a dict to a json and back
@@ -17,15 +74,12 @@ class TagsField(models.TextField):
         super(TagsField, self).__init__(*args, **kwargs)
 
     def from_db_value(self, value, expression, connection, context):
-        if value is None:
-            return {}
-        else:
-            return json.loads(value)
+        return LazyTags(value)
 
     def to_python(self, value):
         if value is None:
             return {}
-        elif isinstance(value, dict):
+        elif isinstance(value, (dict, LazyTags)):
             return value
         elif isinstance(value, str):
             try:
@@ -40,6 +94,8 @@ class TagsField(models.TextField):
     def get_prep_value(self, value):
         if value is None:
             return '{}'
+        elif isinstance(value, LazyTags):
+            return value.json
         elif isinstance(value, dict):
             return json.dumps(value)
         elif isinstance(value, str):
@@ -65,12 +121,29 @@ class TagsField(models.TextField):
         return super(TagsField, self).formfield(**defaults)
 
 
+# values that are numbers (this matches what float() accepts, apart from whitespace, inf and nan)
+NUMERIC_VALUE_RE = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'
+
+_NUMERIC_VALUE = re.compile(NUMERIC_VALUE_RE)
+
+
+def numeric_value(value):
+    """
+    :return: value as a float if it is a number (see NUMERIC_VALUE_RE), or None
+    """
+    if value is None or _NUMERIC_VALUE.match(value) is None:
+        return None
+    return float(value)
+
+
 class Dataset(models.Model):
     """
     Datasets are a scope where the meaning of location, param, and column are consistent
     """
     dataset = models.SlugField(unique=True)
     tags = TagsField()
+    # True if data has been written without updating the dataset's rollups (see mudata.rollups)
+    rollups_stale = models.BooleanField(default=False, editable=False)
 
     def __str__(self):
         return self.dataset
@@ -129,6 +202,57 @@ class Column(models.Model):
         unique_together = ('dataset', 'table', 'column',)
 
 
+class AbstractTag(models.Model):
+    """
+    One tag of an object, with scalar values stored as text (see mudata.tagindex), so that
+    objects can be filtered by tag using an index rather than by decoding every object's tags
+    """
+    key = models.CharField(max_length=200)
+    value = models.CharField(max_length=200)
+
+    def __str__(self):
+        return '%s=%s' % (self.key, self.value)
+
+    class Meta:
+        abstract = True
+
+
+class LocationTag(AbstractTag):
+    # the location is the first column of the unique constraint
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='tag_index', db_index=False)
+
+    class Meta:
+        unique_together = ('location', 'key',)
+        indexes = [
+            models.Index(fields=['key', 'value'], name='mudata_locationtag_key_value'),
+        ]
+
+
+class LocationPoint(models.Model):
+    """
+    The coordinates of locations whose tags have a latitude and longitude (see
+    spatial.tag_point()), indexed so that locations can be selected by area
+    """
+    location = models.OneToOneField(Location, on_delete=models.CASCADE, primary_key=True, related_name='point')
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='mudata_locationpoint_lat_lon'),
+        ]
+
+
+class ParamTag(AbstractTag):
+    param = models.ForeignKey(Param, on_delete=models.CASCADE, related_name='tag_index', db_index=False)
+
+    class Meta:
+        unique_together = ('param', 'key',)
+        indexes = [
+            models.Index(fields=['key', 'value'], name='mudata_paramtag_key_value'),
+        ]
+
+
 class AbstractDatum(models.Model):
 
     class Meta:
@@ -145,17 +269,35 @@ class Datum(AbstractDatum):
     is probably worth it. Other values are stored in the DatumRaw table.
     """
 
-    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
-    location = models.ForeignKey(Location, on_delete=models.CASCADE)
-    param = models.ForeignKey(Param, on_delete=models.CASCADE)
+    # the foreign keys are not indexed on their own: each is the first column of the unique
+    # constraint or of one of the indexes below
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, db_index=False)
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, db_index=False)
+    param = models.ForeignKey(Param, on_delete=models.CASCADE, db_index=False)
     x = models.FloatField()
     datetime = models.DateTimeField(blank=True, null=True)
     value = models.CharField(max_length=200, blank=True, null=True)
+    # value as a number, or NULL if it is not one (see numeric_value()), so that values can be
+    # filtered and aggregated in the database
+    value_num = models.FloatField(blank=True, null=True, editable=False)
     tags = TagsField()
 
     class Meta:
         verbose_name_plural = "data"
         unique_together = ('dataset', 'location', 'param', 'x', )
+        # the filters used by views.query: dataset (the unique constraint), location and/or param,
+        # each optionally with an x range, and an x range across all series
+        indexes = [
+            models.Index(fields=['location', 'param', 'x'], name='mudata_datum_location_param_x'),
+            models.Index(fields=['param', 'x'], name='mudata_datum_param_x'),
+            models.Index(fields=['x'], name='mudata_datum_x'),
+            # value thresholds, e.g., param=temperature and value_num > 30
+            models.Index(fields=['param', 'value_num'], name='mudata_datum_param_value'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.value_num = numeric_value(self.value)
+        super(Datum, self).save(*args, **kwargs)
 
     def __str__(self):
         # use datetime for viewing, if available
@@ -164,3 +306,69 @@ class Datum(AbstractDatum):
         return ' / '.join(str(x) for x in [self.dataset.dataset, self.location.location, self.param.param, x_value]) + \
             ' => ' + str(self.value)
 
+
+class TableHash(models.Model):
+    """
+    The content hash of the rows of a table for one dataset, as of the last incremental import.
+    For the 'data' table, this is a hash of the dataset's SeriesHash values, and its presence
+    means that every series in the dataset has a SeriesHash.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    table = models.CharField(max_length=200, choices=(
+        ('datasets', 'datasets'), ('locations', 'locations'), ('params', 'params'),
+        ('data', 'data'), ('columns', 'columns')
+    ))
+    hash = models.CharField(max_length=64)
+
+    def __str__(self):
+        return ' / '.join(str(x) for x in (self.dataset, self.table))
+
+    class Meta:
+        unique_together = ('dataset', 'table',)
+
+
+class SeriesHash(models.Model):
+    """
+    The content hash of the data in one (dataset, location, param) series, as of the last
+    incremental import. Series whose hash has not changed are skipped by incremental imports.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    location = models.ForeignKey(Location, on_delete=models.CASCADE)
+    param = models.ForeignKey(Param, on_delete=models.CASCADE)
+    hash = models.CharField(max_length=64)
+
+    def __str__(self):
+        return ' / '.join(str(x) for x in (self.dataset, self.location.location, self.param.param))
+
+    class Meta:
+        unique_together = ('dataset', 'location', 'param',)
+
+
+class Rollup(models.Model):
+    """
+    The count, sum, minimum and maximum of the numeric values of one (dataset, location, param)
+    series over one hour, day or month. Rollups are updated whenever data is written or deleted
+    and are used to answer aggregate queries whose buckets are made of whole rollup periods
+    (see mudata.rollups).
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    # location and param are the first columns of the unique constraint and the index below
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, db_index=False)
+    param = models.ForeignKey(Param, on_delete=models.CASCADE, db_index=False)
+    resolution = models.CharField(max_length=1, choices=(('h', 'hourly'), ('D', 'daily'), ('M', 'monthly')))
+    # the x value at the start of hourly and daily periods, or months since year 0 for monthly periods
+    period = models.FloatField()
+    n = models.IntegerField()
+    total = models.FloatField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+
+    def __str__(self):
+        return ' / '.join(str(x) for x in (self.dataset, self.location.location, self.param.param,
+                                           self.resolution, self.period))
+
+    class Meta:
+        unique_together = ('location', 'param', 'resolution', 'period',)
+        indexes = [
+            models.Index(fields=['param', 'resolution', 'period'], name='mudata_rollup_param_period'),
+        ]
@@ -0,0 +1,250 @@
+"""
+Parallel import of mudata archives. Work is partitioned by dataset: archives with more than one
+dataset are split into one archive per dataset (see split_archive()), and each (archive, dataset)
+pair is imported by import_mudata(..., dataset_slugs=[dataset]) in its own worker process while
+holding a DatasetLock, so that imports into different datasets run at the same time and imports
+into the same dataset (from this process, another import_parallel() or mudata_import) are
+serialised.
+"""
+
+import contextlib
+import csv
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import django
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.validators import slug_re
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (not available on windows)
+    fcntl = None
+
+# the directory that lock files are created in, unless another is given
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'mudata-locks')
+
+
+class DatasetLock:
+    """
+    An exclusive lock on a dataset, shared by all processes on this machine that use the same
+    lock directory. The lock is held using flock() on a file named after the dataset, so it is
+    released when the holding process exits, even if it crashes.
+    """
+
+    def __init__(self, dataset, lock_dir=None):
+        """
+        :param dataset: The dataset slug
+        :param lock_dir: The directory for lock files (defaults to DEFAULT_LOCK_DIR)
+        """
+        if fcntl is None:  # pragma: no cover
+            raise NotImplementedError('DatasetLock requires fcntl, which is not available on this platform')
+
+        # slugs are safe file names; anything else (which will fail validation) is hashed
+        name = dataset if slug_re.match(dataset) else hashlib.sha1(dataset.encode('utf-8')).hexdigest()
+        self.lock_dir = lock_dir or DEFAULT_LOCK_DIR
+        self.path = os.path.join(self.lock_dir, name + '.lock')
+        self.file = None
+
+    def acquire(self, blocking=True):
+        """
+        :return: True if the lock was acquired, False if blocking is False and another process holds it
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        except BaseException:
+            f.close()
+            raise
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+@contextlib.contextmanager
+def lock_datasets(datasets, lock_dir=None):
+    """
+    Hold the DatasetLock of each of datasets, acquired in sorted order so that processes that lock
+    overlapping datasets cannot deadlock. Nothing is locked on platforms without fcntl.
+    """
+    with contextlib.ExitStack() as stack:
+        for dataset in sorted(set(datasets)) if fcntl is not None else ():
+            stack.enter_context(DatasetLock(dataset, lock_dir))
+        yield
+
+
+def archive_datasets(zip_file):
+    """
+    Read the dataset slugs in an archive's datasets.csv
+    :return: A list of slugs, in the order they first occur
+    """
+    from .io import find_members, open_member, read_table, DATASETS_COLUMNS
+
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        fnames = find_members(zip_ref)
+        if 'datasets.csv' not in fnames:
+            raise ValueError('"datasets.csv" not found in import file')
+        with open_member(zip_ref, fnames['datasets.csv']) as f:
+            slugs = [line[0] for line_number, line in read_table(f, 'datasets.csv', DATASETS_COLUMNS)]
+    return list(OrderedDict.fromkeys(slugs))
+
+
+def split_archive(zip_file, datasets, out_dir):
+    """
+    Read each table of an archive once and write a copy of the archive for each dataset that contains
+    only that dataset's rows. Rows of other datasets are written as empty lines, which read_table()
+    skips, so that line numbers in error messages are those of the original archive. Tables are
+    written uncompressed.
+    :param datasets: The dataset slugs in the archive (see archive_datasets())
+    :param out_dir: The directory to write the copies to
+    :return: An OrderedDict of dataset slug -> archive filename
+    """
+    from .io import find_members, open_member
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = OrderedDict((dataset, os.path.join(out_dir, 'dataset-%s.zip' % i)) for i, dataset in enumerate(datasets))
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref, contextlib.ExitStack() as stack:
+        outputs = {dataset: stack.enter_context(zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED))
+                   for dataset, path in paths.items()}
+        for fname, member in find_members(zip_ref).items():
+            with open_member(zip_ref, member) as f, contextlib.ExitStack() as members:
+                files = {dataset: members.enter_context(io.TextIOWrapper(out.open(fname, 'w'), encoding='utf-8',
+                                                                         newline=''))
+                         for dataset, out in outputs.items()}
+                writers = {dataset: csv.writer(out_file) for dataset, out_file in files.items()}
+                reader = csv.reader(f)
+                header = next(reader, None)
+                if header is None:
+                    continue
+                for writer in writers.values():
+                    writer.writerow(header)
+
+                # the number of lines written to each copy after the header
+                written = dict.fromkeys(files, 0)
+                for i, line in enumerate(reader):
+                    if line and line[0] in writers:
+                        dataset = line[0]
+                        if written[dataset] < i:
+                            files[dataset].write('\r\n' * (i - written[dataset]))
+                        writers[dataset].writerow(line)
+                        written[dataset] = i + 1
+    return paths
+
+
+def init_worker(database):
+    # workers are started using 'spawn', so that they do not share the coordinator's database
+    # connection or transaction state, and need to set up django themselves
+    if not apps.ready:
+        django.setup()
+
+    if database:
+        from django.db import connections
+        connections['default'].settings_dict.update(database)
+
+
+def import_partition(zip_file, dataset, lock_dir, import_kwargs, partition_file=None):
+    """
+    Import one dataset from an archive in a worker process. Any error is recorded in the result
+    rather than raised, so that it does not stop the other partitions.
+    :param partition_file: The archive to read, if not zip_file (see split_archive())
+    :return: A dict with the zip_file, dataset, the seconds spent waiting for the dataset lock and
+      either the ImportReport (as a dict) or the error message
+    """
+    from .io import import_mudata
+
+    result = {'zip_file': zip_file, 'dataset': dataset}
+    start = time.perf_counter()
+    try:
+        with DatasetLock(dataset, lock_dir):
+            result['lock_seconds'] = time.perf_counter() - start
+            result['report'] = import_mudata(partition_file or zip_file, dataset_slugs=[dataset],
+                                             **import_kwargs).as_dict()
+    except ValidationError as e:
+        result['error'] = '; '.join(e.messages)
+    except (ValueError, OSError) as e:
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+
+def import_parallel(zip_files, workers=None, lock_dir=None, database=None, tmp_dir=None, **import_kwargs):
+    """
+    Import mudata archives using one worker process per (archive, dataset) partition. Partitions
+    for the same dataset are imported one at a time, in the order of zip_files; errors in one
+    partition do not stop the others.
+    :param zip_files: A list of archive filenames
+    :param workers: The number of worker processes (defaults to the number of CPUs)
+    :param lock_dir: The directory for DatasetLock files
+    :param database: Overrides for the workers' default database settings (e.g., {'NAME': ...}), for
+      example to import into a database other than the one in the settings module
+    :param tmp_dir: The directory that archives with more than one dataset are split in (which
+      needs room for their uncompressed tables)
+    :param import_kwargs: Passed to import_mudata() (these must be picklable, so progress callbacks
+      cannot be used). The 'row' and 'pipelined' engines are not supported.
+    :return: A list of the dicts returned by import_partition(), in the order partitions completed
+    """
+    engine = import_kwargs.get('engine', 'bulk')
+    if engine in ('row', 'pipelined'):
+        raise ValueError("The '%s' engine is not supported by import_parallel()" % engine)
+
+    workers = workers or os.cpu_count()
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp, \
+            ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=init_worker, initargs=(database, )) as executor:
+        # pending (archive, partition archive) pairs for each dataset
+        pending = OrderedDict()
+        for i, zip_file in enumerate(zip_files):
+            datasets = archive_datasets(zip_file)
+            if len(datasets) > 1:
+                partitions = split_archive(zip_file, datasets, os.path.join(tmp, str(i)))
+            else:
+                partitions = {dataset: zip_file for dataset in datasets}
+            for dataset in datasets:
+                pending.setdefault(dataset, deque()).append((zip_file, partitions[dataset]))
+
+        running = {}
+        while pending or running:
+            # start the next archive for each dataset that is not already being imported
+            for dataset in list(pending):
+                if len(running) >= workers:
+                    break
+                if dataset in running.values():
+                    continue
+                zip_file, partition_file = pending[dataset].popleft()
+                future = executor.submit(import_partition, zip_file, dataset, lock_dir, import_kwargs, partition_file)
+                running[future] = dataset
+                if not pending[dataset]:
+                    del pending[dataset]
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                results.append(future.result())
+
+    return results
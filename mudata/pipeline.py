@@ -0,0 +1,91 @@
+"""
+Pipelined parsing of data.csv: the calling process splits the file into csv records, and
+chunks of records are resolved and validated in worker processes while the calling process
+writes the results to the database. Chunks are returned in the order they were read, so the
+results (and the line numbers reported in errors) are the same as parsing the file serially.
+"""
+
+import csv
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+
+# the slug -> id lookups used by the worker process
+_lookups = None
+
+
+def init_worker(datasets, locations, params):
+    # workers started using 'spawn' (rather than 'fork') need to set up django themselves
+    if not apps.ready:
+        django.setup()
+
+    global _lookups
+    _lookups = (datasets, locations, params)
+
+
+def parse_chunk(first_line_number, records):
+    """
+    Parse a chunk of data.csv in a worker process
+    :param first_line_number: The line number of the first record
+    :param records: A list of consecutive records, as read by csv.reader() (including empty ones)
+    :return: A list of (line_number, row) as generated by mudata.io.parse_data()
+    """
+    from .io import read_rows, parse_data, DATA_COLUMNS
+
+    lines = read_rows(iter(records), 'data.csv', len(DATA_COLUMNS), first_line_number)
+    return list(parse_data(lines, *_lookups))
+
+
+def read_chunks(reader, chunk_size, first_line_number=2):
+    """
+    Group the records of a csv.reader() into (first_line_number, records) chunks of chunk_size
+    records. Records are split by csv.reader() itself, so that quotes inside unquoted fields and
+    newlines inside quoted fields are handled as they are by the other engines.
+    """
+    while True:
+        chunk = list(itertools.islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield first_line_number, chunk
+        first_line_number += len(chunk)
+
+
+def parse_data_pipelined(f, datasets, locations, params, workers, chunk_size, resume_from=0):
+    """
+    Parse and validate data.csv using a pool of worker processes
+    :param f: An open data.csv file
+    :param datasets: A dict of dataset slug -> id
+    :param locations: A dict of (dataset id, location slug) -> id
+    :param params: A dict of (dataset id, param slug) -> id
+    :param workers: The number of worker processes
+    :param chunk_size: The number of records sent to a worker at a time
+    :param resume_from: Skip lines up to and including this line number
+    :return: A generator of (line_number, row) in file order, as generated by mudata.io.parse_data()
+    """
+    from .io import check_header, DATA_COLUMNS
+
+    reader = csv.reader(f)
+    header = next(reader)
+    check_header(header, 'data.csv', DATA_COLUMNS)
+
+    # the first record after the header is line 2
+    first_line_number = 2
+    if resume_from >= first_line_number:
+        for record in itertools.islice(reader, resume_from - first_line_number + 1):
+            pass
+        first_line_number = resume_from + 1
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(datasets, locations, params)) as executor:
+        # keep a bounded number of chunks in flight so that memory use does not depend on file size
+        pending = deque()
+        for first_line_number, records in read_chunks(reader, chunk_size, first_line_number):
+            pending.append(executor.submit(parse_chunk, first_line_number, records))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
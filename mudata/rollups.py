@@ -0,0 +1,314 @@
+"""
+Hourly, daily and monthly summaries (count, sum, minimum and maximum) of each series, which are
+kept up to date as data is written and deleted so that aggregate queries over long ranges read
+one row per series per period rather than every datum. Imports can instead defer this work,
+marking the datasets they write to as stale: aggregate queries that touch a stale dataset are
+answered from the Datum table until rebuild_rollups() is run.
+"""
+
+import heapq
+import itertools
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import CharField, ExpressionWrapper, F, IntegerField, Value, Count, Min, Max, Sum
+from django.db.models.functions import Floor, Mod
+from django.utils import timezone
+
+from .aggregate import Resample, aggregate_data, bucket_rows, DEFAULT_AGGREGATE_CHUNK_SIZE
+from .downsample import numeric_data
+from .io import invalidate_series_hashes
+from .models import Dataset, Datum, Rollup
+
+# the resolution of each set of rollups, as a resample string, finest first. Monthly rollups are
+# of months in the default time zone.
+ROLLUP_RESOLUTIONS = ('h', 'D', 'M')
+
+# the aggregates stored in each rollup, which all of aggregate.AGGREGATES can be computed from
+ROLLUP_AGGREGATES = ('count', 'sum', 'min', 'max')
+
+# series are filtered by id when updating rollups if a dataset has at most this many changed
+# locations (or params); otherwise all of the dataset's locations (or params) are updated
+MAX_FILTER_IDS = 100
+
+
+class RollupRanges:
+    """
+    The range of x values of each (dataset_id, location_id, param_id) series that data has been
+    written to or deleted from since its rollups were last updated. If defer is True, update()
+    marks the rollups of the changed datasets as stale instead of recomputing them.
+    """
+
+    def __init__(self, defer=False):
+        self.defer = defer
+        # series -> [x_min, x_max], or None if the whole series has changed
+        self.series = {}
+
+    def __bool__(self):
+        return bool(self.series)
+
+    def add(self, series, x_min=None, x_max=None):
+        """
+        Record a change to a series between x_min and x_max, or to the whole series if these are None
+        """
+        if series in self.series and self.series[series] is None:
+            return
+        if x_min is None or x_max is None:
+            self.series[series] = None
+        elif series in self.series:
+            x_range = self.series[series]
+            x_range[0] = min(x_range[0], x_min)
+            x_range[1] = max(x_range[1], x_max)
+        else:
+            self.series[series] = [x_min, x_max]
+
+    def add_rows(self, rows):
+        """
+        Record changes to rows of (dataset_id, location_id, param_id, x, ...) tuples
+        """
+        for row in rows:
+            self.add(tuple(row[:3]), row[3], row[3])
+
+    def update(self):
+        """
+        Update the rollups of the changed series (call within the transaction that changed them)
+        """
+        if self.series and self.defer:
+            Dataset.objects.filter(id__in=sorted(set(series[0] for series in self.series)), rollups_stale=False) \
+                .update(rollups_stale=True)
+            self.series = {}
+        elif self.series:
+            update_rollups(self.series)
+            self.series = {}
+
+
+def summarise(data, resolution):
+    """
+    :return: A values() QuerySet with the columns of Rollup for the numeric values in a Datum
+      QuerySet, grouped by series and period
+    """
+    data = numeric_data(data)
+    if resolution == 'M':
+        data = data.filter(datetime__isnull=False)
+    return data.order_by() \
+        .annotate(period=Resample(resolution).bucket()) \
+        .values('dataset_id', 'location_id', 'param_id', 'period') \
+        .annotate(n=Count('id'), total=Sum('value_num'), minimum=Min('value_num'), maximum=Max('value_num'))
+
+
+def insert_select(model, values):
+    """
+    Insert the rows of a values() QuerySet, whose field and annotation names are the names of
+    the columns of model, using a single INSERT ... SELECT statement
+    """
+    compiler = values.query.get_compiler(connection=connection)
+    sql, params = compiler.as_sql()
+    qn = connection.ops.quote_name
+    columns = [alias or expression.target.column for expression, _, alias in compiler.select]
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) %s' % (qn(model._meta.db_table), ', '.join(qn(c) for c in columns), sql),
+                       params)
+
+
+def recompute(resolution, filters, x_min=None, x_max=None, datum_model=Datum, rollup_model=Rollup):
+    """
+    Replace the rollups of the series matched by filters for the periods that contain x values
+    between x_min and x_max (or for all periods if these are None)
+    """
+    period = Resample(resolution)
+    rollups = rollup_model.objects.filter(resolution=resolution, **filters)
+    data = datum_model.objects.filter(**filters)
+    try:
+        if x_min is not None:
+            first = period.bucket_of(x_min)
+            rollups = rollups.filter(period__gte=first)
+            data = data.filter(x__gte=period.bucket_x(first)[0])
+        if x_max is not None:
+            last = period.bucket_of(x_max)
+            rollups = rollups.filter(period__lte=last)
+            data = data.filter(x__lt=period.bucket_x(last + period.width)[0])
+    except (OverflowError, ValueError, OSError):
+        # x values outside the range of datetimes have no months
+        rollups = rollup_model.objects.filter(resolution=resolution, **filters)
+        data = datum_model.objects.filter(**filters)
+
+    rollups.delete()
+    values = summarise(data, resolution).annotate(resolution=Value(resolution, output_field=CharField()))
+    insert_select(rollup_model, values)
+
+
+def update_rollups(series_ranges, datum_model=Datum, rollup_model=Rollup):
+    """
+    Recompute the rollups of the given series over the given ranges of x. The series of each
+    dataset are updated together: rollups are recomputed for every combination of their
+    locations and params over the union of their ranges, using one DELETE and one INSERT ...
+    SELECT per dataset and resolution.
+    :param series_ranges: A dict of (dataset_id, location_id, param_id) -> [x_min, x_max], or None
+      to recompute the whole series
+    """
+    datasets = defaultdict(list)
+    for series, x_range in series_ranges.items():
+        datasets[series[0]].append((series, x_range))
+
+    # monthly rollups are always of months in the default time zone
+    with timezone.override(timezone.get_default_timezone()):
+        for ds_id, changes in datasets.items():
+            filters = {'dataset_id': ds_id}
+            location_ids = set(series[1] for series, x_range in changes)
+            param_ids = set(series[2] for series, x_range in changes)
+            if len(location_ids) <= MAX_FILTER_IDS:
+                filters['location_id__in'] = sorted(location_ids)
+            if len(param_ids) <= MAX_FILTER_IDS:
+                filters['param_id__in'] = sorted(param_ids)
+
+            if any(x_range is None for series, x_range in changes):
+                x_min = x_max = None
+            else:
+                x_min = min(x_range[0] for series, x_range in changes)
+                x_max = max(x_range[1] for series, x_range in changes)
+
+            for resolution in ROLLUP_RESOLUTIONS:
+                recompute(resolution, filters, x_min, x_max, datum_model, rollup_model)
+
+
+def rebuild_rollups(dataset_ids=None, datum_model=Datum, rollup_model=Rollup):
+    """
+    Recompute all rollups of the given datasets (or of all datasets), one dataset per transaction,
+    and mark them as current
+    :param datum_model: The Datum model (migrations pass the historical models)
+    """
+    dataset_model = datum_model._meta.get_field('dataset').related_model
+    if dataset_ids is None:
+        dataset_ids = list(dataset_model.objects.order_by('id').values_list('id', flat=True))
+
+    with timezone.override(timezone.get_default_timezone()):
+        for ds_id in dataset_ids:
+            with transaction.atomic():
+                for resolution in ROLLUP_RESOLUTIONS:
+                    recompute(resolution, {'dataset_id': ds_id}, datum_model=datum_model, rollup_model=rollup_model)
+                dataset_model.objects.filter(id=ds_id, rollups_stale=True).update(rollups_stale=False)
+
+
+def stale_datasets():
+    """
+    :return: A list of the ids of datasets whose rollups are stale, in order
+    """
+    return list(Dataset.objects.filter(rollups_stale=True).order_by('id').values_list('id', flat=True))
+
+
+def delete_data(data):
+    """
+    Delete the rows of a Datum QuerySet and update the rollups (and remove the incremental import
+    hashes) of the series they belonged to
+    :return: The number of rows deleted
+    """
+    ranges = RollupRanges()
+    with transaction.atomic():
+        for ds_id, location_id, param_id, x_min, x_max in data.order_by() \
+                .values_list('dataset_id', 'location_id', 'param_id') \
+                .annotate(x_min=Min('x'), x_max=Max('x')):
+            ranges.add((ds_id, location_id, param_id), x_min, x_max)
+        deleted, _ = data.delete()
+        invalidate_series_hashes(set(series[0] for series in ranges.series), ranges.series)
+        ranges.update()
+    return deleted
+
+
+def rollup_resolution(resample):
+    """
+    :return: The coarsest of ROLLUP_RESOLUTIONS whose periods divide the buckets of resample
+      exactly, or None if there is none
+    """
+    if not resample.datetime:
+        return None
+    if resample.calendar:
+        # monthly rollups are of months in the default time zone
+        if timezone.get_current_timezone_name() != timezone.get_default_timezone_name():
+            return None
+        return 'M'
+    for resolution in reversed(ROLLUP_RESOLUTIONS):
+        period = Resample(resolution)
+        if not period.calendar and resample.width % period.width == 0:
+            return resolution
+    return None
+
+
+def resample_periods(resample):
+    """
+    :return: An expression for the bucket of resample (see Resample.bucket()) that contains each
+      rollup's period
+    """
+    if resample.calendar:
+        return ExpressionWrapper(F('period') - Mod(F('period'), resample.width), output_field=IntegerField())
+    return Floor(F('period') / resample.width) * resample.width
+
+
+def rollup_rows(filters, resample, aggs=('mean', ), chunk_size=DEFAULT_AGGREGATE_CHUNK_SIZE):
+    """
+    Generate the rows of aggregate.aggregate_rows() from rollups. Only whole rollup periods can be
+    read from rollups, so data between the x limits and the nearest period boundaries is
+    aggregated from the Datum table and combined with the rollups of the same buckets.
+    :param filters: A dict of Datum filters: any of dataset_id__in, location_id__in,
+      param_id__in, x__gte and x__lte
+    :return: A generator of rows, or None if the query cannot be answered using rollups
+    """
+    resolution = rollup_resolution(resample)
+    if resolution is None or not set(filters) <= {'dataset_id__in', 'location_id__in', 'param_id__in',
+                                                 'x__gte', 'x__lte'}:
+        return None
+    stale = Dataset.objects.filter(rollups_stale=True)
+    if 'dataset_id__in' in filters:
+        stale = stale.filter(id__in=filters['dataset_id__in'])
+    if stale.exists():
+        return None
+
+    series_filters = {key: value for key, value in filters.items() if key not in ('x__gte', 'x__lte')}
+    rollups = Rollup.objects.filter(resolution=resolution, **series_filters)
+    data = Datum.objects.filter(**series_filters)
+    x_from, x_to = filters.get('x__gte'), filters.get('x__lte')
+    period = Resample(resolution)
+    edges = []
+    try:
+        if x_from is not None:
+            first = period.bucket_of(x_from)
+            if period.bucket_x(first)[0] < x_from:
+                first += period.width
+            rollups = rollups.filter(period__gte=first)
+            edges.append(data.filter(x__gte=x_from, x__lt=period.bucket_x(first)[0]))
+        if x_to is not None:
+            last = period.bucket_of(x_to)
+            rollups = rollups.filter(period__lt=last)
+            edges.append(data.filter(x__gte=period.bucket_x(last)[0], x__lte=x_to))
+    except (OverflowError, ValueError, OSError):
+        return None
+    if x_from is not None and x_to is not None and first >= last:
+        # the range is less than a period: there is nothing to gain from rollups
+        return None
+
+    buckets = rollups.order_by() \
+        .annotate(bucket=resample_periods(resample)) \
+        .values('dataset_id', 'location_id', 'param_id', 'dataset__dataset', 'location__location', 'param__param',
+                'bucket') \
+        .annotate(count=Sum('n'), sum=Sum('total'), min=Min('minimum'), max=Max('maximum')) \
+        .order_by('dataset_id', 'location_id', 'param_id', 'bucket')
+
+    # the edges have at most one bucket per series each, and are read before the rollups
+    edges = [list(aggregate_data(edge, resample, ROLLUP_AGGREGATES)) for edge in edges]
+    return bucket_rows(combine_buckets(heapq.merge(buckets.iterator(chunk_size=chunk_size), *edges,
+                                                   key=bucket_key)), resample, aggs)
+
+
+def bucket_key(row):
+    return row['dataset_id'], row['location_id'], row['param_id'], row['bucket']
+
+
+def combine_buckets(buckets):
+    """
+    Combine the ROLLUP_AGGREGATES of dicts with the same bucket_key(), and compute the mean
+    """
+    for key, group in itertools.groupby(buckets, key=bucket_key):
+        row = next(group)
+        for other in group:
+            row = dict(row, count=row['count'] + other['count'], sum=row['sum'] + other['sum'],
+                       min=min(row['min'], other['min']), max=max(row['max'], other['max']))
+        yield dict(row, mean=row['sum'] / row['count'])
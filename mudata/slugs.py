@@ -0,0 +1,170 @@
+"""
+Resolve dataset, location and param slugs to ids for the query endpoint, caching the location and
+param slugs of recently used datasets in this process
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Dataset, Location, Param
+
+# the number of datasets whose location and param slugs are kept in memory
+DEFAULT_MAX_DATASETS = 128
+
+# the number of seconds before the cache is reloaded, which limits how long locations and params
+# renamed by other processes (which do not invalidate this process's cache) can go unnoticed
+DEFAULT_MAX_AGE = 300
+
+
+class UnknownDataset(LookupError):
+    pass
+
+
+class SlugCache:
+    """
+    A cache of location and param slug -> id for the most recently used datasets. Dataset slugs
+    are looked up on every call (one query on the small dataset table), so that datasets dropped
+    or replaced by other processes, which change or remove their ids, are never resolved from the
+    cache. Location and param slugs of datasets that are not in the cache are looked up using one
+    IN query per table, and the cache for a dataset is invalidated when it is imported into or
+    when its locations or params are saved or deleted. A slug that is missing from the cache
+    causes the dataset to be reloaded once, so that objects created by other processes are found;
+    after that the slug is cached as missing.
+    """
+
+    def __init__(self, max_datasets=DEFAULT_MAX_DATASETS, max_age=DEFAULT_MAX_AGE):
+        self.max_datasets = max_datasets
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.loaded_at = time.monotonic()
+        # dataset id -> ({location slug: id}, {param slug: id}), least recently used first. Slugs
+        # that have been looked up and were not found have an id of None.
+        self.datasets = OrderedDict()
+
+    def clear(self):
+        with self.lock:
+            self.datasets.clear()
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self, dataset_ids):
+        """
+        Remove datasets from the cache (e.g., after an import has created locations or params)
+        """
+        with self.lock:
+            for ds_id in dataset_ids:
+                self.datasets.pop(ds_id, None)
+
+    def resolve(self, dataset_slugs=(), location_slugs=(), param_slugs=()):
+        """
+        Resolve slugs to ids. Location and param slugs are looked up in the datasets given by
+        dataset_slugs, or in all datasets if there are none.
+        :return: A (dataset_ids, location_ids, param_ids) tuple of sorted lists of ids. Location
+          and param slugs that do not exist are ignored.
+        :raises UnknownDataset: if any of dataset_slugs is not the slug of a dataset
+        """
+        with self.lock:
+            if time.monotonic() - self.loaded_at > self.max_age:
+                self.datasets.clear()
+                self.loaded_at = time.monotonic()
+            dataset_map = self.load_datasets(dataset_slugs)
+            try:
+                return self.lookup(dataset_map, dataset_slugs, location_slugs, param_slugs)
+            except KeyError:
+                # objects may have been created since the cache was loaded
+                return self.lookup(dataset_map, dataset_slugs, location_slugs, param_slugs, reload=True)
+
+    def lookup(self, dataset_map, dataset_slugs, location_slugs, param_slugs, reload=False):
+        """
+        :param dataset_map: The load_datasets() of dataset_slugs
+        :raises KeyError: if a slug is not in the cache, unless everything that was needed has just
+          been loaded from the database
+        """
+        dataset_ids = []
+        for slug in dataset_slugs:
+            if slug not in dataset_map:
+                raise UnknownDataset(slug)
+            dataset_ids.append(dataset_map[slug])
+        if not location_slugs and not param_slugs:
+            return sorted(set(dataset_ids)), [], []
+
+        search_ids = dataset_ids or list(dataset_map.values())
+        fresh = reload or not any(ds_id in self.datasets for ds_id in search_ids)
+        slug_maps = self.load_slugs(search_ids, reload)
+        return (sorted(set(dataset_ids)),
+                self.find(slug_maps, 0, location_slugs, fresh),
+                self.find(slug_maps, 1, param_slugs, fresh))
+
+    @staticmethod
+    def find(slug_maps, table, slugs, fresh):
+        """
+        :return: The sorted ids of slugs in the location (table=0) or param (table=1) maps of the
+          datasets in slug_maps
+        :param fresh: True if slug_maps were just loaded, in which case slugs that are not found
+          are recorded as missing (as None) until the datasets are next invalidated
+        :raises KeyError: if fresh is False and a slug is not found and has not been recorded as
+          missing
+        """
+        ids = set()
+        for slug in slugs:
+            found = [maps[table][slug] for maps in slug_maps if maps[table].get(slug) is not None]
+            if not found:
+                if fresh:
+                    for maps in slug_maps:
+                        maps[table].setdefault(slug, None)
+                elif any(slug not in maps[table] for maps in slug_maps):
+                    raise KeyError(slug)
+            ids.update(found)
+        return sorted(ids)
+
+    @staticmethod
+    def load_datasets(dataset_slugs=()):
+        """
+        :return: A dict of dataset slug -> id for dataset_slugs, or for every dataset if there are none
+        """
+        datasets = Dataset.objects.filter(dataset__in=dataset_slugs) if dataset_slugs else Dataset.objects.all()
+        return dict(datasets.values_list('dataset', 'id'))
+
+    def load_slugs(self, dataset_ids, reload=False):
+        """
+        :return: A list of the (location map, param map) of each dataset, loading datasets that
+          are not cached using one query for locations and one for params
+        """
+        missing = dataset_ids if reload else [ds_id for ds_id in dataset_ids if ds_id not in self.datasets]
+        if missing:
+            loaded = {ds_id: ({}, {}) for ds_id in missing}
+            for ds_id, slug, obj_id in Location.objects.filter(dataset_id__in=missing) \
+                    .values_list('dataset_id', 'location', 'id'):
+                loaded[ds_id][0][slug] = obj_id
+            for ds_id, slug, obj_id in Param.objects.filter(dataset_id__in=missing) \
+                    .values_list('dataset_id', 'param', 'id'):
+                loaded[ds_id][1][slug] = obj_id
+            self.datasets.update(loaded)
+
+        slug_maps = []
+        for ds_id in dataset_ids:
+            self.datasets.move_to_end(ds_id)
+            slug_maps.append(self.datasets[ds_id])
+        while len(self.datasets) > self.max_datasets:
+            self.datasets.popitem(last=False)
+        return slug_maps
+
+
+slug_cache = SlugCache()
+
+
+@receiver(post_save, sender=Dataset)
+@receiver(post_delete, sender=Dataset)
+def dataset_changed(sender, instance, **kwargs):
+    slug_cache.invalidate([instance.id])
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=Param)
+@receiver(post_delete, sender=Param)
+def slug_changed(sender, instance, **kwargs):
+    slug_cache.invalidate([instance.dataset_id])
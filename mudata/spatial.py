@@ -0,0 +1,232 @@
+"""
+An index of the coordinates of locations (from their latitude and longitude tags), kept in the
+LocationPoint table so that locations can be selected by bounding box or by distance from a
+point without decoding the tags of every location
+"""
+
+import json
+import math
+
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Location, LocationPoint
+
+# the tags that are read as the latitude and longitude of a location, in order of preference
+LATITUDE_TAGS = ('latitude', 'lat')
+LONGITUDE_TAGS = ('longitude', 'lon', 'lng')
+
+# the mean radius of the Earth, in kilometres
+EARTH_RADIUS = 6371.0088
+
+# the radius (in km) of the first area searched for the nearest locations, which is enlarged
+# until it contains enough of them
+INITIAL_SEARCH_RADIUS = 50.0
+
+# the number of locations returned by 'near' if 'k' is not given, and the most that can be requested
+DEFAULT_NEAREST = 1
+MAX_NEAREST = 500
+
+
+def coordinate(tags, keys, limit):
+    """
+    :return: The first of keys in tags whose value is a number (or numeric string) between -limit
+      and limit, or None
+    """
+    for key in keys:
+        value = tags.get(key)
+        if isinstance(value, bool):
+            continue
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if -limit <= value <= limit:
+            return value
+    return None
+
+
+def tag_point(tags):
+    """
+    :param tags: A location's tags, as a mapping or JSON text
+    :return: A (latitude, longitude) tuple, or None if the tags do not have both
+    """
+    if isinstance(tags, str):
+        try:
+            tags = json.loads(tags) if tags else {}
+        except ValueError:
+            return None
+    if not hasattr(tags, 'get'):
+        return None
+    latitude = coordinate(tags, LATITUDE_TAGS, 90)
+    longitude = coordinate(tags, LONGITUDE_TAGS, 180)
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude
+
+
+def point_rows(point_model, objects):
+    """
+    :return: A list of unsaved point_model objects for the (pk, tags) tuples that have coordinates
+    """
+    rows = []
+    for pk, tags in objects:
+        point = tag_point(tags)
+        if point is not None:
+            rows.append(point_model(location_id=pk, latitude=point[0], longitude=point[1]))
+    return rows
+
+
+def index_points(locations):
+    """
+    Replace the indexed coordinates of Location objects with those in their current tags
+    """
+    if not locations:
+        return
+    ids = [obj.pk for obj in locations]
+    rows = point_rows(LocationPoint, ((obj.pk, obj.tags) for obj in locations))
+
+    # stay below SQLite's default limit on query parameters
+    for start in range(0, len(ids), 500):
+        LocationPoint.objects.filter(location_id__in=ids[start:start + 500]).delete()
+    LocationPoint.objects.bulk_create(rows, batch_size=500)
+
+
+def rebuild_point_index(location_model=Location, point_model=LocationPoint, chunk_size=2000):
+    """
+    Index the coordinates of every location
+    :param location_model: The Location model (migrations pass the historical models)
+    """
+    point_model.objects.all().delete()
+    objects = []
+    for pk, tags in location_model.objects.values_list('pk', 'tags').iterator(chunk_size=chunk_size):
+        objects.append((pk, tags))
+        if len(objects) >= chunk_size:
+            point_model.objects.bulk_create(point_rows(point_model, objects), batch_size=500)
+            objects = []
+    point_model.objects.bulk_create(point_rows(point_model, objects), batch_size=500)
+
+
+def parse_numbers(name, text, n):
+    try:
+        numbers = [float(value) for value in text.split(',')]
+    except ValueError:
+        raise ValueError("Unparsable %s: %s" % (name, text))
+    if len(numbers) != n or not all(math.isfinite(value) for value in numbers):
+        raise ValueError("Unparsable %s: %s" % (name, text))
+    return numbers
+
+
+def parse_spatial_filters(query_params):
+    """
+    Extract spatial filters from query parameters: bbox=west,south,east,north (in degrees; a box
+    whose west edge is east of its east edge crosses the antimeridian) and near=latitude,longitude
+    with k (the number of nearest locations)
+    :return: A (bbox, near) tuple of a (west, south, east, north) tuple and a (latitude,
+      longitude, k) tuple, either of which is None if it was not given
+    """
+    bbox = near = None
+    if 'bbox' in query_params:
+        west, south, east, north = parse_numbers('bbox', query_params['bbox'], 4)
+        if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+            raise ValueError("bbox must be west,south,east,north in degrees: %s" % query_params['bbox'])
+        bbox = west, south, east, north
+
+    if 'near' in query_params:
+        latitude, longitude = parse_numbers('near', query_params['near'], 2)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("near must be latitude,longitude in degrees: %s" % query_params['near'])
+        try:
+            k = int(query_params['k']) if 'k' in query_params else DEFAULT_NEAREST
+        except ValueError:
+            raise ValueError("Unparsable k: %s" % query_params['k'])
+        if not 1 <= k <= MAX_NEAREST:
+            raise ValueError("k must be between 1 and %s" % MAX_NEAREST)
+        near = latitude, longitude, k
+    elif 'k' in query_params:
+        raise ValueError("k can only be passed with near")
+
+    return bbox, near
+
+
+def in_bbox(locations, bbox):
+    """
+    Filter a Location QuerySet to the locations inside a (west, south, east, north) box
+    """
+    west, south, east, north = bbox
+    if west <= east:
+        longitude = Q(point__longitude__gte=west, point__longitude__lte=east)
+    else:
+        longitude = Q(point__longitude__gte=west) | Q(point__longitude__lte=east)
+    # the latitude range uses the (latitude, longitude) index
+    return locations.filter(longitude, point__latitude__gte=south, point__latitude__lte=north)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    :return: The great-circle (haversine) distance between two points, in km
+    """
+    lat1, lon1, lat2, lon2 = (math.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(latitude, longitude, radius):
+    """
+    :return: The smallest (west, south, east, north) box that contains every point within radius
+      km of a point, or None if that is the whole globe
+    """
+    angle = radius / EARTH_RADIUS
+    if angle >= math.pi:
+        return None
+    south = latitude - math.degrees(angle)
+    north = latitude + math.degrees(angle)
+    if south <= -90 or north >= 90:
+        # the circle contains a pole, so it spans every longitude
+        return -180.0, max(south, -90.0), 180.0, min(north, 90.0)
+
+    # the longitudes of the points where the circle touches its meridians
+    half_width = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(latitude))))
+    west = longitude - half_width
+    east = longitude + half_width
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return west, south, east, north
+
+
+def nearest(locations, latitude, longitude, k=DEFAULT_NEAREST):
+    """
+    Find the k locations in a Location QuerySet that are nearest to a point. Locations are read
+    from a box around the point (using the index), and the box is enlarged until the kth nearest
+    location in it is closer than its edges.
+    :return: A list of location ids, nearest first
+    """
+    radius = INITIAL_SEARCH_RADIUS
+    while True:
+        box = radius_bbox(latitude, longitude, radius)
+        candidates = in_bbox(locations, box) if box is not None else locations.filter(point__isnull=False)
+        found = sorted((distance(latitude, longitude, lat, lon), pk) for pk, lat, lon in
+                       candidates.values_list('pk', 'point__latitude', 'point__longitude'))
+        if box is None or len(found) >= k and found[k - 1][0] <= radius:
+            return [pk for dist, pk in found[:k]]
+        radius *= 4
+
+
+def located(locations, bbox=None, near=None):
+    """
+    Filter a Location QuerySet to the locations inside bbox and, of those, the k nearest to near
+    (see parse_spatial_filters())
+    """
+    if bbox is not None:
+        locations = in_bbox(locations, bbox)
+    if near is not None:
+        locations = locations.model.objects.filter(pk__in=nearest(locations, *near))
+    return locations
+
+
+@receiver(post_save, sender=Location)
+def location_saved(sender, instance, **kwargs):
+    index_points([instance])
@@ -0,0 +1,102 @@
+"""
+Generate valid mudata archives of arbitrary size for testing and benchmarking
+"""
+
+import csv
+import gzip
+import io
+import json
+import random
+import zipfile
+from datetime import datetime, timedelta
+
+X_TYPES = ('datetime', 'numeric')
+
+# the first x value (and the spacing between x values) for generated data
+X_START = datetime(2000, 1, 1)
+X_STEP = timedelta(minutes=1)
+
+
+def write_table(zip_ref, fname, header, rows, compress=False):
+    """
+    Write a csv table into an open ZipFile without holding the whole table in memory
+    """
+    member = fname + '.gz' if compress else fname
+    with zip_ref.open(member, 'w', force_zip64=True) as raw:
+        if compress:
+            raw = gzip.GzipFile(fileobj=raw, mode='wb')
+        with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+def dataset_slug(i):
+    return 'synthetic_%s' % i
+
+
+def location_slug(i):
+    return 'location_%s' % i
+
+
+def param_slug(i):
+    return 'param_%s' % i
+
+
+def generate_mudata(zip_file, n_rows=10000, n_datasets=1, n_locations=5, n_params=5, x_type='datetime',
+                    tag_size=0, na_fraction=0.01, seed=0, compress=False):
+    """
+    Write a mudata archive with random data. Rows are split as evenly as possible between the
+    (dataset, location, param) series, and each series has consecutive x values.
+    :param zip_file: A filename or writable file-like object
+    :param n_rows: The total number of rows in data.csv
+    :param n_datasets: The number of datasets
+    :param n_locations: The number of locations in each dataset
+    :param n_params: The number of params in each dataset
+    :param x_type: 'datetime' for x values one minute apart starting at X_START or
+      'numeric' for x values 0, 1, 2...
+    :param tag_size: The number of tags on each row of data.csv
+    :param na_fraction: The fraction of values that are NA
+    :param seed: The random seed
+    :param compress: Write data.csv as a gzip-compressed data.csv.gz
+    """
+    if x_type not in X_TYPES:
+        raise ValueError('Unknown x_type: %s' % x_type)
+
+    rand = random.Random(seed)
+    datasets = [dataset_slug(i) for i in range(n_datasets)]
+    series = [(ds, location_slug(loc), param_slug(param))
+              for ds in datasets for loc in range(n_locations) for param in range(n_params)]
+    rows_per_series, extra_rows = divmod(n_rows, len(series))
+
+    def data_rows():
+        for i, (ds, loc, param) in enumerate(series):
+            for j in range(rows_per_series + (1 if i < extra_rows else 0)):
+                if x_type == 'datetime':
+                    x = (X_START + X_STEP * j).strftime('%Y-%m-%d %H:%M:%S')
+                else:
+                    x = j
+                value = 'NA' if rand.random() < na_fraction else '%.3f' % rand.gauss(10, 5)
+                if tag_size:
+                    tags = json.dumps({'tag_%s' % k: rand.choice('abcde') for k in range(tag_size)})
+                else:
+                    tags = '{}'
+                yield ds, loc, param, x, value, tags
+
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        write_table(zip_ref, 'datasets.csv', ('dataset', 'tags'),
+                    ((ds, json.dumps({'label': ds})) for ds in datasets))
+        write_table(zip_ref, 'locations.csv', ('dataset', 'location', 'tags'),
+                    ((ds, location_slug(i), json.dumps({'latitude': round(rand.uniform(-60, 70), 4),
+                                                        'longitude': round(rand.uniform(-180, 180), 4)}))
+                     for ds in datasets for i in range(n_locations)))
+        write_table(zip_ref, 'params.csv', ('dataset', 'param', 'tags'),
+                    ((ds, param_slug(i), json.dumps({'label': 'Parameter %s' % i}))
+                     for ds in datasets for i in range(n_params)))
+        write_table(zip_ref, 'columns.csv', ('dataset', 'table', 'column', 'tags'),
+                    ((ds, 'data', column, json.dumps({'type': column_type}))
+                     for ds in datasets
+                     for column, column_type in (('x', 'POSIXct' if x_type == 'datetime' else 'numeric'),
+                                                 ('value', 'numeric'))))
+        write_table(zip_ref, 'data.csv', ('dataset', 'location', 'param', 'x', 'value', 'tags'),
+                    data_rows(), compress=compress)
@@ -0,0 +1,121 @@
+"""
+An index of the tags of locations and params (e.g., region or instrument), kept in the
+LocationTag and ParamTag tables so that objects can be filtered by tag in the database
+"""
+
+import json
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Location, Param, LocationTag, ParamTag
+
+# the tag model of each indexed model, and the name of its foreign key
+TAG_MODELS = {
+    Location: (LocationTag, 'location'),
+    Param: (ParamTag, 'param'),
+}
+
+# the query parameter prefix for the tags of each indexed model (e.g., location_tag__region=Arctic)
+TAG_FILTER_PREFIXES = {
+    Location: 'location_tag__',
+    Param: 'param_tag__',
+}
+
+# the longest key or value that is indexed
+MAX_TAG_LENGTH = 200
+
+
+def tag_value(value):
+    """
+    :return: The indexed text of a tag value: strings as they are and other scalars as JSON
+      (e.g., '30', 'true'), or None if the value is a list or dict (which are not indexed)
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return None
+    return json.dumps(value)
+
+
+def tag_rows(tag_model, fk_name, pk, tags):
+    """
+    :return: A list of unsaved tag_model objects for the indexable tags of one object
+    :param tags: The object's tags, as a mapping or JSON text
+    """
+    if isinstance(tags, str):
+        tags = json.loads(tags) if tags else {}
+    rows = []
+    for key, value in tags.items():
+        text = tag_value(value)
+        if text is not None and len(key) <= MAX_TAG_LENGTH and len(text) <= MAX_TAG_LENGTH:
+            rows.append(tag_model(key=key, value=text, **{fk_name + '_id': pk}))
+    return rows
+
+
+def index_tags(objects):
+    """
+    Replace the indexed tags of Location or Param objects (all of the same model) with their
+    current tags
+    """
+    if not objects:
+        return
+    tag_model, fk_name = TAG_MODELS[type(objects[0])]
+    ids = [obj.pk for obj in objects]
+
+    rows = [row for obj in objects for row in tag_rows(tag_model, fk_name, obj.pk, obj.tags)]
+
+    # stay below SQLite's default limit on query parameters
+    for start in range(0, len(ids), 500):
+        tag_model.objects.filter(**{fk_name + '_id__in': ids[start:start + 500]}).delete()
+    tag_model.objects.bulk_create(rows, batch_size=500)
+
+
+def rebuild_tag_index(location_model=Location, param_model=Param, location_tag_model=LocationTag,
+                      param_tag_model=ParamTag, chunk_size=2000):
+    """
+    Index the tags of every location and param
+    :param location_model: The Location model (migrations pass the historical models)
+    """
+    for model, tag_model, fk_name in ((location_model, location_tag_model, 'location'),
+                                      (param_model, param_tag_model, 'param')):
+        tag_model.objects.all().delete()
+        rows = []
+        for pk, tags in model.objects.values_list('pk', 'tags').iterator(chunk_size=chunk_size):
+            rows.extend(tag_rows(tag_model, fk_name, pk, tags))
+            if len(rows) >= chunk_size:
+                tag_model.objects.bulk_create(rows, batch_size=500)
+                rows = []
+        tag_model.objects.bulk_create(rows, batch_size=500)
+
+
+def parse_tag_filters(query_params):
+    """
+    Extract tag filters (e.g., location_tag__region=Arctic) from query parameters. A parameter
+    may be repeated to match any of several values.
+    :return: A dict of model -> {key: [values]} for the models that are filtered
+    """
+    filters = {}
+    for name in query_params:
+        for model, prefix in TAG_FILTER_PREFIXES.items():
+            if name.startswith(prefix) and len(name) > len(prefix):
+                values = query_params.getlist(name) if hasattr(query_params, 'getlist') else [query_params[name]]
+                filters.setdefault(model, {})[name[len(prefix):]] = values
+    return filters
+
+
+def tagged(queryset, tag_filters):
+    """
+    Filter a Location or Param QuerySet to the objects that have all of the given tags
+    :param tag_filters: A dict of key -> list of values, any of which match
+    """
+    for key, values in sorted(tag_filters.items()):
+        # one join (on the key, value index) per key
+        queryset = queryset.filter(tag_index__key=key, tag_index__value__in=values)
+    return queryset
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=Param)
+def tags_saved(sender, instance, **kwargs):
+    index_tags([instance])
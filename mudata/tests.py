@@ -1,4 +1,5 @@
 
+import csv
 import datetime
 import os
 from django.test import TestCase
@@ -36,6 +37,37 @@ class TagsFieldTests(TestCase):
         ds_invalid_tags = Dataset(dataset='dataset', tags=str)  # wrong type, but currently only raises error on save
         self.assertRaises(ValidationError, ds_invalid_tags.save)
 
+    def test_lazy_tags(self):
+        import json
+        from mudata.io import dump_json, format_tags
+        from mudata.models import LazyTags
+
+        # the text is kept exactly as stored until the tags are accessed
+        text = '{"b": 1,  "a": [1, 2]}'
+        Dataset.objects.create(dataset='lazy', tags=text)
+        Dataset.objects.create(dataset='empty', tags='')
+        tags = Dataset.objects.get(dataset='lazy').tags
+        self.assertIsInstance(tags, LazyTags)
+        self.assertFalse(tags.decoded)
+        self.assertEqual(format_tags(tags), text)
+        self.assertEqual(dump_json({'id': 1, 'tags': tags}), '{"id": 1, "tags": %s}' % text)
+        self.assertEqual(json.loads(dump_json({'tags': tags})), {'tags': {'b': 1, 'a': [1, 2]}})
+        self.assertFalse(tags.decoded)
+        self.assertEqual(Dataset.objects.get(dataset='empty').tags, {})
+
+        ds = Dataset.objects.get(dataset='lazy')
+        ds.save()
+        self.assertEqual(Dataset.objects.filter(tags=text).count(), 1)
+
+        # tags behave as a dict once they are accessed
+        self.assertEqual(ds.tags, {'a': [1, 2], 'b': 1})
+        self.assertTrue(ds.tags.decoded)
+        ds.tags['c'] = 'new'
+        del ds.tags['b']
+        ds.save()
+        self.assertEqual(Dataset.objects.get(dataset='lazy').tags, {'a': [1, 2], 'c': 'new'})
+        self.assertEqual(json.loads(str(ds.tags)), {'a': [1, 2], 'c': 'new'})
+
 
 class DatasetModelTests(TestCase):
 
@@ -196,6 +228,36 @@ class DateTimeConversionTests(TestCase):
             dt = datetime_parse(date_string)
             self.assertIsNotNone(dt.tzinfo)
 
+    def test_datetime_parse_matches_strptime(self):
+        from mudata.datetime_parse import datetime_parse, datetime_parse_array
+        from mudata.benchmarks import strptime_parse
+
+        # zero-padded values use the fast path, the others fall back to strptime()
+        values = ['2017-05-09', '2017-05-09 17:25', '2017-05-09 17:25 -0300', '2017-05-09 17:25:48',
+                  '2017-05-09 17:25:48 +0000', '2017-5-9', '2017-05-09 7:25', '2017-05-09 17:25 Z',
+                  '2017-05-09 17:25 +03:00', '2017-05-09 17:25 +0360', '2017-02-30', '2017-05-09 ',
+                  '2017-05-09 17:25:48.5', '2017-05-09 17:25:48.123456 -0500', '2017-05-09 17:25:48.1234567',
+                  '12.5', '-1', '2017', '', '2017-05-09\n', '2017-05-09 17:25\n', '2017-05-09 17:25:48 +0000\n']
+
+        expected = []
+        for value in values:
+            try:
+                expected.append(strptime_parse(value))
+            except ValueError:
+                expected.append(None)
+
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(datetime_parse(value))
+            except ValueError:
+                parsed.append(None)
+
+        self.assertEqual(parsed, expected)
+        self.assertEqual([dt.tzinfo for dt in parsed if dt is not None],
+                         [dt.tzinfo for dt in expected if dt is not None])
+        self.assertEqual(datetime_parse_array(values), expected)
+
 
 class DataRawModelTests(TestCase):
 
@@ -316,3 +378,1556 @@ class ImportFunctionTest(TestCase):
 
         # check for data
         self.assertEqual(len(ds.datum_set.all()), 1364)
+
+
+class BulkImportTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def datum_values(self):
+        return sorted(Datum.objects.values_list('dataset__dataset', 'location__location', 'param__param',
+                                                'x', 'datetime', 'value', 'tags'))
+
+    def test_bulk_import_matches_row_import(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip, engine='row')
+        row_values = self.datum_values()
+        Dataset.objects.all().delete()
+
+        # use a batch size that does not divide the number of rows
+        import_mudata(self.kg_zip, engine='bulk', batch_size=100)
+        self.assertEqual(self.datum_values(), row_values)
+        self.assertEqual(Location.objects.count(), 2)
+        self.assertEqual(Param.objects.count(), 11)
+        self.assertEqual(Column.objects.count(), 21)
+
+    def test_bulk_import_duplicates(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        # metadata is reused but data cannot be imported twice
+        with self.assertRaisesRegex(ValidationError, 'data.csv" on line 2: Datum with this'):
+            import_mudata(self.kg_zip)
+        self.assertEqual(Datum.objects.count(), 1364)
+
+    def test_bad_engine(self):
+        from mudata.io import import_mudata
+        self.assertRaises(ValueError, import_mudata, self.kg_zip, engine='not an engine')
+
+    def test_compressed_and_nested_members(self):
+        import gzip
+        import io
+        import zipfile
+        from mudata.io import import_mudata
+
+        # rewrite the kg archive with tables in a subdirectory and a gzipped data.csv
+        buf = io.BytesIO()
+        with zipfile.ZipFile(self.kg_zip) as src, zipfile.ZipFile(buf, 'w') as dest:
+            for member in src.namelist():
+                if member.endswith('data.csv'):
+                    dest.writestr('kg/data.csv.gz', gzip.compress(src.read(member)))
+                elif member.endswith('.csv'):
+                    dest.writestr('kg/' + member.split('/')[-1], src.read(member))
+        buf.seek(0)
+
+        import_mudata(buf)
+        self.assertEqual(Datum.objects.count(), 1364)
+
+    def test_missing_table(self):
+        import io
+        import zipfile
+        from mudata.io import import_mudata
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as dest:
+            dest.writestr('datasets.csv', 'dataset,tags\n')
+        buf.seek(0)
+        self.assertRaisesRegex(ValueError, '"locations.csv" not found', import_mudata, buf)
+
+    def test_pipelined_import_matches_bulk_import(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip, engine='bulk')
+        bulk_values = self.datum_values()
+        Dataset.objects.all().delete()
+
+        import_mudata(self.kg_zip, engine='pipelined', batch_size=100, workers=2)
+        self.assertEqual(self.datum_values(), bulk_values)
+
+        # errors report the line number in the original file
+        with self.assertRaisesRegex(ValidationError, 'data.csv" on line 2: Datum with this'):
+            import_mudata(self.kg_zip, engine='pipelined', batch_size=100, workers=2)
+
+    def test_pipelined_chunks(self):
+        import io
+        import zipfile
+        from mudata.io import import_mudata, read_table, skip_lines, parse_data, DATA_COLUMNS
+        from mudata.pipeline import read_chunks, parse_data_pipelined
+
+        text = 'a,"b\nc",d\ne,f,g\n\nh,i,j\n'
+        self.assertEqual(list(read_chunks(csv.reader(io.StringIO(text, newline='')), 3)),
+                         [(2, [['a', 'b\nc', 'd'], ['e', 'f', 'g'], []]), (5, [['h', 'i', 'j']])])
+
+        # a quote inside an unquoted field is a literal character, as it is for csv.reader()
+        data = ['dataset,location,param,x,value,tags']
+        data += ['ds,loc,param,%s,%s,' % (x, '5"' if x in (1, 3) else x) for x in range(1, 13)]
+        data[10] = 'ds,loc,param,not an x,1,'
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as dest:
+            dest.writestr('datasets.csv', 'dataset,tags\nds,\n')
+            dest.writestr('locations.csv', 'dataset,location,tags\nds,loc,\n')
+            dest.writestr('params.csv', 'dataset,param,tags\nds,param,\n')
+            dest.writestr('columns.csv', 'dataset,table,column,tags\n')
+            dest.writestr('data.csv', '\n'.join(data) + '\n')
+
+        for engine, kwargs in (('bulk', {}), ('columnar', {}), ('pipelined', {'batch_size': 3, 'workers': 2})):
+            buf.seek(0)
+            with self.assertRaisesRegex(ValidationError, 'data.csv" on line 11:'):
+                import_mudata(buf, engine=engine, **kwargs)
+
+        # resuming skips the same lines as the serial engines
+        data[10] = 'ds,loc,param,10,1,'
+        datasets, locations, params = {'ds': 1}, {(1, 'loc'): 2}, {(1, 'param'): 3}
+        serial = list(parse_data(skip_lines(read_table(io.StringIO('\n'.join(data)), 'data.csv', DATA_COLUMNS), 5),
+                                 datasets, locations, params))
+        pipelined = list(parse_data_pipelined(io.StringIO('\n'.join(data)), datasets, locations, params,
+                                              workers=2, chunk_size=3, resume_from=5))
+        self.assertEqual([line_number for line_number, row in serial], list(range(6, 14)))
+        self.assertEqual(pipelined, serial)
+
+    def test_columnar_import_matches_bulk_import(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip, engine='bulk')
+        bulk_values = self.datum_values()
+        Dataset.objects.all().delete()
+
+        import_mudata(self.kg_zip, engine='columnar', batch_size=100)
+        self.assertEqual(self.datum_values(), bulk_values)
+
+        with self.assertRaisesRegex(ValidationError, 'data.csv" on line 2: Datum with this'):
+            import_mudata(self.kg_zip, engine='columnar')
+
+    def test_columnar_errors(self):
+        from mudata.io import parse_data_columns
+
+        datasets = {'ds': 1}
+        locations = {(1, 'loc'): 2}
+        params = {(1, 'param'): 3}
+
+        def parse(*lines):
+            return parse_data_columns(range(2, len(lines) + 2), list(zip(*lines)), datasets, locations, params)
+
+        rows = parse(('ds', 'loc', 'param', '1', 'NA', '{}'), ('ds', 'loc', 'param', '2', '12', ''))
+        self.assertEqual(rows, [(1, 2, 3, 1.0, None, None, '{}'), (1, 2, 3, 2.0, None, '12', '')])
+
+        # the first bad line is reported
+        with self.assertRaisesRegex(ValidationError, 'line 3: .*float'):
+            parse(('ds', 'loc', 'param', '1', 'NA', '{}'), ('ds', 'loc', 'param', 'x', 'NA', '{}'),
+                  ('ds', 'loc', 'param', '3', 'NA', '{bad json'))
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            parse(('ds', 'not_a_loc', 'param', '1', 'NA', '{}'), ('ds', 'loc', 'param', '2', 'x' * 201, '{}'))
+
+
+class SyntheticDataTest(TestCase):
+
+    def test_generate_and_import(self):
+        import io
+        from mudata.io import import_mudata
+        from mudata.synthetic import generate_mudata
+
+        for x_type, compress in (('datetime', False), ('numeric', True)):
+            buf = io.BytesIO()
+            generate_mudata(buf, n_rows=1003, n_datasets=2, n_locations=3, n_params=4, x_type=x_type,
+                            tag_size=2, compress=compress)
+            buf.seek(0)
+            import_mudata(buf)
+
+            self.assertEqual(Datum.objects.count(), 1003)
+            self.assertEqual(Location.objects.count(), 6)
+            self.assertEqual(Param.objects.count(), 8)
+            self.assertEqual(Datum.objects.filter(datetime__isnull=False).exists(), x_type == 'datetime')
+            self.assertEqual(set(Datum.objects.first().tags), {'tag_0', 'tag_1'})
+            Dataset.objects.all().delete()
+
+    def test_benchmark_synthetic(self):
+        from mudata.benchmarks import benchmark_synthetic
+
+        other = Dataset.objects.create(dataset='other')
+        results = benchmark_synthetic(100, n_locations=2, n_params=2)
+        self.assertEqual([result['benchmark'] for result in results],
+                         ['import'] + ['query'] * 8 + ['view'] * 3)
+        self.assertTrue(all(result['queries'] > 0 for result in results))
+        self.assertGreater(results[0]['rows_per_sec'], 0)
+        # every row is read (the csv has a header line)
+        queries = [result for result in results if result['benchmark'] == 'query']
+        self.assertEqual([result['format'] for result in queries[:2]], ['csv', 'json'])
+        self.assertGreater(queries[0]['bytes'], 100 * 20)
+        self.assertEqual(list(Dataset.objects.all()), [other])
+
+        results = benchmark_synthetic(100, n_locations=2, n_params=2, defer_rollups=True)
+        self.assertEqual([result['benchmark'] for result in results[:2]], ['import', 'rebuild_rollups'])
+        self.assertTrue(results[0]['defer_rollups'])
+        self.assertGreater(results[1]['queries'], 0)
+
+    def test_peak_rss(self):
+        from mudata.benchmarks import measure, reset_peak_rss
+
+        if not reset_peak_rss():
+            self.skipTest('the peak RSS cannot be reset on this platform')
+        result, stats = measure(lambda: len(bytearray(64 * 1024 * 1024)))
+        self.assertGreaterEqual(stats['rss_growth_kb'], 60 * 1024)
+        result, stats = measure(lambda: None)
+        self.assertLess(stats['rss_growth_kb'], 60 * 1024)
+
+
+class ImportReportTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def test_import_report(self):
+        from mudata.io import import_mudata
+
+        for engine in ('bulk', 'columnar', 'row'):
+            calls = []
+            report = import_mudata(self.kg_zip, engine=engine, batch_size=200,
+                                   progress=lambda r: calls.append(r.rows), progress_every=500)
+
+            self.assertEqual(report.rows, 1364)
+            self.assertGreater(report.queries.count, 0)
+            self.assertEqual(list(report.stages)[:6], ['extract', 'datasets.csv', 'locations.csv', 'params.csv',
+                                                       'columns.csv', 'data.csv'])
+            self.assertEqual(report.stages['params.csv'].rows, 11)
+            self.assertEqual(report.stages['data.csv'].rows, 1364)
+            # progress is reported after the write that crosses each multiple of progress_every
+            self.assertEqual(calls, [600, 1000] if engine != 'row' else [500, 1000])
+
+            if engine != 'row':
+                self.assertEqual(report.stages['write'].rows, 1364)
+                self.assertGreater(report.stages['write'].queries, 0)
+                self.assertEqual(report.stages['parse'].queries, 0)
+                self.assertIsNotNone(report.stages['write'].rows_per_sec)
+
+            Dataset.objects.all().delete()
+
+
+class TransactionalImportTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from mudata.synthetic import generate_mudata
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_file = os.path.join(self.tmp_dir.name, 'synthetic.zip')
+        generate_mudata(self.zip_file, n_rows=1000, n_locations=2, n_params=2)
+        self.checkpoint_file = os.path.join(self.tmp_dir.name, 'synthetic.zip.checkpoint')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_abort_rolls_back_metadata(self):
+        from unittest import mock
+        from mudata.io import import_mudata, ImportCheckpoint
+        from mudata.models import LocationTag, Rollup
+
+        # the new dataset is deleted without the cascade collector, which loads every row that
+        # refers to it
+        collect = mock.patch('django.db.models.deletion.Collector.collect', side_effect=AssertionError)
+        self.addCleanup(mock.patch.stopall)
+
+        def abort(report):
+            collect.start()
+            raise KeyboardInterrupt()
+
+        checkpoint = ImportCheckpoint(self.checkpoint_file, self.zip_file)
+        with self.assertRaises(KeyboardInterrupt):
+            import_mudata(self.zip_file, batch_size=100, commit_every=200, checkpoint=checkpoint,
+                          progress=abort, progress_every=500)
+
+        self.assertEqual(Dataset.objects.count(), 0)
+        self.assertEqual(Location.objects.count(), 0)
+        self.assertEqual(LocationTag.objects.count(), 0)
+        self.assertEqual(Datum.objects.count(), 0)
+        self.assertEqual(Rollup.objects.count(), 0)
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_resume_from_checkpoint(self):
+        import io
+        from mudata.io import import_mudata, ImportCheckpoint
+        from mudata.synthetic import generate_mudata
+
+        # create the metadata first, so that nothing is rolled back when the import is
+        # interrupted (which is the state an import is left in after a crash)
+        metadata_only = io.BytesIO()
+        generate_mudata(metadata_only, n_rows=0, n_locations=2, n_params=2)
+        metadata_only.seek(0)
+        import_mudata(metadata_only)
+
+        def crash(report):
+            raise RuntimeError('crash')
+
+        for engine in ('bulk', 'columnar', 'pipelined'):
+            checkpoint = ImportCheckpoint(self.checkpoint_file, self.zip_file)
+            with self.assertRaises(RuntimeError):
+                import_mudata(self.zip_file, engine=engine, batch_size=100, commit_every=200, workers=2,
+                              checkpoint=checkpoint, progress=crash, progress_every=500)
+
+            # the transaction in progress was rolled back and the checkpoint is the last commit
+            self.assertEqual(Datum.objects.count(), 400)
+            self.assertEqual(checkpoint.line, 401)
+
+            report = import_mudata(self.zip_file, engine=engine, batch_size=100, commit_every=200, workers=2,
+                                   checkpoint=checkpoint)
+            self.assertEqual(report.rows, 600)
+            self.assertEqual(Datum.objects.count(), 1000)
+            self.assertFalse(os.path.exists(self.checkpoint_file))
+
+            Datum.objects.all().delete()
+
+    def test_checkpoint_identity(self):
+        from mudata.io import ImportCheckpoint
+        from mudata.synthetic import generate_mudata
+
+        ImportCheckpoint(self.checkpoint_file, self.zip_file).save(10)
+        self.assertEqual(ImportCheckpoint(self.checkpoint_file, self.zip_file).line, 10)
+
+        # a checkpoint for a different data.csv is ignored
+        other_zip = os.path.join(self.tmp_dir.name, 'other.zip')
+        generate_mudata(other_zip, n_rows=1001, n_locations=2, n_params=2)
+        self.assertEqual(ImportCheckpoint(self.checkpoint_file, other_zip).line, 0)
+
+    def test_import_command(self):
+        import io
+        from django.core.management import call_command
+
+        out = io.StringIO()
+        call_command('mudata_import', self.zip_file, '--commit-every', '300', '--progress-every', '500', stdout=out)
+        self.assertEqual(Datum.objects.count(), 1000)
+        self.assertIn('1000 rows (', out.getvalue())
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+
+class IncrementalImportTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from mudata.synthetic import generate_mudata
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_file = os.path.join(self.tmp_dir.name, 'synthetic.zip')
+        generate_mudata(self.zip_file, n_rows=1000, n_locations=2, n_params=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def rewrite(self, edit):
+        """
+        Write a copy of the archive, calling edit with a dict of table name -> list of rows
+        """
+        import csv
+        import io
+        import zipfile
+        from mudata.synthetic import write_table
+
+        with zipfile.ZipFile(self.zip_file) as zip_ref:
+            tables = {name: list(csv.reader(io.StringIO(zip_ref.read(name).decode('utf-8'))))
+                      for name in zip_ref.namelist()}
+        edit(tables)
+        zip_file = os.path.join(self.tmp_dir.name, 'edited.zip')
+        with zipfile.ZipFile(zip_file, 'w') as zip_ref:
+            for name, rows in tables.items():
+                write_table(zip_ref, name, rows[0], rows[1:])
+        return zip_file
+
+    def datum_values(self):
+        return sorted(Datum.objects.values_list('location__location', 'param__param', 'x', 'value', 'tags'))
+
+    def test_unchanged_archive_is_skipped(self):
+        from mudata.io import import_mudata
+
+        report = import_mudata(self.zip_file, incremental=True)
+        self.assertEqual(Datum.objects.count(), 1000)
+        self.assertEqual(report.counts['series_changed'], 4)
+        self.assertEqual(report.counts['rows_inserted'], 1000)
+
+        report = import_mudata(self.zip_file, incremental=True)
+        self.assertEqual(Datum.objects.count(), 1000)
+        self.assertEqual(report.counts['series_unchanged'], 4)
+        self.assertEqual(report.counts['series_changed'], 0)
+        self.assertEqual(report.counts['tables_changed'], 0)
+        self.assertEqual(report.rows, 0)
+        # only hashes and keys are read; nothing is written
+        self.assertLess(report.queries.count, 20)
+
+    def test_changed_rows(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.zip_file, incremental=True)
+
+        def edit(tables):
+            data = tables['data.csv']
+            # change a value in the first series, remove a row from the second and add a row to the third
+            data[1][4] = '1234.5'
+            del data[300]
+            data.append(['synthetic_0', 'location_1', 'param_0', '2010-01-01 00:00:00', '1', '{"flag": "new"}'])
+            tables['locations.csv'][1][2] = '{"label": "edited"}'
+        edited = self.rewrite(edit)
+
+        report = import_mudata(edited, incremental=True)
+        self.assertEqual(report.counts['series_unchanged'], 1)
+        self.assertEqual(report.counts['series_changed'], 3)
+        self.assertEqual(report.counts['rows_updated'], 1)
+        self.assertEqual(report.counts['rows_deleted'], 1)
+        self.assertEqual(report.counts['rows_inserted'], 1)
+        self.assertEqual(report.counts['locations_updated'], 1)
+        self.assertEqual(Location.objects.get(location='location_0').tags, {'label': 'edited'})
+        self.assertEqual(list(Location.objects.get(location='location_0').tag_index.values_list('key', 'value')),
+                         [('label', 'edited')])
+        values = self.datum_values()
+
+        # the result is the same as a full import of the new archive
+        Dataset.objects.all().delete()
+        import_mudata(edited)
+        self.assertEqual(self.datum_values(), values)
+
+    def test_removed_series_and_bulk_import(self):
+        from mudata.io import import_mudata
+        from mudata.models import SeriesHash
+
+        # data written by other engines has no hashes and is compared row by row
+        import_mudata(self.zip_file)
+        self.assertEqual(SeriesHash.objects.count(), 0)
+        report = import_mudata(self.zip_file, incremental=True)
+        self.assertEqual(report.counts['series_changed'], 4)
+        self.assertEqual(report.counts['rows_unchanged'], 1000)
+        self.assertEqual(report.rows, 0)
+        self.assertEqual(SeriesHash.objects.count(), 4)
+
+        def edit(tables):
+            tables['data.csv'] = [row for row in tables['data.csv'] if row[2] != 'param_1']
+        report = import_mudata(self.rewrite(edit), incremental=True)
+        self.assertEqual(report.counts['series_removed'], 2)
+        self.assertEqual(report.counts['rows_deleted'], 500)
+        self.assertFalse(Datum.objects.filter(param__param='param_1').exists())
+        self.assertEqual(SeriesHash.objects.count(), 2)
+
+        # invalid rows in changed series are reported before anything is written
+        def edit(tables):
+            tables['data.csv'][1][3] = 'not a date'
+        with self.assertRaises(ValidationError):
+            import_mudata(self.rewrite(edit), incremental=True)
+        self.assertEqual(Datum.objects.count(), 500)
+
+        with self.assertRaises(ValueError):
+            import_mudata(self.zip_file, engine='row', incremental=True)
+
+    def test_bounded_groups(self):
+        from functools import partial
+        from unittest import mock
+        from mudata import incremental
+        from mudata.io import import_mudata
+
+        counts = {'a': 200, 'b': 200, 'c': 500, 'd': 100}
+        self.assertEqual(list(incremental.series_groups('abcd', counts, max_rows=400)),
+                         [['a', 'b'], ['c'], ['d']])
+        self.assertEqual(list(incremental.series_groups('abcd', counts)), [['a', 'b', 'c', 'd']])
+
+        # each series of 250 rows is parsed and written before the next is read
+        with mock.patch('mudata.incremental.sync_data', partial(incremental.sync_data, max_rows=300)):
+            report = import_mudata(self.zip_file, incremental=True)
+        self.assertEqual(report.counts['series_changed'], 4)
+        self.assertEqual(report.counts['rows_inserted'], 1000)
+        values = self.datum_values()
+
+        Dataset.objects.all().delete()
+        import_mudata(self.zip_file)
+        self.assertEqual(self.datum_values(), values)
+
+
+class ConflictPolicyTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from mudata.synthetic import generate_mudata
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_file = os.path.join(self.tmp_dir.name, 'synthetic.zip')
+        generate_mudata(self.zip_file, n_rows=1000, n_locations=2, n_params=2, seed=1)
+        # an overlapping window: the same first 250 x values of each series, and 250 more
+        self.overlap_file = os.path.join(self.tmp_dir.name, 'overlap.zip')
+        generate_mudata(self.overlap_file, n_rows=2000, n_locations=2, n_params=2, seed=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def datum_values(self):
+        return dict(((loc, param, x), value) for loc, param, x, value in
+                    Datum.objects.values_list('location__location', 'param__param', 'x', 'value'))
+
+    def test_skip_and_replace(self):
+        from mudata.io import import_mudata
+
+        for engine in ('bulk', 'columnar'):
+            import_mudata(self.overlap_file)
+            new_values = self.datum_values()
+            Dataset.objects.all().delete()
+
+            import_mudata(self.zip_file)
+            old_values = self.datum_values()
+            with self.assertRaises(ValidationError):
+                import_mudata(self.overlap_file, engine=engine)
+
+            report = import_mudata(self.overlap_file, engine=engine, on_conflict='skip')
+            self.assertEqual(report.counts, {'rows_inserted': 1000, 'rows_skipped': 1000})
+            values = self.datum_values()
+            self.assertEqual(len(values), 2000)
+            for key, value in old_values.items():
+                self.assertEqual(values[key], value)
+
+            report = import_mudata(self.overlap_file, engine=engine, on_conflict='replace')
+            self.assertEqual(report.counts, {'rows_inserted': 0, 'rows_replaced': 2000})
+            self.assertEqual(self.datum_values(), new_values)
+            Dataset.objects.all().delete()
+
+    def test_staged_errors(self):
+        import io
+        import zipfile
+        from django.core.management import call_command
+        from mudata.io import import_mudata
+
+        # rows that occur more than once in data.csv are still an error
+        buf = io.BytesIO()
+        with zipfile.ZipFile(self.zip_file) as zip_in, zipfile.ZipFile(buf, 'w') as zip_out:
+            for name in zip_in.namelist():
+                content = zip_in.read(name)
+                if name == 'data.csv':
+                    lines = content.splitlines(keepends=True)
+                    content = b''.join(lines[:5] + lines[2:3] + lines[5:])
+                zip_out.writestr(name, content)
+        buf.seek(0)
+        with self.assertRaisesRegex(ValidationError, 'on line 6'):
+            import_mudata(buf, on_conflict='skip')
+
+        import_mudata(self.zip_file)
+        out = io.StringIO()
+        call_command('mudata_import', self.overlap_file, '--on-conflict', 'skip', stdout=out)
+        self.assertIn('rows_skipped', out.getvalue())
+        self.assertEqual(Datum.objects.count(), 2000)
+
+        with self.assertRaises(ValueError):
+            import_mudata(self.zip_file, on_conflict='ignore')
+        with self.assertRaises(ValueError):
+            import_mudata(self.zip_file, engine='row', on_conflict='skip')
+
+
+class ParallelImportTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_dataset_lock(self):
+        from mudata.parallel import DatasetLock
+
+        with DatasetLock('ecclimate', self.tmp_dir.name):
+            self.assertFalse(DatasetLock('ecclimate', self.tmp_dir.name).acquire(blocking=False))
+            other = DatasetLock('other_dataset', self.tmp_dir.name)
+            self.assertTrue(other.acquire(blocking=False))
+            other.release()
+        lock = DatasetLock('ecclimate', self.tmp_dir.name)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_parallel_import_sqlite_wal(self):
+        import sqlite3
+        from django.db import connection
+        from mudata.parallel import import_parallel, archive_datasets
+        from mudata.synthetic import generate_mudata
+
+        if connection.vendor != 'sqlite':
+            self.skipTest('requires sqlite')
+
+        # workers need a database they can share, so copy the (empty, migrated) test database to a
+        # file-backed database in WAL mode
+        db_file = os.path.join(self.tmp_dir.name, 'db.sqlite3')
+        connection.ensure_connection()
+        target = sqlite3.connect(db_file)
+        connection.connection.backup(target)
+        target.execute('PRAGMA journal_mode=WAL')
+        target.close()
+
+        # two archives with overlapping data for synthetic_0 and synthetic_1
+        zip_files = [os.path.join(self.tmp_dir.name, name) for name in ('a.zip', 'b.zip')]
+        generate_mudata(zip_files[0], n_rows=1000, n_datasets=2, n_locations=2, n_params=2)
+        generate_mudata(zip_files[1], n_rows=3000, n_datasets=3, n_locations=2, n_params=2)
+        self.assertEqual(archive_datasets(zip_files[1]), ['synthetic_0', 'synthetic_1', 'synthetic_2'])
+
+        results = import_parallel(zip_files, workers=2, lock_dir=self.tmp_dir.name, on_conflict='skip',
+                                  database={'NAME': db_file, 'OPTIONS': {'timeout': 60}})
+        self.assertEqual(len(results), 5)
+        self.assertEqual([result for result in results if 'error' in result], [])
+
+        target = sqlite3.connect(db_file)
+        counts = dict(target.execute('SELECT d.dataset, COUNT(*) FROM mudata_datum x JOIN mudata_dataset d '
+                                     'ON x.dataset_id = d.id GROUP BY d.dataset').fetchall())
+        target.close()
+        self.assertEqual(counts, {'synthetic_0': 1000, 'synthetic_1': 1000, 'synthetic_2': 1000})
+        # nothing was written to the test database
+        self.assertEqual(Dataset.objects.count(), 0)
+
+        with self.assertRaises(ValueError):
+            import_parallel(zip_files, engine='pipelined')
+
+
+class PartitionImportTest(TestCase):
+    # separate from ParallelImportTest, whose sqlite test copies the test database and cannot run
+    # after a test in the same class has written to it
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_split_archive(self):
+        import zipfile
+        from mudata.io import import_mudata
+        from mudata.parallel import split_archive, archive_datasets, import_partition
+        from mudata.synthetic import generate_mudata
+
+        zip_file = os.path.join(self.tmp_dir.name, 'a.zip')
+        generate_mudata(zip_file, n_rows=600, n_datasets=3, n_locations=2, n_params=2)
+        datasets = archive_datasets(zip_file)
+        partitions = split_archive(zip_file, datasets, os.path.join(self.tmp_dir.name, 'split'))
+        self.assertEqual(list(partitions), datasets)
+
+        with zipfile.ZipFile(zip_file) as zip_ref:
+            original = zip_ref.read('data.csv').decode('utf-8').splitlines()
+        for dataset, partition_file in partitions.items():
+            with zipfile.ZipFile(partition_file) as zip_ref:
+                lines = zip_ref.read('data.csv').decode('utf-8').splitlines()
+            # each row is on the same line as in the original archive
+            self.assertEqual(lines[0], original[0])
+            self.assertEqual([(i, line) for i, line in enumerate(lines) if line][1:],
+                             [(i, line) for i, line in enumerate(original) if line.startswith(dataset + ',')])
+            import_mudata(partition_file, dataset_slugs=[dataset])
+        self.assertEqual(Datum.objects.count(), 600)
+
+        # errors, including unexpected ones, are recorded in the partition's result
+        result = import_partition(zip_file, datasets[0], self.tmp_dir.name, {}, partitions[datasets[0]])
+        self.assertIn('already exists', result['error'])
+        result = import_partition(zip_file, datasets[0], self.tmp_dir.name, {'not_an_argument': True})
+        self.assertTrue(result['error'].startswith('TypeError: '))
+
+    def test_import_command_locks_datasets(self):
+        from io import StringIO
+        from unittest import mock
+        from django.core.management import call_command
+        from mudata.parallel import DatasetLock, archive_datasets, lock_datasets
+
+        with lock_datasets(['ecclimate', 'other'], self.tmp_dir.name):
+            self.assertFalse(DatasetLock('ecclimate', self.tmp_dir.name).acquire(blocking=False))
+            self.assertFalse(DatasetLock('other', self.tmp_dir.name).acquire(blocking=False))
+
+        kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+        with mock.patch('mudata.management.commands.mudata_import.lock_datasets', wraps=lock_datasets) as locked:
+            call_command('mudata_import', kg_zip, '--lock-dir', self.tmp_dir.name, stdout=StringIO())
+        locked.assert_called_once_with(archive_datasets(kg_zip), self.tmp_dir.name)
+        self.assertTrue(Datum.objects.exists())
+
+
+class ExportTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def datum_values(self):
+        return sorted(Datum.objects.values_list('dataset__dataset', 'location__location', 'param__param',
+                                                'x', 'datetime', 'value', 'tags'))
+
+    def test_export_round_trip(self):
+        import io
+        from mudata.io import import_mudata, export_mudata
+
+        import_mudata(self.kg_zip)
+        values = self.datum_values()
+        location_tags = dict(Location.objects.values_list('location', 'tags'))
+        n_columns = Column.objects.count()
+
+        buf = io.BytesIO()
+        export_mudata(buf, datasets=Dataset.objects.filter(dataset='ecclimate'), chunk_size=100)
+        Dataset.objects.all().delete()
+
+        buf.seek(0)
+        import_mudata(buf)
+        self.assertEqual(self.datum_values(), values)
+        self.assertEqual(dict(Location.objects.values_list('location', 'tags')), location_tags)
+        self.assertEqual(Column.objects.count(), n_columns)
+
+    def test_export_round_trip_dst(self):
+        import io
+        from datetime import datetime, timedelta, timezone as dt_timezone
+        from django.utils import timezone
+        from mudata.io import import_mudata, export_mudata
+
+        ds = Dataset.objects.create(dataset='ds')
+        location = Location.objects.create(dataset=ds, location='loc')
+        param = Param.objects.create(dataset=ds, param='param')
+        # 00:30, 01:30 CDT and 01:30 CST as the clocks go back, then a time with fractional seconds
+        times = [datetime(2017, 11, 5, 5, 30, tzinfo=dt_timezone.utc) + timedelta(hours=i) for i in range(3)]
+        times.append(datetime(2017, 11, 5, 8, 0, 0, 250000, tzinfo=dt_timezone.utc))
+        for i, dt in enumerate(times):
+            Datum.objects.create(dataset=ds, location=location, param=param, x=dt.timestamp(), datetime=dt,
+                                 value=str(i))
+        values = self.datum_values()
+
+        with timezone.override('America/Chicago'):
+            buf = io.BytesIO()
+            export_mudata(buf, datasets=Dataset.objects.filter(dataset='ds'))
+            Dataset.objects.all().delete()
+            buf.seek(0)
+            import_mudata(buf)
+        self.assertEqual(self.datum_values(), values)
+
+    def test_export_views(self):
+        import io
+        import zipfile
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        factory = RequestFactory()
+
+        response = views.export_dataset(factory.get('/export/'), 'ecclimate')
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zip_ref:
+            self.assertEqual(len(zip_ref.read('data.csv').decode('utf-8').splitlines()), 1365)
+
+        # only the metadata that the query refers to is exported
+        response = views.export_query(factory.get('/export/', {'locations': 'GREENWOOD_A', 'params': 'maxtemp'}))
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zip_ref:
+            self.assertEqual(len(zip_ref.read('locations.csv').decode('utf-8').splitlines()), 2)
+            self.assertEqual(len(zip_ref.read('params.csv').decode('utf-8').splitlines()), 2)
+            self.assertEqual(len(zip_ref.read('data.csv').decode('utf-8').splitlines()),
+                             Datum.objects.filter(location__location='GREENWOOD_A', param__param='maxtemp').count() + 1)
+
+    def test_query_formats(self):
+        import csv
+        import json
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.io import import_mudata, stream_data
+
+        import_mudata(self.kg_zip)
+        factory = RequestFactory()
+        query = {'locations': 'GREENWOOD_A', 'params': 'maxtemp'}
+        n_rows = Datum.objects.filter(location__location='GREENWOOD_A', param__param='maxtemp').count()
+
+        response = views.query(factory.get('/query/', query), 'json')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(rows), n_rows)
+        self.assertEqual(set(rows[0]), {'dataset', 'location', 'param', 'x', 'datetime', 'value', 'tags'})
+        self.assertEqual((rows[0]['location'], rows[0]['param']), ('GREENWOOD_A', 'maxtemp'))
+
+        response = views.query(factory.get('/query/', query), 'ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], rows)
+
+        response = views.query(factory.get('/query/', query), 'csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(lines[0], ['dataset', 'location', 'param', 'x', 'value', 'tags'])
+        self.assertEqual(len(lines), n_rows + 1)
+
+        # rows are fetched and written in chunks
+        self.assertEqual(len(list(stream_data(Datum.objects.all(), 'json', chunk_size=100))),
+                         -(-Datum.objects.count() // 100) + 1)
+        self.assertEqual(json.loads(''.join(stream_data(Datum.objects.none(), 'json'))), [])
+        with self.assertRaises(ValueError):
+            list(stream_data(Datum.objects.all(), 'xml'))
+
+    def test_query_pages(self):
+        import json
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        factory = RequestFactory()
+        # in the default order, and in x order (for a range of x alone)
+        for query in ({'locations': 'GREENWOOD_A'}, {'datetime_from': '1999-08-01'}):
+            response = views.query(factory.get('/query/', query), 'json')
+            all_rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+            self.assertGreater(len(all_rows), 250)
+
+            rows = []
+            cursor = None
+            n_pages = 0
+            while True:
+                page_query = dict(query, limit=250, **({} if cursor is None else {'cursor': cursor}))
+                response = views.query(factory.get('/query/', page_query), 'json')
+                page = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+                self.assertLessEqual(len(page), 250)
+                rows.extend(page)
+                n_pages += 1
+                if not response.has_header('X-Next-Cursor'):
+                    break
+                cursor = response['X-Next-Cursor']
+            self.assertEqual(rows, all_rows)
+            self.assertEqual(n_pages, -(-len(all_rows) // 250))
+        self.assertEqual([row['x'] for row in all_rows], sorted(row['x'] for row in all_rows))
+
+        # each page is a single query that seeks past the cursor
+        with self.assertNumQueries(1):
+            views.query_page(Datum.objects.all(), {'limit': '10', 'cursor': cursor})
+
+        for bad_query in ({'limit': 'ten'}, {'limit': '0'}, {'cursor': 'not a cursor'},
+                          {'cursor': views.encode_cursor([1, 2, 3])}):
+            with self.assertRaises(ValueError):
+                views.query(factory.get('/query/', bad_query), 'json')
+
+    def test_query_x_range(self):
+        from mudata import views
+
+        # an x of 0 is a bound like any other
+        self.assertEqual(views.query_filters({'x_from': '0', 'x_to': '0'}), {'x__gte': 0, 'x__lte': 0})
+        self.assertEqual(views.query_filters({'x_from': '-1.5'}), {'x__gte': -1.5})
+
+
+class SlugCacheTest(TestCase):
+
+    def setUp(self):
+        from mudata.slugs import SlugCache
+
+        self.cache = SlugCache(max_datasets=2)
+        self.datasets = [Dataset.objects.create(dataset='ds%s' % i) for i in range(3)]
+        self.locations = {(ds.dataset, slug): Location.objects.create(dataset=ds, location=slug).id
+                          for ds in self.datasets for slug in ('A', 'B')}
+        self.params = {ds.dataset: Param.objects.create(dataset=ds, param='temp').id for ds in self.datasets}
+
+    def test_resolve(self):
+        from mudata.slugs import UnknownDataset
+
+        # one query per table, then only the datasets
+        with self.assertNumQueries(3):
+            ids = self.cache.resolve(['ds0', 'ds1'], ['A', 'B'], ['temp'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cache.resolve(['ds0', 'ds1'], ['A', 'B'], ['temp']), ids)
+
+        # slugs are combined as a union
+        self.assertEqual(ids, ([self.datasets[0].id, self.datasets[1].id],
+                               sorted(self.locations[ds, slug] for ds in ('ds0', 'ds1') for slug in ('A', 'B')),
+                               [self.params['ds0'], self.params['ds1']]))
+
+        # without datasets, slugs are looked up in every dataset (and only 2 datasets are cached)
+        self.assertEqual(self.cache.resolve([], ['A'], [])[1], sorted(self.locations[ds.dataset, 'A']
+                                                                      for ds in self.datasets))
+        self.assertEqual(len(self.cache.datasets), 2)
+
+        with self.assertRaises(UnknownDataset):
+            self.cache.resolve(['ds0', 'not_a_dataset'])
+        self.assertEqual(self.cache.resolve(['ds0'], ['not_a_location'])[1], [])
+
+    def test_invalidation(self):
+        from mudata.slugs import slug_cache
+
+        slug_cache.clear()
+        slug_cache.resolve(['ds0'], ['A'])
+
+        # objects created without signals are found when a slug is missing
+        Location.objects.bulk_create([Location(dataset=self.datasets[0], location='C')])
+        with self.assertNumQueries(3):
+            location_ids = slug_cache.resolve(['ds0'], ['C'])[1]
+        self.assertEqual(location_ids, list(Location.objects.filter(location='C').values_list('id', flat=True)))
+
+        # saving or deleting invalidates the dataset
+        Location.objects.filter(location='C').delete()
+        self.assertNotIn(self.datasets[0].id, slug_cache.datasets)
+        self.assertEqual(slug_cache.resolve(['ds0'], ['C'])[1], [])
+
+        # slugs that are still missing after a reload are remembered
+        with self.assertNumQueries(1):
+            self.assertEqual(slug_cache.resolve(['ds0'], ['C'])[1], [])
+
+    def test_replaced_by_another_process(self):
+        from mudata.drop import delete_dataset_rows
+        from mudata.slugs import UnknownDataset
+
+        self.cache.resolve(['ds0', 'ds1'], ['A'], ['temp'])
+
+        # delete_dataset_rows() and bulk_create() send no signals, as if another process had
+        # replaced ds0 and dropped ds1
+        delete_dataset_rows(self.datasets[0].id, {})
+        delete_dataset_rows(self.datasets[1].id, {})
+        Dataset.objects.bulk_create([Dataset(dataset='ds0')])
+        ds = Dataset.objects.get(dataset='ds0')
+        Location.objects.bulk_create([Location(dataset=ds, location='A')])
+        Param.objects.bulk_create([Param(dataset=ds, param='temp')])
+
+        self.assertEqual(self.cache.resolve(['ds0'], ['A'], ['temp']),
+                         ([ds.id], [Location.objects.get(dataset=ds).id], [Param.objects.get(dataset=ds).id]))
+        with self.assertRaises(UnknownDataset):
+            self.cache.resolve(['ds1'], ['A'])
+
+    def test_query_data(self):
+        from django.http import Http404
+        from mudata import views
+
+        views.slug_cache.clear()
+        query_params = {'datasets': 'ds0 ds1', 'locations': ' '.join('ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
+                        'params': 'temp'}
+        with self.assertNumQueries(3):
+            query_set = views.query_data(query_params)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(query_set), [])
+        with self.assertNumQueries(1):
+            views.query_data(query_params)
+        with self.assertRaises(Http404):
+            views.query_data({'datasets': 'not_a_dataset'})
+
+    def test_signals_connected_without_admin(self):
+        import subprocess
+        import sys
+
+        # a project that uses only the models (the signals used to be connected as a side effect
+        # of importing the admin, views or io modules)
+        script = """
+import django, sys
+from django.conf import settings
+settings.configure(INSTALLED_APPS=['mudata'], USE_TZ=True,
+                   DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+django.setup()
+from django.core.management import call_command
+call_command('migrate', verbosity=0)
+from mudata.models import Dataset, Location, LocationTag, LocationPoint
+from mudata.slugs import slug_cache
+ds = Dataset.objects.create(dataset='ds')
+slug_cache.resolve(['ds'])
+Location.objects.create(dataset=ds, location='loc', tags={'region': 'north', 'lat': 45, 'lon': -63})
+assert ds.id not in slug_cache.datasets
+assert list(LocationTag.objects.values_list('key', flat=True).order_by('key')) == ['lat', 'lon', 'region']
+assert LocationPoint.objects.count() == 1
+assert not any(name.startswith(('mudata.admin', 'mudata.views', 'mudata.io')) for name in sys.modules)
+"""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        result = subprocess.run([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+
+class QueryPlanTest(TestCase):
+
+    # the common filter shapes of views.query (the synthetic series below have x values from
+    # 00:00 to 00:09 on 2000-01-01)
+    filters = [
+        {'datasets': 'synthetic_1'},
+        {'locations': 'location_1'},
+        {'params': 'param_1'},
+        {'locations': 'location_1 location_2', 'params': 'param_1'},
+        {'datetime_from': '2000-01-01 00:08'},
+        {'datetime_from': '2000-01-01 00:02', 'datetime_to': '2000-01-01 00:03'},
+        {'locations': 'location_1', 'datetime_from': '2000-01-01 00:08'},
+        {'params': 'param_1', 'datetime_from': '2000-01-01 00:02', 'datetime_to': '2000-01-01 00:03'},
+        {'datasets': 'synthetic_1', 'params': 'param_1', 'datetime_from': '2000-01-01 00:08'},
+        {'params': 'param_1', 'value_min': '30'},
+    ]
+
+    def test_no_sequential_scans(self):
+        import io
+        import re
+        from django.db import connection
+        from mudata import views
+        from mudata.io import import_mudata
+        from mudata.synthetic import generate_mudata
+
+        if connection.vendor == 'sqlite':
+            # 'SCAN mudata_datum USING INDEX ...' walks a whole index, which is no better than
+            # walking the table
+            sequential_scan = re.compile(r'\bSCAN (TABLE )?mudata_datum\b')
+        elif connection.vendor == 'postgresql':
+            sequential_scan = re.compile(r'\bSeq Scan on mudata_datum\b')
+        else:
+            self.skipTest('requires sqlite or postgresql')
+
+        generated = io.BytesIO()
+        generate_mudata(generated, n_rows=40000, n_datasets=2, n_locations=50, n_params=40)
+        generated.seek(0)
+        import_mudata(generated)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            if connection.vendor == 'postgresql':
+                # a table this small is cheap to scan, so check that an index could be used instead
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+        scans = []
+        for query_params in self.filters:
+            # unordered, and in the order used by the query endpoint
+            ordering = views.query_ordering(views.query_filters(query_params))
+            for query_set in (views.query_data(query_params), views.query_data(query_params).order_by(*ordering)):
+                plan = query_set.explain()
+                if sequential_scan.search(plan):
+                    scans.append('%s:\n%s' % (query_params, plan))
+        self.assertEqual(scans, [], '\n'.join(scans))
+
+
+class PlotTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def test_lttb(self):
+        from mudata.downsample import lttb
+
+        points = [(x, 0.0) for x in range(100)]
+        points[37] = (37, 10.0)
+        selected = list(lttb(iter(points), len(points), 10))
+        self.assertEqual(len(selected), 10)
+        self.assertEqual((selected[0], selected[-1]), (points[0], points[-1]))
+        self.assertIn((37, 10.0), selected)
+        self.assertEqual(selected, sorted(selected))
+
+        self.assertEqual(list(lttb(iter(points[:5]), 5, 10)), points[:5])
+        # fewer points than expected
+        self.assertEqual(list(lttb(iter(points[:50]), 100, 10))[0], points[0])
+
+    def test_minmax(self):
+        from mudata.downsample import downsample_minmax
+
+        ds = Dataset.objects.create(dataset='ds')
+        location = Location.objects.create(dataset=ds, location='loc')
+        param = Param.objects.create(dataset=ds, param='param')
+        # two buckets: the maximum comes before the minimum in the first, and the second is flat
+        values = {0: 5, 1: 9, 2: 1, 3: 9, 4: 2, 5: 3, 6: 3, 7: 3, 8: 3, 9: 3}
+        Datum.objects.bulk_create([Datum(dataset=ds, location=location, param=param, x=x, value=str(value),
+                                         value_num=value) for x, value in values.items()])
+
+        self.assertEqual(downsample_minmax(Datum.objects.all(), width=2),
+                         {(location.id, param.id): [[1, 9], [2, 1], [5, 3]]})
+
+    def test_plot(self):
+        import json
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        factory = RequestFactory()
+        query = {'params': 'maxtemp mintemp'}
+        n_rows = Datum.objects.filter(param__param='maxtemp', location__location='GREENWOOD_A',
+                                      value__isnull=False).count()
+
+        for method in ('minmax', 'lttb'):
+            response = views.plot(factory.get('/plot/', dict(query, method=method, width=20)), 'json')
+            result = json.loads(response.content.decode('utf-8'))
+            self.assertEqual((result['method'], result['width']), (method, 20))
+            self.assertEqual(len(result['series']), 4)
+            for series in result['series']:
+                self.assertIn(series['param'], ('maxtemp', 'mintemp'))
+                self.assertLessEqual(len(series['points']), 40 if method == 'minmax' else 20)
+                self.assertEqual(series['points'], sorted(series['points']))
+
+            # points are rows of the series (lttb selects rows, minmax selects the rows with the
+            # minimum and maximum value of each bucket)
+            series = [s for s in result['series'] if (s['location'], s['param']) == ('GREENWOOD_A', 'maxtemp')][0]
+            rows = dict((x, float(value)) for x, value in
+                        Datum.objects.filter(location__location='GREENWOOD_A', param__param='maxtemp',
+                                             value__isnull=False).values_list('x', 'value'))
+            for x, y in series['points']:
+                self.assertEqual(rows[x], y)
+
+        # the extremes of each series are kept by minmax
+        response = views.plot(factory.get('/plot/', dict(query, width=20)), 'json')
+        series = [s for s in json.loads(response.content.decode('utf-8'))['series']
+                  if (s['location'], s['param']) == ('GREENWOOD_A', 'maxtemp')][0]
+        values = [float(v) for v in Datum.objects.filter(location__location='GREENWOOD_A', param__param='maxtemp',
+                                                         value__isnull=False).values_list('value', flat=True)]
+        self.assertEqual(len(values), n_rows)
+        self.assertEqual(min(y for x, y in series['points']), min(values))
+        self.assertEqual(max(y for x, y in series['points']), max(values))
+
+        for bad_query in ({'method': 'mean'}, {'width': '2'}, {'width': 'wide'}):
+            with self.assertRaises(ValueError):
+                views.plot(factory.get('/plot/', bad_query), 'json')
+
+
+class AggregateTest(TestCase):
+
+    def setUp(self):
+        import io
+        from mudata.io import import_mudata
+        from mudata.synthetic import generate_mudata
+
+        # 2 series of 6000 rows, one minute apart from 2000-01-01 00:00 UTC (about 4 days)
+        generated = io.BytesIO()
+        generate_mudata(generated, n_rows=12000, n_datasets=1, n_locations=2, n_params=1, na_fraction=0.1)
+        generated.seek(0)
+        import_mudata(generated)
+
+    def test_resample(self):
+        from mudata.aggregate import Resample
+
+        self.assertEqual((Resample('1h').width, Resample('1h').datetime), (3600, True))
+        self.assertEqual(Resample('15min').width, 900)
+        self.assertEqual(Resample('D').width, 86400)
+        self.assertEqual((Resample('3M').width, Resample('3M').calendar), (3, True))
+        self.assertEqual(Resample('Y').width, 12)
+        self.assertEqual((Resample('2.5').width, Resample('2.5').datetime), (2.5, False))
+        for bad in ('', 'h1', '0h', '1.5M', 'week'):
+            with self.assertRaises(ValueError):
+                Resample(bad)
+
+    def test_aggregate_query(self):
+        import csv
+        import json
+        from collections import defaultdict
+        from django.test import RequestFactory
+        from mudata import views
+
+        factory = RequestFactory()
+        expected = defaultdict(list)
+        for location, dt, value in Datum.objects.exclude(value=None) \
+                .values_list('location__location', 'datetime', 'value'):
+            expected[location, dt.date().isoformat()].append(float(value))
+        self.assertEqual(len(expected), 2 * 5)
+
+        # one query for the aggregates and one to check that their rollups are current
+        with self.assertNumQueries(2):
+            response = views.query(factory.get('/query/', {'resample': '1D', 'agg': 'mean,min,max,count'}), 'json')
+            rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(rows), len(expected))
+        for row in rows:
+            values = expected[row['location'], row['datetime'][:10]]
+            self.assertEqual(row['count'], len(values))
+            self.assertAlmostEqual(row['mean'], sum(values) / len(values))
+            self.assertEqual((row['min'], row['max']), (min(values), max(values)))
+            self.assertEqual(row['datetime'][10:], 'T00:00:00+00:00')
+
+        response = views.query(factory.get('/query/', {'resample': 'M', 'agg': 'count',
+                                                       'locations': 'location_0'}), 'csv')
+        lines = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(lines[0], ['dataset', 'location', 'param', 'x', 'datetime', 'count'])
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(int(lines[1][-1]), sum(len(v) for (loc, day), v in expected.items() if loc == 'location_0'))
+
+        for bad_query in ({'resample': '1D', 'agg': 'median'}, {'resample': 'fortnight'},
+                          {'resample': '1D', 'limit': '10'}):
+            with self.assertRaises(ValueError):
+                views.query(factory.get('/query/', bad_query), 'json')
+
+
+class RollupTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from mudata.synthetic import generate_mudata
+
+        # 4 series of 1500 rows, one minute apart from 2000-01-01 00:00 UTC
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_file = os.path.join(self.tmp_dir.name, 'synthetic.zip')
+        generate_mudata(self.zip_file, n_rows=6000, n_locations=2, n_params=2, na_fraction=0.1)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertRollupsCurrent(self):
+        """
+        Check that the rollups are the same as rebuilt rollups
+        """
+        from mudata.models import Rollup
+        from mudata.rollups import rebuild_rollups
+
+        def rollups():
+            return sorted(Rollup.objects.values_list('location_id', 'param_id', 'resolution', 'period', 'n', 'total',
+                                                     'minimum', 'maximum'))
+        current = rollups()
+        rebuild_rollups()
+        self.assertEqual(current, rollups())
+        return current
+
+    def test_imports_update_rollups(self):
+        from mudata.io import import_mudata
+        from mudata.rollups import delete_data
+
+        for engine, kwargs in (('bulk', {'commit_every': 2000}), ('columnar', {}), ('row', {}),
+                               ('bulk', {'incremental': True})):
+            import_mudata(self.zip_file, engine=engine, **kwargs)
+            rollups = self.assertRollupsCurrent()
+            # 25 hours, 2 days and 1 month of each series
+            self.assertEqual(len(rollups), 4 * (25 + 2 + 1))
+            self.assertEqual(sum(row[4] for row in rollups if row[2] == 'D'),
+                             Datum.objects.exclude(value=None).count())
+            Dataset.objects.all().delete()
+
+        import_mudata(self.zip_file)
+        delete_data(Datum.objects.filter(location__location='location_0', x__lt=946690000))
+        self.assertRollupsCurrent()
+        import_mudata(self.zip_file, on_conflict='replace')
+        self.assertRollupsCurrent()
+
+    def test_query_from_rollups(self):
+        import json
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.aggregate import Resample, aggregate_rows
+        from mudata.io import import_mudata
+        from mudata.rollups import rollup_resolution, rollup_rows
+
+        import_mudata(self.zip_file)
+        self.assertEqual(rollup_resolution(Resample('1D')), 'D')
+        self.assertEqual(rollup_resolution(Resample('2h')), 'h')
+        self.assertEqual(rollup_resolution(Resample('W')), 'D')
+        self.assertIsNone(rollup_resolution(Resample('15min')))
+        self.assertIsNone(rollup_resolution(Resample('3600')))
+
+        factory = RequestFactory()
+        for query in ({'resample': 'D'}, {'resample': '2h', 'params': 'param_1'},
+                      {'resample': 'M', 'locations': 'location_0'},
+                      {'resample': 'h', 'datetime_from': '2000-01-01 05:30', 'datetime_to': '2000-01-01 20:10'}):
+            filters = views.query_filters(query)
+            resample = Resample(query['resample'])
+            aggs = ('mean', 'min', 'max', 'sum', 'count')
+            expected = list(aggregate_rows(Datum.objects.filter(**filters), resample, aggs))
+            rows = list(rollup_rows(filters, resample, aggs))
+            self.assertEqual([row[:5] for row in rows], [row[:5] for row in expected])
+            for row, expected_row in zip(rows, expected):
+                for value, expected_value in zip(row[5:], expected_row[5:]):
+                    self.assertAlmostEqual(value, expected_value)
+
+        # a query without x limits reads only the rollups (after checking that they are current)
+        with self.assertNumQueries(2):
+            response = views.query(factory.get('/query/', {'resample': 'D', 'agg': 'count'}), 'json')
+            rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(sum(row['count'] for row in rows), Datum.objects.exclude(value=None).count())
+
+    def test_deferred_rollups(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from mudata.aggregate import Resample
+        from mudata.io import import_mudata
+        from mudata.models import Rollup
+        from mudata.rollups import rollup_rows, stale_datasets
+
+        for kwargs in ({'engine': 'columnar', 'commit_every': 2000}, {'incremental': True}):
+            import_mudata(self.zip_file, defer_rollups=True, **kwargs)
+            self.assertFalse(Rollup.objects.exists())
+            self.assertEqual(stale_datasets(), list(Dataset.objects.values_list('id', flat=True)))
+            # stale rollups are not used
+            self.assertIsNone(rollup_rows({}, Resample('D')))
+
+            call_command('mudata_rebuild_rollups', '--stale', stdout=StringIO())
+            self.assertEqual(stale_datasets(), [])
+            self.assertEqual(len(self.assertRollupsCurrent()), 4 * (25 + 2 + 1))
+            self.assertIsNotNone(rollup_rows({}, Resample('D')))
+            Dataset.objects.all().delete()
+
+
+class NumericValueTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def assertValueNumsMatch(self):
+        from mudata.models import numeric_value
+
+        rows = list(Datum.objects.values_list('value', 'value_num'))
+        self.assertTrue(any(value_num is not None for value, value_num in rows))
+        self.assertEqual([value_num for value, value_num in rows], [numeric_value(value) for value, _ in rows])
+
+    def test_numeric_value(self):
+        from mudata.models import numeric_value
+
+        self.assertEqual([numeric_value(value) for value in ('12', '-1.5', '.5', '+3e2', '1.')],
+                         [12.0, -1.5, 0.5, 300.0, 1.0])
+        for value in (None, '', 'NA', 'nan', 'inf', ' 1', '1,5', '0x10', '1_000'):
+            self.assertIsNone(numeric_value(value))
+
+    def test_import_and_migration(self):
+        import importlib
+        from django.apps import apps
+        from mudata.io import import_mudata
+
+        for engine, kwargs in (('bulk', {}), ('columnar', {}), ('row', {}), ('columnar', {'on_conflict': 'skip'})):
+            import_mudata(self.kg_zip, engine=engine, **kwargs)
+            self.assertValueNumsMatch()
+            Dataset.objects.all().delete()
+
+        import_mudata(self.kg_zip)
+        Datum.objects.update(value_num=None)
+        importlib.import_module('mudata.migrations.0005_datum_value_num').fill_value_num(apps, None)
+        self.assertValueNumsMatch()
+
+    def test_value_filters(self):
+        from django.test import RequestFactory
+        from mudata import views
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        factory = RequestFactory()
+        expected = sorted(pk for pk, value in Datum.objects.filter(param__param='maxtemp').values_list('pk', 'value')
+                          if value is not None and 20 <= float(value) <= 25)
+        self.assertTrue(expected)
+        query_set = views.query_data({'params': 'maxtemp', 'value_min': '20', 'value_max': '25'})
+        self.assertEqual(sorted(query_set.values_list('pk', flat=True)), expected)
+
+        with self.assertRaises(ValueError):
+            views.query(factory.get('/query/', {'value_min': 'warm'}), 'json')
+
+
+class TagIndexTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def test_index_is_maintained(self):
+        from mudata.io import import_mudata
+        from mudata.models import LocationTag, ParamTag
+        from mudata.tagindex import rebuild_tag_index
+
+        def indexed():
+            return (sorted(LocationTag.objects.values_list('location__location', 'key', 'value')),
+                    sorted(ParamTag.objects.values_list('param__param', 'key', 'value')))
+
+        for engine in ('bulk', 'row'):
+            import_mudata(self.kg_zip, engine=engine)
+            locations, params = indexed()
+            self.assertIn(('GREENWOOD_A', 'tcid', 'YZX'), locations)
+            self.assertIn(('GREENWOOD_A', 'stationid', '6354'), locations)
+            self.assertIn(('maxtemp', 'label', 'Max Temp (C)'), params)
+            self.assertEqual(indexed(), (locations, params))
+            rebuild_tag_index()
+            self.assertEqual(indexed(), (locations, params))
+            Dataset.objects.all().delete()
+            self.assertEqual(LocationTag.objects.count(), 0)
+
+        location = Location.objects.create(dataset=Dataset.objects.create(dataset='ds'), location='loc',
+                                           tags={'region': 'north', 'height': 3, 'nested': {'a': 1}})
+        self.assertEqual(sorted(LocationTag.objects.values_list('key', 'value')), [('height', '3'), ('region', 'north')])
+        location.tags = {'region': 'south'}
+        location.save()
+        self.assertEqual(list(LocationTag.objects.values_list('key', 'value')), [('region', 'south')])
+
+    def test_tag_filters(self):
+        from django.test import RequestFactory
+        from django.http import QueryDict
+        from mudata import views
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        greenwood = Datum.objects.filter(location__location='GREENWOOD_A')
+        query_set = views.query_data({'location_tag__tcid': 'YZX'})
+        self.assertEqual(query_set.count(), greenwood.count())
+
+        query_set = views.query_data(QueryDict('location_tag__tcid=YZX&location_tag__tcid=XKT&'
+                                               'param_tag__label=Max+Temp+(C)&locations=GREENWOOD_A'))
+        self.assertEqual(query_set.count(), greenwood.filter(param__param='maxtemp').count())
+        self.assertEqual(views.query_data({'location_tag__tcid': 'YZX', 'location_tag__province': 'ALBERTA'}).count(), 0)
+
+        response = views.view_dataset(RequestFactory().get('/view/', {'location_tag__tcid': 'XKT'}), 'ecclimate')
+        self.assertIn(b'KENTVILLE_CDA_CS', response.content)
+        self.assertNotIn(b'GREENWOOD_A', response.content)
+
+
+class SpatialTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def test_spatial_filters(self):
+        from mudata import views
+        from mudata.io import import_mudata
+        from mudata.models import LocationPoint
+
+        import_mudata(self.kg_zip)
+        self.assertEqual(sorted(LocationPoint.objects.values_list('location__location', 'latitude', 'longitude')),
+                         [('GREENWOOD_A', 44.98, -64.92), ('KENTVILLE_CDA_CS', 45.07, -64.48)])
+
+        greenwood = Datum.objects.filter(location__location='GREENWOOD_A')
+        self.assertEqual(views.query_data({'bbox': '-65,44,-64.7,46'}).count(), greenwood.count())
+        self.assertEqual(views.query_data({'bbox': '-64,44,-63,46'}).count(), 0)
+        self.assertEqual(views.query_data({'datasets': 'ecclimate', 'near': '44.9,-65'}).count(), greenwood.count())
+        self.assertEqual(views.query_data({'near': '44.9,-65', 'k': '2', 'params': 'maxtemp'}).count(),
+                         Datum.objects.filter(param__param='maxtemp').count())
+        self.assertEqual(views.query_data({'near': '44.9,-65', 'location_tag__tcid': 'XKT'}).count(),
+                         Datum.objects.filter(location__location='KENTVILLE_CDA_CS').count())
+        for query in ({'bbox': '-65,44,-64'}, {'bbox': '-65,46,-64,44'}, {'near': '95,0'}, {'k': '2'},
+                      {'near': '45,-65', 'k': '0'}):
+            with self.assertRaises(ValueError):
+                views.query_data(query)
+
+        # the index follows changes to tags
+        location = Location.objects.get(location='GREENWOOD_A')
+        location.tags = {'lat': '10', 'lon': '20'}
+        location.save()
+        self.assertEqual((location.point.latitude, location.point.longitude), (10, 20))
+        location.tags = {'name': 'nowhere'}
+        location.save()
+        self.assertFalse(LocationPoint.objects.filter(location=location).exists())
+
+    def test_nearest(self):
+        import random
+        from mudata.spatial import distance, in_bbox, nearest
+
+        rand = random.Random(42)
+        ds = Dataset.objects.create(dataset='ds')
+        points = [(rand.uniform(-90, 90), rand.uniform(-180, 180)) for i in range(200)] + \
+                 [(89.5, 10), (-89.5, -170), (0, 179.9), (0, -179.9)]
+        for i, (lat, lon) in enumerate(points):
+            Location.objects.create(dataset=ds, location='loc%s' % i, tags={'latitude': lat, 'longitude': lon})
+        locations = Location.objects.all()
+        coords = {loc.id: (loc.tags['latitude'], loc.tags['longitude']) for loc in locations}
+
+        for lat, lon in ((0, 180), (0, -180), (90, 0), (-90, 45), (45, -64), (10, 10)):
+            for k in (1, 5, 50):
+                expected = sorted(coords, key=lambda pk: distance(lat, lon, *coords[pk]))[:k]
+                self.assertEqual(nearest(locations, lat, lon, k), expected)
+
+        # boxes that cross the antimeridian
+        inside = set(in_bbox(locations, (170, -10, -170, 10)).values_list('id', flat=True))
+        self.assertEqual(inside, set(pk for pk, (lat, lon) in coords.items()
+                                     if -10 <= lat <= 10 and (lon >= 170 or lon <= -170)))
+
+
+class AdminTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip)
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_datum_changelist(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+
+        # the number of queries does not depend on the number of rows on the page
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:mudata_datum_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 15)
+        self.assertIn(b'KENTVILLE_CDA_CS', response.content)
+
+        ds = Dataset.objects.get(dataset='ecclimate')
+        location = Location.objects.get(location='GREENWOOD_A')
+        response = self.client.get(reverse('admin:mudata_datum_changelist'),
+                                   {'dataset__id__exact': ds.id, 'location__id__exact': location.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, Datum.objects.filter(location=location).count())
+        self.assertTrue(all(datum.location_id == location.id for datum in response.context['cl'].result_list))
+
+        datum = Datum.objects.filter(location=location).first()
+        response = self.client.get(reverse('admin:mudata_datum_change', args=(datum.pk, )))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'vForeignKeyRawIdAdminField', response.content)
+
+    def test_edits_are_reimported(self):
+        from django.urls import reverse
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip, incremental=True)
+        values = sorted(Datum.objects.values_list('location_id', 'param_id', 'x', 'value'))
+        edited, deleted = Datum.objects.order_by('pk')[:2]
+
+        response = self.client.post(reverse('admin:mudata_datum_change', args=(edited.pk, )),
+                                    {'dataset': edited.dataset_id, 'location': edited.location_id,
+                                     'param': edited.param_id, 'x': edited.x, 'value': '1234.5', 'tags': '{}'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post(reverse('admin:mudata_datum_delete', args=(deleted.pk, )), {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Datum.objects.get(pk=edited.pk).value, '1234.5')
+        self.assertFalse(Datum.objects.filter(pk=deleted.pk).exists())
+
+        # the edited series are compared with the archive again, rather than skipped as unchanged
+        import_mudata(self.kg_zip, incremental=True)
+        self.assertEqual(sorted(Datum.objects.values_list('location_id', 'param_id', 'x', 'value')), values)
+
+    def test_estimated_count(self):
+        from unittest import mock
+        from mudata.admin import EstimatedCountPaginator
+
+        data = Datum.objects.order_by('pk')
+        self.assertEqual(EstimatedCountPaginator(data, 100).count, data.count())
+        with mock.patch('mudata.admin.MAX_EXACT_COUNT', 100):
+            pk_range = data.last().pk - data.first().pk + 1
+            self.assertEqual(EstimatedCountPaginator(data, 100).count, pk_range)
+            self.assertEqual(EstimatedCountPaginator(data.filter(param__param='maxtemp'), 10).count, 100)
+
+
+class DropDatasetTest(TestCase):
+
+    kg_zip = os.path.join(os.path.dirname(__file__), 'static', 'mudata', 'kg.mudata.zip')
+
+    def setUp(self):
+        from mudata.io import import_mudata
+
+        import_mudata(self.kg_zip, incremental=True)
+        other = Dataset.objects.create(dataset='other')
+        Datum.objects.create(dataset=other, location=Location.objects.create(dataset=other, location='loc',
+                                                                             tags={'latitude': 1, 'longitude': 2}),
+                             param=Param.objects.create(dataset=other, param='param', tags={'units': 'm'}),
+                             x=1, value='3')
+
+    def counts(self):
+        from django.apps import apps
+        return {model._meta.label: model.objects.count() for model in apps.get_app_config('mudata').get_models()}
+
+    def test_drop_dataset(self):
+        from django.core.management import call_command
+        from django.db import connection
+        from django.http import Http404
+        from django.test.utils import CaptureQueriesContext
+        from mudata import views
+        from mudata.drop import drop_dataset
+
+        self.assertEqual(views.query_data({'datasets': 'ecclimate'}).count(), 1364)
+        before = self.counts()
+        with self.assertRaises(Dataset.DoesNotExist):
+            drop_dataset('ecclimate', 'missing')
+        self.assertEqual(self.counts(), before)
+
+        # one statement per table, whatever the number of rows
+        with CaptureQueriesContext(connection) as queries:
+            counts = drop_dataset('ecclimate')
+        self.assertLess(len(queries), 20)
+        self.assertEqual(counts['mudata.Datum'], 1364)
+        self.assertEqual({label: before[label] - count for label, count in counts.items()}, self.counts())
+        self.assertEqual(self.counts(), {'mudata.Dataset': 1, 'mudata.Location': 1, 'mudata.Param': 1,
+                                         'mudata.Column': 0, 'mudata.Datum': 1, 'mudata.LocationTag': 2,
+                                         'mudata.LocationPoint': 1, 'mudata.ParamTag': 1, 'mudata.TableHash': 0,
+                                         'mudata.SeriesHash': 0, 'mudata.Rollup': 0})
+        with self.assertRaises(Http404):
+            views.query_data({'datasets': 'ecclimate'})
+
+        call_command('mudata_drop', 'other', stdout=open(os.devnull, 'w'))
+        self.assertEqual(set(self.counts().values()), {0})
+
+    def test_replace_dataset(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from mudata import views
+        from mudata.drop import replace_dataset
+
+        before = self.counts()
+        old_id = Dataset.objects.get(dataset='ecclimate').id
+        counts, report = replace_dataset('ecclimate', self.kg_zip)
+        self.assertEqual(report.rows, 1364)
+        self.assertEqual(counts['mudata.Datum'], 1364)
+        after = self.counts()
+        # the incremental import hashes are not recreated by a replacement
+        self.assertEqual(after, dict(before, **{'mudata.TableHash': 0, 'mudata.SeriesHash': 0}))
+        self.assertNotEqual(Dataset.objects.get(dataset='ecclimate').id, old_id)
+        self.assertEqual(views.query_data({'datasets': 'ecclimate'}).count(), 1364)
+
+        # a failed replacement leaves the dataset as it was
+        with self.assertRaises(CommandError):
+            call_command('mudata_drop', 'other', '--replace', self.kg_zip, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.counts(), after)
@@ -16,7 +16,12 @@ urlpatterns = [
         views.view_param, name='view_param'),
 
     # the 'query' action
-    url(r'^query/(?P<format>html|json)$', views.query, name='query'),
+    url(r'^query/(?P<format>html|json|ndjson|csv)$', views.query, name='query'),
+
+    # the 'export' action
+    url(r'^export/dataset/(?P<dataset_slug>[a-zA-Z0-9_-]+)\.mudata\.zip$',
+        views.export_dataset, name='export_dataset'),
+    url(r'^export/query\.mudata\.zip$', views.export_query, name='export_query'),
 
     # the 'plot' action
     url(r'^plot/(?P<format>html|json)$', views.plot, name='plot'),
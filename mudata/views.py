@@ -1,9 +1,22 @@
 
+import base64
+import binascii
+import json
+
+from django.db import connection
 from django.shortcuts import render, get_object_or_404
-from django.http import Http404
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 
+from .aggregate import Resample, parse_aggregates, aggregate_rows, encode_aggregates
 from .datetime_parse import datetime_parse_numeric
+from .downsample import downsample, DEFAULT_PLOT_WIDTH
+from .io import stream_mudata, stream_data, encode_data, DATA_EXPORT_FIELDS, DATA_ORDERING, \
+    DATA_X_ORDERING
 from .models import Dataset, Location, Param, Datum
+from .rollups import rollup_rows
+from .slugs import slug_cache, UnknownDataset
+from .spatial import parse_spatial_filters, located
+from .tagindex import parse_tag_filters, tagged
 
 
 def index(request):
@@ -12,7 +25,13 @@ def index(request):
 
 def view_dataset(request, dataset_slug):
     dataset = get_object_or_404(Dataset, dataset=dataset_slug)
-    return render(request, 'mudata/view_dataset.html', {'dataset': dataset})
+    # locations and params can be filtered by tag (e.g., ?location_tag__region=Arctic)
+    tag_filters = parse_tag_filters(request.GET)
+    locations = tagged(Location.objects.filter(dataset=dataset), tag_filters.get(Location, {}))
+    params = tagged(Param.objects.filter(dataset=dataset), tag_filters.get(Param, {}))
+    return render(request, 'mudata/view_dataset.html', {'dataset': dataset,
+                                                        'locations': locations.order_by('location'),
+                                                        'params': params.order_by('param')})
 
 
 def view_location(request, dataset_slug, location_slug):
@@ -27,9 +46,22 @@ def view_param(request, dataset_slug, param_slug):
     return render(request, 'mudata/view_param.html', {'param': param})
 
 
-def query(request, format):
+def query_data(query_params):
+    """
+    Build a Datum QuerySet from query parameters (datasets, locations, params, x_from, x_to,
+    datetime_from, datetime_to, value_min, value_max, location_tag__<key> and
+    param_tag__<key> to restrict locations and params to those with a tag value, and bbox and
+    near/k to restrict locations to an area or the nearest to a point; see
+    spatial.parse_spatial_filters())
+    """
+    return Datum.objects.filter(**query_filters(query_params))
+
 
-    query_params = request.GET
+def query_filters(query_params):
+    """
+    Parse query parameters (see query_data()) into a dict of Datum filters: any of
+    dataset_id__in, location_id__in, param_id__in, x__gte, x__lte, value_num__gte and value_num__lte
+    """
     # TODO: validate query params (make sure datetime XOR x query is used, not both)
 
     # extract dataset/location/param restrictions
@@ -47,6 +79,16 @@ def query(request, format):
     except ValueError:
         raise ValueError("Unparsable x_to: %s" % query_params['x_to'])
 
+    # extract numeric value limits (rows whose value is not a number never match)
+    try:
+        value_min = float(query_params['value_min']) if 'value_min' in query_params else None
+    except ValueError:
+        raise ValueError("Unparsable value_min: %s" % query_params['value_min'])
+    try:
+        value_max = float(query_params['value_max']) if 'value_max' in query_params else None
+    except ValueError:
+        raise ValueError("Unparsable value_max: %s" % query_params['value_max'])
+
     # extract 'datetime' query
     datetime_from = query_params['datetime_from'] if 'datetime_from' in query_params else None
     datetime_to = query_params['datetime_to'] if 'datetime_to' in query_params else None
@@ -67,32 +109,196 @@ def query(request, format):
         except ValueError:
             raise ValueError("Unparsable datetime_to: %s" % datetime_to)
 
-    query_set = Datum.objects.all()
-    if datasets:
-        dataset_ids = []
-        for dataset in datasets:
-            dataset_ids.append(get_object_or_404(Dataset, dataset=dataset))
-        query_set = query_set.filter(dataset__in=dataset_ids)
+    # resolve all slugs to ids up front, so that data is filtered by a single IN on each column
+    if datasets or locations or params:
+        try:
+            dataset_ids, location_ids, param_ids = slug_cache.resolve(datasets, locations, params)
+        except UnknownDataset as e:
+            raise Http404('Unknown dataset: %s' % e)
 
+    filters = {}
+    if datasets:
+        filters['dataset_id__in'] = dataset_ids
     if locations:
-        for location_slug in locations:
-            location_qs = Location.objects.filter(location=location_slug)
-            query_set = query_set.filter(location__in=location_qs)
-
+        filters['location_id__in'] = location_ids
     if params:
-        for param_slug in params:
-            param_qs = Param.objects.filter(param=param_slug)
-            query_set = query_set.filter(param__in=param_qs)
+        filters['param_id__in'] = param_ids
+
+    # tags and areas are matched in a subquery that uses the tag and coordinate indexes
+    tag_filters = parse_tag_filters(query_params)
+    bbox, near = parse_spatial_filters(query_params)
+    for model, name, ids in ((Location, 'location_id__in', location_ids if locations else None),
+                             (Param, 'param_id__in', param_ids if params else None)):
+        spatial = model is Location and (bbox is not None or near is not None)
+        if model in tag_filters or spatial:
+            objects = model.objects.all()
+            if model in tag_filters:
+                objects = tagged(objects, tag_filters[model])
+            if ids is not None:
+                objects = objects.filter(id__in=ids)
+            if spatial:
+                if datasets:
+                    # the nearest locations are found among those of the requested datasets
+                    objects = objects.filter(dataset_id__in=dataset_ids)
+                objects = located(objects, bbox, near)
+            filters[name] = objects.values('id')
+
+    if x_from is not None:
+        filters['x__gte'] = x_from
+    if x_to is not None:
+        filters['x__lte'] = x_to
+
+    if value_min is not None:
+        filters['value_num__gte'] = value_min
+    if value_max is not None:
+        filters['value_num__lte'] = value_max
+
+    return filters
+
+
+def query_ordering(filters):
+    """
+    The order to return the rows selected by query_filters() in: DATA_X_ORDERING if they are
+    selected by a range of x alone (which the index on x can serve), otherwise DATA_ORDERING
+    """
+    if ('x__gte' in filters or 'x__lte' in filters) and \
+            not any(name in filters for name in ('dataset_id__in', 'location_id__in', 'param_id__in')):
+        return DATA_X_ORDERING
+    return DATA_ORDERING
+
+
+QUERY_CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# the largest page of query results that can be requested using 'limit'
+MAX_QUERY_LIMIT = 100000
+
+
+def encode_cursor(key):
+    """
+    Encode the ordering values (see query_ordering()) of the last row of a page as an opaque cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
 
-    if x_from:
-        query_set = query_set.filter(x__gte=x_from)
-    if x_to:
-        query_set = query_set.filter(x__lte=x_to)
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    if not isinstance(key, list) or len(key) != len(DATA_ORDERING) or \
+            not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in key):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    return key
+
+
+def after_cursor(query_set, key, ordering=DATA_ORDERING):
+    """
+    Filter a Datum QuerySet to the rows that come after key in ordering, using a row value
+    comparison so that the database can seek to the first row using an index (unlike OFFSET,
+    which reads and discards every row before the page)
+    """
+    table = connection.ops.quote_name(Datum._meta.db_table)
+    columns = ', '.join('%s.%s' % (table, connection.ops.quote_name(Datum._meta.get_field(name).column))
+                        for name in ordering)
+    return query_set.extra(where=['(%s) > (%s)' % (columns, ', '.join(['%s'] * len(key)))], params=key)
+
+
+def query_page(query_set, query_params, ordering=DATA_ORDERING):
+    """
+    Apply the 'cursor' and 'limit' query parameters to a Datum QuerySet
+    :param ordering: DATA_ORDERING or DATA_X_ORDERING (see query_ordering())
+    :return: A (rows, next_cursor) tuple, where rows is an iterable of DATA_EXPORT_FIELDS and
+      next_cursor is None if there are no more rows
+    """
+    try:
+        limit = int(query_params['limit']) if 'limit' in query_params else None
+    except ValueError:
+        raise ValueError("Unparsable limit: %s" % query_params['limit'])
+    if limit is not None and not 0 < limit <= MAX_QUERY_LIMIT:
+        raise ValueError("limit must be between 1 and %s" % MAX_QUERY_LIMIT)
+
+    if 'cursor' in query_params:
+        query_set = after_cursor(query_set, decode_cursor(query_params['cursor']), ordering)
+    query_set = query_set.order_by(*ordering)
+    if limit is None:
+        return query_set.values_list(*DATA_EXPORT_FIELDS).iterator(), None
+
+    # one extra row tells whether there is another page
+    rows = list(query_set.values_list(*(ordering + DATA_EXPORT_FIELDS))[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1][:len(ordering)]) if len(rows) > limit else None
+    return [row[len(ordering):] for row in rows[:limit]], next_cursor
+
+
+def query_aggregates(request, filters, format):
+    """
+    Respond to a query with 'resample' (and optionally 'agg') with the aggregated values of each
+    series, computed in the database from rollups if the buckets are made of whole rollup periods
+    :param filters: The query_filters() of the request
+    """
+    if 'limit' in request.GET or 'cursor' in request.GET:
+        raise ValueError("limit and cursor cannot be used with resample")
+    resample = Resample(request.GET['resample'])
+    aggs = parse_aggregates(request.GET.get('agg', 'mean'))
+
+    rows = rollup_rows(filters, resample, aggs)
+    if rows is None:
+        rows = aggregate_rows(Datum.objects.filter(**filters), resample, aggs)
+    if format == 'html':
+        return render(request, 'mudata/query.html', {'result': list(rows)})
+    return StreamingHttpResponse(encode_aggregates(rows, aggs, format), content_type=QUERY_CONTENT_TYPES[format])
 
-    return render(request, 'mudata/query.html',
-                    {'result': query_set}
-                  )
 
+def query(request, format):
+    filters = query_filters(request.GET)
+    if 'resample' in request.GET:
+        return query_aggregates(request, filters, format)
+    query_set = Datum.objects.filter(**filters)
+    ordering = query_ordering(filters)
+    if 'limit' not in request.GET and 'cursor' not in request.GET:
+        if format == 'html':
+            return render(request, 'mudata/query.html',
+                            {'result': query_set}
+                          )
+        return StreamingHttpResponse(stream_data(query_set, format, ordering=ordering),
+                                     content_type=QUERY_CONTENT_TYPES[format])
+
+    rows, next_cursor = query_page(query_set, request.GET, ordering)
+    if format == 'html':
+        response = render(request, 'mudata/query.html', {'result': rows, 'next_cursor': next_cursor})
+    else:
+        response = StreamingHttpResponse(encode_data(rows, format), content_type=QUERY_CONTENT_TYPES[format])
+    if next_cursor is not None:
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def mudata_response(filename, **kwargs):
+    response = StreamingHttpResponse(stream_mudata(**kwargs), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def export_dataset(request, dataset_slug):
+    get_object_or_404(Dataset, dataset=dataset_slug)
+    return mudata_response('%s.mudata.zip' % dataset_slug, datasets=Dataset.objects.filter(dataset=dataset_slug))
+
+
+def export_query(request):
+    return mudata_response('query.mudata.zip', data=query_data(request.GET))
+
+
+def plot(request, format):
+    try:
+        width = int(request.GET['width']) if 'width' in request.GET else DEFAULT_PLOT_WIDTH
+    except ValueError:
+        raise ValueError("Unparsable width: %s" % request.GET['width'])
+    method = request.GET.get('method', 'minmax')
 
-def plot(request, table, query_string):
-    pass
+    result = {'method': method, 'width': width, 'series': downsample(query_data(request.GET), width, method)}
+    if format == 'html':
+        return render(request, 'mudata/plot.html', {'result': result})
+    return JsonResponse(result)